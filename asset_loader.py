@@ -0,0 +1,175 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from mesh import Mesh
+from mesh_cache import MeshCache
+from log import Logger
+
+'''
+Loads several .obj files at once, using a pool of worker processes.
+
+Each worker parses one file and generates its normals, then writes the
+resulting meshes into a shared memory block using the mesh cache's binary
+format (see mesh_cache.py). Only the name of the block is sent back to the
+main process, which reads the meshes as views of the shared memory rather than
+unpickling them. This leaves the main (OpenGL) thread with only the GPU
+uploads to do, in Model.bind.
+'''
+
+logger = Logger(False, True, True)
+
+# Shared memory blocks created by this (worker) process, by name. On Windows
+# a block is destroyed when its last handle is closed, so workers keep theirs
+# open until they exit, when the pool shuts down (by which time the main
+# process has attached to every block).
+_worker_blocks: dict[str, SharedMemory] = {}
+
+
+def load_in_worker(obj_file: str, cache_folder: str) -> tuple:
+    """
+    Loads the meshes of an .obj file in a worker process, and stores them in
+    a new shared memory block (and the mesh cache).
+    :return: the name and size of the shared memory block, and the time taken.
+    """
+    time_start = time.perf_counter()
+
+    meshes = MeshCache(cache_folder).load_obj_file(obj_file)
+
+    layout = MeshCache.layout(meshes)
+    size = layout[3]
+    shm = SharedMemory(create=True, size=max(size, 1))
+    try:
+        MeshCache.write(np.ndarray((size,), dtype=np.uint8, buffer=shm.buf), layout)
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+
+    # The main process takes ownership of the block, and unlinks it once it
+    # has been attached to. Stop this process from unlinking it on exit (the
+    # resource tracker only exists on POSIX).
+    if os.name == "posix":
+        resource_tracker.unregister(shm._name, "shared_memory")
+    _worker_blocks[shm.name] = shm
+
+    return shm.name, size, time.perf_counter() - time_start
+
+
+class AssetLoader:
+    """Loads .obj files in parallel, and keeps track of how long each took."""
+    def __init__(self, mesh_cache: MeshCache, processes: int = None):
+        self.mesh_cache = mesh_cache
+        self.processes = processes
+
+        # Time taken for each stage of loading each file, in seconds:
+        # "load": reading the meshes (from the cache, or parsing in a worker)
+        # "transfer": reading the meshes from shared memory
+        # "bind": creating the models (see Scene.add_models_from_obj)
+        self.timings: dict[str, dict[str, float]] = {}
+
+        # Number of meshes of each file with each source of normals
+        # (see Mesh.normals_source)
+        self.normal_sources: dict[str, dict[str, int]] = {}
+
+        # (before, after) vertex cache miss ratio of each optimised mesh of
+        # each file (see MeshOptimiser)
+        self.acmr: dict[str, list[tuple]] = {}
+
+        # Shared memory blocks in use by loaded meshes. These must stay open
+        # for as long as the meshes exist, as their arrays are views of them.
+        self.shared_memory = []
+
+
+    def load_obj_files(self, obj_files: list[str]) -> dict[str, list[Mesh]]:
+        """
+        Loads the meshes of several .obj files. Files which are in the mesh
+        cache are loaded directly; the rest are loaded in worker processes.
+        :return: a dictionary of the meshes of each file.
+        """
+        meshes = {}
+        misses = []
+
+        for obj_file in obj_files:
+            time_start = time.perf_counter()
+            cached = self.mesh_cache.load(self.mesh_cache.key(obj_file))
+
+            if cached is None:
+                misses.append(obj_file)
+                continue
+
+            self.mesh_cache.hits += 1
+            meshes[obj_file] = cached
+            self.timings[obj_file] = {"load": time.perf_counter() - time_start,
+                                      "transfer": 0.0}
+
+        if len(misses) == 0:
+            return meshes
+
+        self.mesh_cache.misses += len(misses)
+        processes = self.processes or os.cpu_count() or 1
+
+        with ProcessPoolExecutor(max_workers=min(processes, len(misses))) as pool:
+            futures = {obj_file: pool.submit(load_in_worker, obj_file, self.mesh_cache.folder)
+                       for obj_file in misses}
+
+            for obj_file, future in futures.items():
+                name, size, load_time = future.result()
+
+                time_start = time.perf_counter()
+                shm = SharedMemory(name=name)
+
+                # The block is only removed once every process has closed it,
+                # so it can be unlinked straight away (on Windows, it is
+                # removed when the last handle is closed, so this does nothing).
+                shm.unlink()
+                self.shared_memory.append(shm)
+
+                data = np.ndarray((size,), dtype=np.uint8, buffer=shm.buf)
+                meshes[obj_file] = MeshCache.read(data)
+
+                self.timings[obj_file] = {"load": load_time,
+                                          "transfer": time.perf_counter() - time_start}
+
+        return meshes
+
+
+    def add_time(self, obj_file: str, stage: str, seconds: float) -> None:
+        """Records how long a stage of loading a file took."""
+        self.timings.setdefault(obj_file, {})[stage] = seconds
+
+
+    def add_meshes(self, obj_file: str, meshes: list[Mesh]) -> None:
+        """
+        Records where the normals of a file's meshes came from, and how well
+        their index buffers use the vertex cache.
+        """
+        sources = self.normal_sources.setdefault(obj_file, {"file": 0, "calculated": 0})
+        for mesh in meshes:
+            sources[mesh.normals_source] = sources.get(mesh.normals_source, 0) + 1
+        
+        self.acmr[obj_file] = [mesh.acmr for mesh in meshes if mesh.acmr is not None]
+
+
+    def print_report(self) -> None:
+        """
+        Prints the time taken to load each file, how many of its meshes used
+        normals from the file or calculated them, and the vertex cache miss
+        ratio (ACMR) of each mesh before and after optimisation.
+        """
+        print("Asset loading report:")
+        for obj_file, timing in self.timings.items():
+            stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in timing.items())
+            print(f"    {obj_file}: {stages}")
+
+            if obj_file in self.normal_sources:
+                sources = ", ".join(f"{count} {source}" for source, count
+                                    in self.normal_sources[obj_file].items())
+                print(f"        normals: {sources}")
+
+            for i, (before, after) in enumerate(self.acmr.get(obj_file, [])):
+                print(f"        mesh {i} ACMR: {before:.3f} -> {after:.3f}")
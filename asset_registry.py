@@ -0,0 +1,91 @@
+import os
+
+from OpenGL.GL import *
+
+from material import MaterialLibrary
+from texture import Texture
+from log import Logger
+
+logger = Logger(False, True, True)
+
+
+class AssetRegistry:
+    """
+    A process-wide store of assets which can be shared, so each one is only
+    loaded once however many meshes or .obj files use it.
+    - Material libraries are shared by path.
+    - Textures are shared by file name and sampler parameters, and reference
+      counted so they are deleted from the GPU once nothing uses them.
+    """
+    def __init__(self):
+        self.material_libraries: dict[str, MaterialLibrary] = {}
+
+        # Texture key => [texture, reference count]
+        self.textures: dict[tuple, list] = {}
+
+        # Total number of requests, to compare with the number of assets
+        self.material_library_requests = 0
+        self.texture_requests = 0
+
+
+    def material_library(self, file_name: str, load) -> MaterialLibrary:
+        """
+        Returns the material library at a path, calling load(file_name) to
+        load it if it hasn't been loaded already.
+        """
+        self.material_library_requests += 1
+
+        path = os.path.normpath(file_name)
+        if path not in self.material_libraries:
+            self.material_libraries[path] = load(file_name)
+        return self.material_libraries[path]
+
+
+    def acquire_texture(self, name: str, wrap=GL_REPEAT, sample=GL_NEAREST,
+                        format=GL_RGBA, type=GL_UNSIGNED_BYTE,
+                        target=GL_TEXTURE_2D) -> Texture:
+        """
+        Returns the texture for an image file with the given parameters,
+        loading it if it isn't already loaded. Every call must be matched by a
+        call to release_texture once the texture is no longer used.
+        """
+        self.texture_requests += 1
+
+        key = (name, wrap, sample, format, type, target)
+        if key not in self.textures:
+            texture = Texture(name, wrap=wrap, sample=sample, format=format,
+                              type=type, target=target)
+            texture.registry_key = key
+            self.textures[key] = [texture, 0]
+
+        entry = self.textures[key]
+        entry[1] += 1
+        return entry[0]
+
+
+    def release_texture(self, texture: Texture) -> None:
+        """Releases a texture, deleting it once it has no more users."""
+        # The key is stored as the texture's parameters may have been changed
+        key = getattr(texture, "registry_key", None)
+
+        entry = self.textures.get(key)
+        if entry is None or entry[0] is not texture:
+            logger.warning(f"Released texture {texture.name} is not in the registry.")
+            return
+
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.textures[key]
+            texture.delete()
+
+
+    def print_report(self) -> None:
+        """Prints the number of unique assets against the number of requests."""
+        print(f"Material libraries: {len(self.material_libraries)} loaded for "
+              f"{self.material_library_requests} request(s)")
+        print(f"Textures: {len(self.textures)} loaded for "
+              f"{self.texture_requests} request(s)")
+
+
+# The registry shared by the whole program
+asset_registry = AssetRegistry()
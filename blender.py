@@ -1,8 +1,12 @@
+import itertools
+import re
+
 import numpy as np
 import glm
 
 from material import Material, MaterialLibrary
 from mesh import Mesh
+from asset_registry import asset_registry
 from log import Logger
 
 '''
@@ -11,13 +15,57 @@ Reference:
 https://en.wikipedia.org/wiki/Wavefront_.obj_file
 
 The following are limitations for further use:
-    - Face format (how many of v/vt/vn are used on each line) must be consistent
-      for the whole file (the case for my models).
     - Not all line types are covered (e.g. s, o or l lines aren't covered)
 '''
 
 logger = Logger(False, True, True)
 
+# Line types read by Obj. Other types (e.g. s, o or l lines) are skipped.
+_VERTEX_LINE = re.compile(r'^[ \t]*v[ \t]+(.*)$', re.M)
+_TEXTURE_LINE = re.compile(r'^[ \t]*vt[ \t]+(.*)$', re.M)
+_NORMAL_LINE = re.compile(r'^[ \t]*vn[ \t]+(.*)$', re.M)
+_MTLLIB_LINE = re.compile(r'^[ \t]*mtllib[ \t]+(\S+)', re.M)
+_MATERIAL_LINE = re.compile(r'^[ \t]*usemtl[ \t]+(\S+)', re.M)
+_FACE_LINE = re.compile(r'^[ \t]*f[ \t]+(.*)$', re.M)
+_FACE_OR_MATERIAL_LINE = re.compile(r'^[ \t]*(f|usemtl)[ \t]+(.*?)[ \t\r]*$', re.M)
+
+# Number of lines read at once by Obj.stream_obj_file
+CHUNK_LINES = 16384
+
+
+class GrowableArray:
+    """
+    A typed array which rows can be appended to, used instead of python lists
+    while streaming. Capacity is doubled whenever it runs out, so appending
+    is amortised O(1) per row.
+    """
+    def __init__(self, row_shape, dtype, capacity=1024):
+        self.data = np.empty((capacity, *row_shape), dtype=dtype)
+        self.size = 0
+    
+    
+    def extend(self, rows):
+        """Appends an array of rows."""
+        end = self.size + len(rows)
+        if end > self.data.shape[0]:
+            data = np.empty((max(end, 2 * self.data.shape[0]), *self.data.shape[1:]),
+                            dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        
+        self.data[self.size:end] = rows
+        self.size = end
+    
+    
+    def view(self):
+        """Returns a view of the rows appended so far."""
+        return self.data[:self.size]
+    
+    
+    def clear(self):
+        """Removes all rows, keeping the capacity for reuse."""
+        self.size = 0
+
 
 class Obj:
     """A class for loading a .obj file."""
@@ -25,192 +73,257 @@ class Obj:
         self.filename = filename
         
         # Vertex coordinates, texture coordinates and normal coordinates
-        self.vlist = []
-        self.vtlist = []
-        self.vnlist = []
+        self.varray = None
+        self.vtarray = None
+        self.vnarray = None
         
-        # Indices for v, vt and vn respectively for each face
-        self.flist = []
-        self.ftlist = []
-        self.fnlist = []
-        self.mlist = []
+        # (num_triangles, 3, 3) array of v/vt/vn indices for each triangle
+        # corner. Missing vt or vn indices are stored as 0.
+        self.farray = None
+        
+        # Mesh id of each triangle, and material index of each mesh id.
+        # A new mesh starts at every usemtl line.
+        self.mesh_ids = None
+        self.materials = None
         
-        self.lnlist = []
-        self.mesh_list = []
+        # Line number of each usemtl line, for easier error locating
+        self.mesh_lines = {}
         
         self.library = None
-                
-        self.varray = None
-        self.vtarray = None
-        self.farray = None
     
     
     def load_obj_file(self):
         '''
-        Function for loading a Blender3D object file. minimalistic, and partial,
-        but sufficient for this course. You do not really need to worry about it.
+        Function for loading a Blender3D object file. The whole file is read
+        at once, each line type is collected in bulk and converted to numpy
+        arrays in a single call, and polygons are reduced to triangle fans
+        with index arithmetic rather than one face at a time.
         '''
         logger.info(f"Loading mesh(es) from Blender file {self.filename}...")
         
-        mesh_id = 0
+        with open(self.filename) as objfile:
+            text = objfile.read()
+        
+        for name in _MTLLIB_LINE.findall(text):
+            self.library = asset_registry.material_library('models/{}'.format(name),
+                                                       Obj.load_material_library)
+        
+        self.varray = Obj.parse_vectors(_VERTEX_LINE.findall(text), 3)
+        self.vtarray = Obj.parse_vectors(_TEXTURE_LINE.findall(text), 2)
+        self.vnarray = Obj.parse_vectors(_NORMAL_LINE.findall(text), 3)
+        
+        # Faces and materials must be read together, as each usemtl line
+        # applies to every face after it.
+        records = _FACE_OR_MATERIAL_LINE.findall(text)
+        is_face = np.fromiter((kind == 'f' for kind, _ in records), dtype=bool,
+                              count=len(records))
+        face_lines = [fields for kind, fields in records if kind == 'f']
+        material_names = [fields for kind, fields in records if kind != 'f']
+        
+        # Material number n (from 1) belongs to mesh id n; faces before the
+        # first usemtl line belong to mesh id 0, which has no material.
+        material_ids = [None]
+        for name in material_names:
+            material_ids.append(self.library.names[name])
+        
+        line_num = 1
+        last_pos = 0
+        for mesh_id, match in enumerate(_MATERIAL_LINE.finditer(text), 1):
+            line_num += text.count('\n', last_pos, match.start())
+            last_pos = match.start()
+            self.mesh_lines[mesh_id] = line_num
+            logger.info(f"[{line_num}] Loading mesh with material: {match.group(1)}")
         
-        # current material object
+        face_mesh_ids = np.cumsum(~is_face)[is_face]
+        
+        corners, corner_counts = Obj.parse_faces(face_lines)
+        self.farray, triangle_counts = Obj.triangulate(corners, corner_counts)
+        self.mesh_ids = np.repeat(face_mesh_ids, triangle_counts)
+        self.materials = material_ids
+        
+        logger.info(f"File read. Found {len(self.varray)} vertices and {len(self.farray)} faces.")
+        
+        return self.__create_meshes_from_blender()
+    
+    
+    def stream_obj_file(self, chunk_lines=CHUNK_LINES):
+        '''
+        Generator version of load_obj_file, which yields each mesh as soon as
+        its usemtl block ends rather than once the whole file has been read.
+        
+        The file is read chunk_lines lines at a time, and each chunk is
+        parsed in bulk as in load_obj_file. Vertex data is global to the
+        file, so it is kept in growable typed buffers for the whole read,
+        but faces are only kept until their mesh is created, so memory use
+        is bounded by the largest mesh rather than the whole file.
+        '''
+        logger.info(f"Streaming mesh(es) from Blender file {self.filename}...")
+        
+        vertices = GrowableArray((3,), 'f')
+        textures = GrowableArray((2,), 'f')
+        normals = GrowableArray((3,), 'f')
+        faces = GrowableArray((3, 3), np.uint32)
+        
+        mesh_id = 0
         material = None
-
+        num_meshes = 0
+        line_num = 1
+        
         with open(self.filename) as objfile:
-            line_num = 0 # count line number for easier error locating
-
-            # loop over all lines in the file
-            for line in objfile:
-                # Process line and increment line number
-                data = Obj.process_line(line)
-                line_num += 1
-
-                # Skip empty line
-                if data is None:
-                    continue
-
-                elif data[0] == 'vertex':
-                    self.vlist.append(data[1])
-
-                elif data[0] == 'vertex-texture':
-                    self.vtlist.append(data[1])
+            while True:
+                lines = list(itertools.islice(objfile, chunk_lines))
+                if len(lines) == 0:
+                    break
+                text = ''.join(lines)
                 
-                elif data[0] == "vertex-normal":
-                    self.vnlist.append(data[1])
-
-                elif data[0] == 'face':
-                    # data[1] means the face data.
+                # Split the chunk at each usemtl line, as each one ends the
+                # current mesh and starts a new one.
+                block_start = 0
+                for match in itertools.chain(_MATERIAL_LINE.finditer(text), [None]):
+                    block_end = len(text) if match is None else match.start()
+                    block = text[block_start:block_end]
                     
-                    # How many values provided per face element.
-                    # f v1 ... => size = 1
-                    # f v1/vt1 ... => size = 2
-                    # f v1//vn1 ... => size = 2
-                    # f v1/vt1/vn1 ... => size = 3
-                    # Any other size is invalid.
-                    size = len(data[1][0])
+                    for name in _MTLLIB_LINE.findall(block):
+                        self.library = asset_registry.material_library(
+                            'models/{}'.format(name), Obj.load_material_library)
                     
-                    if size not in [1, 2, 3]:        
-                        logger.error("Expected 1-3 arguments per face, got {size}.\
-                                     \n{data[1][0]}")
+                    vertices.extend(Obj.parse_vectors(_VERTEX_LINE.findall(block), 3))
+                    textures.extend(Obj.parse_vectors(_TEXTURE_LINE.findall(block), 2))
+                    normals.extend(Obj.parse_vectors(_NORMAL_LINE.findall(block), 3))
                     
-                    n = len(data[1])               
+                    corners, corner_counts = Obj.parse_faces(_FACE_LINE.findall(block))
+                    faces.extend(Obj.triangulate(corners, corner_counts)[0])
+                    
+                    line_num += block.count('\n')
+                    if match is None:
+                        break
+                    
+                    if faces.size > 0:
+                        self.varray = vertices.view()
+                        self.vtarray = textures.view()
+                        self.vnarray = normals.view()
+                        yield self.__create_mesh(faces.view(), material)
+                        num_meshes += 1
+                        faces.clear()
                     
-                    # Attempt to reduce the n-sided face into n-2 triangles
-                    # Works for most shapes, but this order of triangles is
-                    # not necessarily correct (e.g. non-convex shapes)
-                    for i in range(1, n-1):
-                        sub_face = [data[1][0], data[1][i], data[1][i+1]]
-                        
-                        self.ftlist.extend([vert[1] for vert in sub_face])
-                        self.fnlist.extend([vert[2] for vert in sub_face])
-                        self.flist.append([vert[:-1] for vert in sub_face])
-                        
-                        self.mesh_list.append(mesh_id)
-                        self.mlist.append(material)
-                        self.lnlist.append(line_num)
-                                                    
-                elif data[0] == 'material-lib':
-                    self.library = Obj.load_material_library('models/{}'.format(data[1]))
-
-                # material indicate a new mesh in the file, so we store the previous one if not empty and start
-                # a new one.
-                elif data[0] == 'material':
-                    material = self.library.names[data[1]]
                     mesh_id += 1
-                    logger.info(f"[{line_num}] Loading mesh with material: {data[1]}")
-
-        logger.info(f"File read. Found {len(self.vlist)} vertices and {len(self.flist)} faces.")
-
-        return self.__create_meshes_from_blender()
+                    material = self.library.names[match.group(1)]
+                    self.mesh_lines[mesh_id] = line_num
+                    logger.info(f"[{line_num}] Loading mesh with material: {match.group(1)}")
+                    block_start = match.start()
+        
+        self.varray = vertices.view()
+        self.vtarray = textures.view()
+        self.vnarray = normals.view()
+        
+        # add the last mesh
+        if faces.size > 0:
+            yield self.__create_mesh(faces.view(), material)
+            num_meshes += 1
+        
+        logger.info(f"Streamed {num_meshes} mesh(es) from Blender file.")
     
     
     @staticmethod
-    def process_line(line):
+    def parse_vectors(lines, size):
         '''
-        Function for reading the Blender3D object file, line by line. Clearly
-        minimalistic and slow as it is, but it will do the job nicely for this course.
+        Converts the fields of every v, vt or vn line into a single
+        (num_lines, size) float array. Extra fields (e.g. a 0.000 third
+        texture coordinate) are ignored.
         '''
-        label = None
-        fields = line.split()
+        if len(lines) == 0:
+            return np.zeros((0, size), dtype='f')
         
-        if len(fields) == 0:
-            return None
+        counts = np.fromiter((len(line.split()) for line in lines),
+                             dtype=np.int64, count=len(lines))
         
-        match fields[0]:
-            case '#':
-                return None
-            case 'v':
-                label = "vertex"
-                if len(fields) != 4:
-                    logger.error("3 entries expected for vertex")
-                    return None
-            case 'vt':
-                label = "vertex-texture"
-                if len(fields) != 3:
-                    if len(fields) == 4 and fields[3] == 0.000:
-                        print(fields[3])
-                        # Ignore third coordinate as it is 0
-                        fields = fields[:-1]
-                        print(fields)
-                    else:
-                        logger.error("2 entries expected for vertex texture")
-                        return None
-            case 'vn':
-                label = "vertex-normal"
-                if len(fields) != 4:
-                    logger.error("3 entries expected for vertex normal")
-                    return None
-            case 'f':
-                label = 'face'
-
-                # multiple formats for faces lines, eg
-                # f 586/1 1860/2 1781/3
-                # f vi/ti/ni
-                # f vi//ni
-                # where vi is the vertex index
-                # ti is the texture index
-                # ni is the normal index (optional)
-                face = []
-                for v in fields[1:]:
-                    vert = []
-                    current_str = ""
-                    for char in v:
-                        if char != "/":
-                            current_str += char
-                        else:
-                            if current_str == "":
-                                vert.append(0)
-                            else:
-                                vert.append(np.uint32(current_str))
-                            current_str = ""
-                    
-                    # If vt or vn are missing, append zeroes
-                    for i in range(3 - len(vert)):
-                        vert.append(0)
-                    face.append(vert)
-                return (label, face)
-            case 'mtllib':
-                label = "material-lib"
-                if len(fields) != 2:
-                    logger.error("Material library missing filename")
-                    return None
-                else:
-                    return (label, fields[1])
-            case 'usemtl':
-                label = "material"
-                if len(fields) != 2:
-                    logger.error("Material missing filename")
-                    return None
-                else:
-                    return (label, fields[1])
-            case 's' 'l' 'o':
-                return None
-            case _:
-                logger.warning(f"Unknown line: {fields}")
-                return None
+        # Fast path: every line has the same number of fields
+        width = int(counts[0])
+        if width >= size and np.all(counts == width):
+            values = np.array(' '.join(lines).split(), dtype='f')
+            return np.ascontiguousarray(values.reshape(-1, width)[:, :size])
+        
+        rows = [line.split()[:size] for line in lines]
+        if any(len(row) != size for row in rows):
+            logger.error(f"{size} entries expected for each vector in {lines[0]}")
+            rows = [row + ['0'] * (size - len(row)) for row in rows]
+        return np.array(rows, dtype='f')
+    
+    
+    @staticmethod
+    def parse_faces(lines):
+        '''
+        Converts the fields of every f line into a (num_corners, 3) array of
+        v/vt/vn indices, and an array containing the number of corners of
+        each face.
+        
+        Multiple formats are used for face lines, eg
+        f 586/1 1860/2 1781/3
+        f vi/ti/ni
+        f vi//ni
+        where vi is the vertex index
+        ti is the texture index
+        ni is the normal index (optional)
+        '''
+        counts = np.fromiter((len(line.split()) for line in lines),
+                             dtype=np.int64, count=len(lines))
+        if len(lines) == 0:
+            return np.zeros((0, 3), dtype=np.uint32), counts
+        
+        corners = ' '.join(lines).split()
+        
+        # How many values provided per face element.
+        # f v1 ... => size = 1
+        # f v1/vt1 ... => size = 2
+        # f v1//vn1 ... => size = 3
+        # f v1/vt1/vn1 ... => size = 3
+        # Any other size is invalid.
+        sizes = np.fromiter((corner.count('/') + 1 for corner in corners),
+                            dtype=np.int64, count=len(corners))
+        if np.any(sizes > 3):
+            invalid = corners[int(np.argmax(sizes > 3))]
+            logger.error(f"Expected 1-3 arguments per face, got {invalid.count('/') + 1}.\n{invalid}")
+        
+        indices = np.zeros((len(corners), 3), dtype=np.uint32)
+        
+        # Fast path: every corner has the same format
+        size = int(sizes[0])
+        if size <= 3 and np.all(sizes == size):
+            # A missing texture index (v//vn) is stored as 0
+            values = ' '.join(corners).replace('//', '/0/').replace('/', ' ').split()
+            indices[:, :size] = np.array(values, dtype=np.uint32).reshape(-1, size)
+        else:
+            # The face format changes within the file, so pad every corner
+            # to v/vt/vn before splitting it.
+            fields = '/'.join(corner + '/' * (2 - corner.count('/')) for corner in corners)
+            values = [value or '0' for value in fields.split('/')]
+            indices[:] = np.array(values, dtype=np.uint32).reshape(-1, 3)
+        return indices, counts
 
-        return (label, [float(token) for token in fields[1:]])
+    
+    @staticmethod
+    def triangulate(corners, corner_counts):
+        '''
+        Attempt to reduce each n-sided face into n-2 triangles (a fan around
+        its first corner).
+        Works for most shapes, but this order of triangles is
+        not necessarily correct (e.g. non-convex shapes)
+        :param corners: (num_corners, 3) array of v/vt/vn indices
+        :param corner_counts: The number of corners of each face
+        :return: a (num_triangles, 3, 3) array of v/vt/vn indices, and the
+        number of triangles each face was split into.
+        '''
+        if np.any(corner_counts < 3):
+            logger.warning(f"Ignoring {np.sum(corner_counts < 3)} face(s) with fewer than 3 vertices.")
+        triangle_counts = np.maximum(corner_counts - 2, 0)
+        face_starts = np.cumsum(corner_counts) - corner_counts
+        triangle_starts = np.cumsum(triangle_counts) - triangle_counts
+        
+        first = np.repeat(face_starts, triangle_counts)
+        k = np.arange(first.shape[0]) - np.repeat(triangle_starts, triangle_counts)
+        fans = np.stack([first, first + k + 1, first + k + 2], axis=1)
+        
+        return corners[fans], triangle_counts
 
     
     @staticmethod
@@ -278,104 +391,100 @@ class Obj:
 
 
     def __create_meshes_from_blender(self):
-        fstart = 0
-        mesh_id = 1
         meshes = []
-            
-        # Create np array objects for vlist and (optionally) vtlist
-        self.varray = np.array(self.vlist, dtype='f')
-        self.vtarray = np.array(self.vtlist, dtype='f')
     
         # Obj has no faces or materials
-        if fstart >= len(self.mlist):
-            return
+        if self.farray is None or len(self.farray) == 0:
+            return meshes
         
-        material = self.mlist[fstart]
+        # New mesh is denoted by change in material
+        boundaries = np.flatnonzero(np.diff(self.mesh_ids)) + 1
+        fstarts = np.concatenate([[0], boundaries])
+        fends = np.concatenate([boundaries, [len(self.farray)]])
     
-        for f in range(len(self.flist)):
-            if mesh_id != self.mesh_list[f]:  # new mesh is denoted by change in material
-                logger.info(f"Creating new mesh {mesh_id}, faces {fstart}-{f},\
-line {self.lnlist[fstart]}, with material {self.mlist[fstart]}:\
-{self.library.materials[self.mlist[fstart]].name}")
+        for fstart, fend in zip(fstarts, fends):
+            mesh_id = self.mesh_ids[fstart]
+            material = self.materials[mesh_id]
+            logger.info(f"Creating new mesh {mesh_id}, faces {fstart}-{fend},\
+line {self.mesh_lines.get(mesh_id)}, with material {material}:\
+{self.library.materials[material].name}")
 
-                try:
-                    mesh = self.__create_mesh(fstart, f, material)
-                    meshes.append(mesh)
-                except:
-                    logger.error("Could not load mesh!")
-                    raise
-    
-                mesh_id = self.mesh_list[f]
-    
-                # start the next mesh
-                fstart = f
-                material = self.mlist[fstart]
-    
-        # add the last mesh
-        try:
-            mesh = self.__create_mesh(fstart, len(self.flist), material)
-            meshes.append(mesh)
-        except:
-            logger.error("Could not load mesh!")
-            raise
+            try:
+                mesh = self.__create_mesh(self.farray[fstart:fend], material)
+                meshes.append(mesh)
+            except:
+                logger.error("Could not load mesh!")
+                raise
     
         logger.info(f"Created {len(meshes)} mesh(es) from Blender file.")
         return meshes
 
 
-    def __create_mesh(self, fstart, findex, material):
-        # select faces for this mesh
-        self.farray = np.array(self.flist[fstart:findex], dtype=np.uint32)
-    
-        # and vertices
-        vmax = np.max(self.farray[:, :, 0].flatten())
-        vmin = np.min(self.farray[:, :, 0].flatten()) - 1
-    
-        # fix blender texture intexing
-        textures = self.__fix_blender_textures()
-        if textures is not None:
-            textures = textures[vmin:vmax, :]
-            
-        normal_list = []
-        normal_array = None
-        
-        # If normals are assigned, the first, and every element in fnlist will
-        # be non-zero. Just need to check the first element.
-        if self.fnlist[0] != 0:
-            num_faces = len(self.fnlist) / 3
-            if not isinstance(num_faces, int):
-                logger.error(f"Number of face normals is incorrect.\n{num_faces * 3}")
-            normal_array = np.array(normal_list, dtype="f")
+    def __create_mesh(self, faces, material):
+        '''
+        Creates a mesh from its faces (v/vt/vn indices for each triangle).
+        Blender allows for multiple indexing of vertices and textures, which
+        is not supported by OpenGL, so each unique v/vt/vn combination used by
+        the faces becomes one vertex of the mesh.
+        Normals from vn lines are used when available, so the mesh does not
+        need to calculate them.
+        '''
+        corners, indices = Obj.weld(faces)
+        
+        textures = Obj.gather(self.vtarray, corners[:, 1])
+        if textures is None:
+            logger.warning("No texture indices provided, setting texture coordinate array as None")
+        
+        # Only use the file's normals if every corner has one; otherwise
+        # the mesh calculates its own.
+        normals = None
+        if np.all(corners[:, 2] > 0):
+            normals = Obj.gather(self.vnarray, corners[:, 2])
     
-        return Mesh(
-            vertices=self.varray[vmin:vmax, :],
-            faces=self.farray[:, :, 0] - vmin - 1,
+        mesh = Mesh(
+            vertices=self.varray[corners[:, 0] - 1],
+            faces=indices,
             material=self.library.materials[material],
-            normals=normal_array,
+            normals=normals,
             textureCoords=textures
         )
-
-
-    def __fix_blender_textures(self):
-        '''
-        Corrects the indexing of textures in Blender file for OpenGL.
-        Blender allows for multiple indexing of vertices and textures, which is not supported by OpenGL.
-        This function ensures that indexing is consistent.
-        :param textures: Original Blender texture UV values
-        :param faces: Blender faces multiple-index
-        :return: a new texture array indexed according to vertices.
-        '''
-        # (OpenGL, unlike Blender, does not allow for multiple indexing!)
+        
+        if normals is not None:
+            mesh.normals_source = "file"
+        
+        return mesh
     
-        if self.ftlist[0] == 0:
-            logger.warning("No texture indices provided, setting texture coordinate array as None")
-            return None
     
-        # Create an array of size (num_vertices, 2)
-        new_textures = np.zeros((self.varray.shape[0], 2), dtype='f')
+    @staticmethod
+    def weld(faces):
+        '''
+        Finds the unique v/vt/vn combinations used by a set of faces.
+        Each combination is packed into a single integer key so that numpy
+        can sort and deduplicate them in one call.
+        :param faces: (num_triangles, 3, 3) array of v/vt/vn indices
+        :return: a (num_vertices, 3) array of the unique v/vt/vn combinations
+        (in order of their keys), and a (num_triangles, 3) array of indices
+        into it for each triangle.
+        '''
+        corners = faces.reshape(-1, 3).astype(np.int64)
+        sizes = corners.max(axis=0) + 1
+        keys = (corners[:, 0] * sizes[1] + corners[:, 1]) * sizes[2] + corners[:, 2]
+        
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        
+        return corners[first], inverse.reshape(-1, 3).astype(np.uint32)
     
-        for f in range(self.farray.shape[0]):
-            for j in range(self.farray.shape[1]):
-                new_textures[self.farray[f, j, 0] - 1, :] = self.vtarray[self.farray[f, j, 1] - 1, :]
     
-        return new_textures
+    @staticmethod
+    def gather(array, indices):
+        '''
+        Returns the rows of array for each (1-based) index, or None if no
+        indices are given. Missing (0) indices give a row of zeros.
+        '''
+        if not np.any(indices):
+            return None
+        
+        rows = np.zeros((len(indices), array.shape[1]), dtype='f')
+        present = indices > 0
+        rows[present] = array[indices[present] - 1]
+        return rows
@@ -0,0 +1,313 @@
+from OpenGL.GL import *
+
+import numpy as np
+
+from vertex_format import VertexFormat
+from log import Logger
+
+'''
+Suballocated vertex and index storage. Rather than every mesh having its own
+vertex buffer, index buffer and vao, meshes with the same vertex format share
+a few large blocks, each of which has:
+    - one vertex buffer and one index buffer, whose ranges are handed out by
+      free-list allocators (in vertices and indices, so vertex ranges stay
+      aligned to the format's stride), and
+    - one vao, pointing the format's attributes at the vertex buffer.
+Indices are stored relative to their mesh's first vertex, so they are drawn
+with glDrawElementsBaseVertex (base vertex = the start of the mesh's range).
+
+Freed ranges are merged with their free neighbours. defragment moves every
+block's allocations to the start of its buffers, leaving one free range at
+the end; allocations are objects, so their owners see the new offsets.
+'''
+
+logger = Logger(False, True, True)
+
+# Default size of each block's buffers; larger meshes get a block of their own
+BLOCK_VERTEX_BYTES = 8 * 1024 * 1024
+BLOCK_INDEX_BYTES = 4 * 1024 * 1024
+
+
+class Allocation:
+    """A range of an allocator, in its units."""
+    def __init__(self, offset: int, size: int):
+        self.offset = offset
+        self.size = size
+
+
+class FreeListAllocator:
+    """First-fit allocator of ranges in [0, capacity)."""
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+
+        # Free [offset, size] ranges, sorted by offset and never adjacent
+        self.free_ranges = [[0, capacity]] if capacity > 0 else []
+
+        # Live allocations
+        self.allocations: list[Allocation] = []
+
+
+    def allocate(self, size: int) -> Allocation:
+        """Returns a new allocation of size units, or None if no range fits."""
+        if size == 0:
+            allocation = Allocation(0, 0)
+            self.allocations.append(allocation)
+            return allocation
+
+        for i, (offset, free) in enumerate(self.free_ranges):
+            if free >= size:
+                if free == size:
+                    del self.free_ranges[i]
+                else:
+                    self.free_ranges[i] = [offset + size, free - size]
+
+                allocation = Allocation(offset, size)
+                self.allocations.append(allocation)
+                return allocation
+        return None
+
+
+    def free(self, allocation: Allocation) -> None:
+        """Returns an allocation's range, merging it with free neighbours."""
+        self.allocations.remove(allocation)
+        if allocation.size == 0:
+            return
+
+        start, end = allocation.offset, allocation.offset + allocation.size
+        i = 0
+        while i < len(self.free_ranges) and self.free_ranges[i][0] < start:
+            i += 1
+
+        # Merge with the following range, then the preceding one
+        if i < len(self.free_ranges) and self.free_ranges[i][0] == end:
+            end += self.free_ranges.pop(i)[1]
+        if i > 0 and sum(self.free_ranges[i - 1]) == start:
+            start = self.free_ranges[i - 1][0]
+            self.free_ranges[i - 1] = [start, end - start]
+        else:
+            self.free_ranges.insert(i, [start, end - start])
+
+
+    def compact(self) -> list:
+        """
+        Moves every allocation to the start of the range, in order.
+        :return: the (allocation, old offset) of each allocation moved.
+        """
+        moves = []
+        offset = 0
+        for allocation in sorted(self.allocations, key=lambda a: a.offset):
+            if allocation.offset != offset:
+                moves.append((allocation, allocation.offset))
+                allocation.offset = offset
+            offset += allocation.size
+
+        self.free_ranges = [[offset, self.capacity - offset]] if offset < self.capacity else []
+        return moves
+
+
+    def used(self) -> int:
+        return sum(allocation.size for allocation in self.allocations)
+
+
+    def largest_free(self) -> int:
+        return max((size for _, size in self.free_ranges), default=0)
+
+
+class BufferBlock:
+    """One vertex buffer, index buffer and vao, shared by meshes of one format."""
+    def __init__(self, stride: int, formats: tuple, index_size: int,
+                 vertex_capacity: int, index_capacity: int):
+        self.stride = stride
+        self.index_size = index_size
+
+        self.vertices = FreeListAllocator(vertex_capacity)
+        self.indices = FreeListAllocator(index_capacity)
+
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+
+        self.vertex_buffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer)
+        glBufferData(GL_ARRAY_BUFFER, vertex_capacity * stride, None, GL_STATIC_DRAW)
+        VertexFormat.point_attributes(formats, stride)
+
+        self.index_buffer = glGenBuffers(1)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, max(index_capacity, 1) * index_size, None,
+                     GL_STATIC_DRAW)
+
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+
+    def allocate(self, vertex_count: int, index_count: int) -> tuple:
+        """
+        Allocates ranges for a mesh's vertices and indices.
+        :return: the vertex and index allocations, or None if they don't fit.
+        """
+        vertices = self.vertices.allocate(vertex_count)
+        if vertices is None:
+            return None
+
+        indices = self.indices.allocate(index_count)
+        if indices is None:
+            self.vertices.free(vertices)
+            return None
+
+        return vertices, indices
+
+
+    def upload(self, vertices: Allocation, vertex_data: np.ndarray,
+               indices: Allocation, index_data: np.ndarray) -> None:
+        """Uploads a mesh's vertex and index data to its ranges."""
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer)
+        glBufferSubData(GL_ARRAY_BUFFER, vertices.offset * self.stride, vertex_data.nbytes,
+                        vertex_data)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        if index_data.size > 0:
+            # The element array binding is part of the vao's state, so the
+            # index buffer is bound as a copy target instead
+            glBindBuffer(GL_COPY_WRITE_BUFFER, self.index_buffer)
+            glBufferSubData(GL_COPY_WRITE_BUFFER, indices.offset * self.index_size,
+                            index_data.nbytes, index_data)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+
+    def defragment(self) -> int:
+        """
+        Moves the allocations of both buffers to their starts.
+        :return: the number of bytes copied.
+        """
+        copied = 0
+        for buffer, allocator, unit in ((self.vertex_buffer, self.vertices, self.stride),
+                                        (self.index_buffer, self.indices, self.index_size)):
+            moves = allocator.compact()
+            if len(moves) == 0:
+                continue
+
+            # Copy the live ranges through a temporary buffer, as copies
+            # within one buffer must not overlap
+            used = allocator.used() * unit
+            temporary = glGenBuffers(1)
+            glBindBuffer(GL_COPY_READ_BUFFER, buffer)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, temporary)
+            glBufferData(GL_COPY_WRITE_BUFFER, used, None, GL_STREAM_COPY)
+
+            old_offsets = {id(allocation): offset for allocation, offset in moves}
+            for allocation in allocator.allocations:
+                old_offset = old_offsets.get(id(allocation), allocation.offset)
+                glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER,
+                                    old_offset * unit, allocation.offset * unit,
+                                    allocation.size * unit)
+
+            glBindBuffer(GL_COPY_READ_BUFFER, temporary)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, buffer)
+            glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, 0, 0, used)
+
+            glBindBuffer(GL_COPY_READ_BUFFER, 0)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+            glDeleteBuffers(1, np.array([temporary], dtype=np.uint32))
+            copied += 2 * used
+
+        return copied
+
+
+    def total_bytes(self) -> int:
+        return self.vertices.capacity * self.stride + self.indices.capacity * self.index_size
+
+
+    def used_bytes(self) -> int:
+        return self.vertices.used() * self.stride + self.indices.used() * self.index_size
+
+
+    def delete(self) -> None:
+        glDeleteBuffers(2, np.array([self.vertex_buffer, self.index_buffer], dtype=np.uint32))
+        glDeleteVertexArrays(1, np.array([self.vao], dtype=np.uint32))
+
+
+class BufferPool:
+    """The blocks of every vertex format."""
+    def __init__(self):
+        # (stride, attribute formats, index size) => blocks
+        self.blocks: dict[tuple, list[BufferBlock]] = {}
+
+
+    def allocate(self, stride: int, formats: tuple, index_size: int,
+                 vertex_data: np.ndarray, index_data: np.ndarray) -> tuple:
+        """
+        Stores a mesh's interleaved vertices and its indices (relative to its
+        first vertex) in a block of their format, creating one if none has room.
+        :return: the block, and the vertex and index allocations.
+        """
+        vertex_count = vertex_data.shape[0]
+        index_count = index_data.size
+        blocks = self.blocks.setdefault((stride, formats, index_size), [])
+
+        allocation = None
+        for block in blocks:
+            allocation = block.allocate(vertex_count, index_count)
+            if allocation is not None:
+                break
+        else:
+            block = BufferBlock(stride, formats, index_size,
+                                max(BLOCK_VERTEX_BYTES // stride, vertex_count),
+                                max(BLOCK_INDEX_BYTES // index_size, index_count))
+            blocks.append(block)
+            allocation = block.allocate(vertex_count, index_count)
+
+        vertices, indices = allocation
+        block.upload(vertices, vertex_data, indices, index_data)
+        return block, vertices, indices
+
+
+    def free(self, block: BufferBlock, vertices: Allocation, indices: Allocation) -> None:
+        """Frees a mesh's ranges. Empty blocks are deleted, except a format's first."""
+        block.vertices.free(vertices)
+        block.indices.free(indices)
+
+        for key, blocks in self.blocks.items():
+            if block in blocks and len(block.vertices.allocations) == 0 and blocks[0] is not block:
+                blocks.remove(block)
+                block.delete()
+                break
+
+
+    def defragment(self) -> int:
+        """
+        Compacts every block.
+        :return: the number of bytes copied.
+        """
+        copied = sum(block.defragment() for blocks in self.blocks.values() for block in blocks)
+        logger.info(f"Defragmented buffer pool, copying {copied} bytes")
+        return copied
+
+
+    def fragmentation(self) -> float:
+        """
+        Returns the fraction of free space which is not in the largest free
+        range of its buffer (0 when every buffer's free space is contiguous).
+        """
+        free = 0
+        largest = 0
+        for blocks in self.blocks.values():
+            for block in blocks:
+                for allocator in (block.vertices, block.indices):
+                    unit = block.stride if allocator is block.vertices else block.index_size
+                    free += (allocator.capacity - allocator.used()) * unit
+                    largest += allocator.largest_free() * unit
+        return 0.0 if free == 0 else 1.0 - largest / free
+
+
+    def print_report(self) -> None:
+        """Prints the blocks, bytes and fragmentation of the pool."""
+        blocks = [block for blocks in self.blocks.values() for block in blocks]
+        total = sum(block.total_bytes() for block in blocks)
+        used = sum(block.used_bytes() for block in blocks)
+        print(f"Buffer pool: {len(blocks)} block(s) for {len(self.blocks)} vertex format(s), "
+              f"{used / 1024:.1f} KiB used of {total / 1024:.0f} KiB, "
+              f"{100 * self.fragmentation():.2f}% fragmented")
+
+
+# The buffer pool shared by the whole program
+buffer_pool = BufferPool()
@@ -0,0 +1,281 @@
+import ctypes
+
+from OpenGL.GL import *
+
+import numpy as np
+
+from model import DrawModelFromMesh
+from vertex_format import VertexFormat
+from log import Logger
+
+'''
+Vertex data which is rewritten by the CPU every frame (e.g. deforming or
+morphing meshes).
+
+A DynamicBuffer is a ring of FRAMES copies (regions) of the data in one
+buffer. Each update writes the next region while the GPU may still be
+drawing from the others, so the CPU never waits for the draws of the last
+frame, and never overwrites data they are reading:
+
+    update n:   write region n % FRAMES, then draw from it
+
+Before moving on from a region, a fence is inserted after its last draw;
+the next write to that region waits for its fence (which it should have
+long since passed, FRAMES updates later).
+
+With GL 4.4 or ARB_buffer_storage, the buffer's storage is immutable and
+persistently (and coherently) mapped, so each region is a numpy array
+viewing mapped memory, and updates are written straight into it: there is
+no staging copy or glBufferSubData. Otherwise the regions are numpy arrays
+which are uploaded with glBufferSubData after each write.
+
+A DynamicModel draws from a DynamicBuffer holding its mesh's interleaved
+vertices (always in the float formats), with the indices from the buffer
+pool, and base vertex region * vertex count. The bytes written to dynamic
+buffers, and the writes which had to wait, are counted each frame.
+'''
+
+logger = Logger(False, True, True)
+
+# Regions in each ring
+FRAMES = 3
+
+# Nanoseconds to wait for a fence before checking again
+FENCE_TIMEOUT = 1000000
+
+
+class DynamicStats:
+    """Counts the bytes written to dynamic buffers, and the writes which waited."""
+    def __init__(self):
+        self.bytes = 0
+        self.waits = 0
+
+        # Counts for the last complete frame
+        self.frame_bytes = 0
+        self.frame_waits = 0
+
+
+    def end_frame(self):
+        """Stores the counts of the frame which just finished, and resets them."""
+        self.frame_bytes = self.bytes
+        self.frame_waits = self.waits
+        self.bytes = 0
+        self.waits = 0
+
+
+# The dynamic buffer statistics of the whole program
+dynamic_stats = DynamicStats()
+
+
+class DynamicBuffer:
+    def __init__(self, region_size: int, target=GL_ARRAY_BUFFER, frames=FRAMES):
+        """
+        Creates a ring of regions.
+        :param region_size: The size of each region in bytes.
+        """
+        self.region_size = region_size
+        self.target = target
+        self.frames = frames
+
+        # Region drawn from, and the fence after the last draw of each region
+        self.current = 0
+        self.fences = [None] * frames
+
+        self.persistent = DynamicBuffer.supported()
+
+        size = region_size * frames
+        self.buffer = glGenBuffers(1)
+        glBindBuffer(target, self.buffer)
+
+        if self.persistent:
+            flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+            glBufferStorage(target, size, None, flags)
+            pointer = glMapBufferRange(target, 0, size, flags)
+            memory = np.ctypeslib.as_array(ctypes.cast(pointer, ctypes.POINTER(ctypes.c_ubyte)),
+                                           shape=(size,))
+        else:
+            glBufferData(target, size, None, GL_DYNAMIC_DRAW)
+            memory = np.zeros(size, dtype=np.uint8)
+
+        glBindBuffer(target, 0)
+
+        # (frames, region_size) view of the mapped memory (or the copies to upload)
+        self.regions = memory.reshape(frames, region_size)
+
+
+    @staticmethod
+    def supported() -> bool:
+        """Returns whether the current context can persistently map buffers."""
+        major = glGetIntegerv(GL_MAJOR_VERSION)
+        minor = glGetIntegerv(GL_MINOR_VERSION)
+        if (major, minor) >= (4, 4):
+            return True
+
+        extensions = {glGetStringi(GL_EXTENSIONS, i).decode()
+                      for i in range(glGetIntegerv(GL_NUM_EXTENSIONS))}
+        return "GL_ARB_buffer_storage" in extensions
+
+
+    def fill(self, data: np.ndarray) -> None:
+        """Writes the same data to every region, e.g. before the first update."""
+        data = np.ascontiguousarray(data).view(np.uint8).ravel()
+        self.regions[:, :data.size] = data
+
+        if not self.persistent:
+            glBindBuffer(self.target, self.buffer)
+            glBufferSubData(self.target, 0, self.regions.nbytes, self.regions)
+            glBindBuffer(self.target, 0)
+
+
+    def begin_write(self) -> np.ndarray:
+        """
+        Fences the region being drawn from, waits until the GPU has finished
+        with the next region, and returns it to be written.
+        :return: the next region, as a region_size uint8 array.
+        """
+        if self.fences[self.current] is not None:
+            glDeleteSync(self.fences[self.current])
+        self.fences[self.current] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+        region = (self.current + 1) % self.frames
+        fence = self.fences[region]
+        if fence is not None:
+            status = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 0)
+            if status == GL_TIMEOUT_EXPIRED:
+                dynamic_stats.waits += 1
+                while status == GL_TIMEOUT_EXPIRED:
+                    status = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, FENCE_TIMEOUT)
+
+            glDeleteSync(fence)
+            self.fences[region] = None
+
+        return self.regions[region]
+
+
+    def end_write(self, written: int) -> None:
+        """
+        Makes the region returned by begin_write the one drawn from.
+        :param written: The number of bytes written to it, for the statistics.
+        """
+        region = (self.current + 1) % self.frames
+        if not self.persistent:
+            glBindBuffer(self.target, self.buffer)
+            glBufferSubData(self.target, region * self.region_size, self.region_size,
+                            self.regions[region])
+            glBindBuffer(self.target, 0)
+
+        self.current = region
+        dynamic_stats.bytes += written
+
+
+    @property
+    def offset(self) -> int:
+        """The byte offset of the region drawn from."""
+        return self.current * self.region_size
+
+
+    def delete(self) -> None:
+        """Unmaps and deletes the buffer, and deletes the fences."""
+        for fence in self.fences:
+            if fence is not None:
+                glDeleteSync(fence)
+
+        if self.persistent:
+            glBindBuffer(self.target, self.buffer)
+            glUnmapBuffer(self.target)
+            glBindBuffer(self.target, 0)
+        glDeleteBuffers(1, np.array([self.buffer], dtype=np.uint32))
+
+
+class DynamicModel(DrawModelFromMesh):
+    def __init__(self, scene, M, mesh, env_map=None, shadows=None, name=None, visible=True):
+        """
+        Initialises a model whose vertices can be rewritten every frame (see
+        update_vertices). The model must be the only one drawing its mesh.
+        """
+        self.dynamic_buffer = None
+
+        super().__init__(scene=scene, M=M, mesh=mesh, env_map=env_map, shadows=shadows,
+                         name=name, visible=visible, compact=False)
+
+
+    def bind(self):
+        """
+        Binds the mesh's buffers (see Model.bind), for its indices and
+        attribute formats, then creates the ring of vertices and a vao
+        reading it.
+        """
+        super().bind()
+
+        self.dynamic_buffer = DynamicBuffer(self.mesh.vertices.shape[0] * self.buffers.stride)
+        self.dynamic_buffer.fill(VertexFormat.float_layout(self.mesh).build())
+
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.dynamic_buffer.buffer)
+        self.buffers.point_attributes()
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.buffers.index_buffer)
+
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+
+    def attribute_views(self, region: np.ndarray) -> dict:
+        """
+        Returns a (vertex count, size) float32 view of each attribute in a
+        region, through which it can be written in place.
+        """
+        vertices = region.reshape(self.mesh.vertices.shape[0], self.buffers.stride)
+        views = {}
+        for name, location in self.buffers.attributes.items():
+            for format_location, size, _, _, offset in self.buffers.formats:
+                if format_location == location:
+                    views[name] = vertices[:, offset:offset + 4 * size].view(np.float32)
+        return views
+
+
+    def update_vertices(self, vertices: np.ndarray, normals: np.ndarray = None) -> None:
+        """
+        Replaces the mesh's vertex positions, and its normals (which are
+        recalculated from the faces if not given), writing them to the next
+        region of the ring. Other attributes keep their first values.
+        :param vertices: A (vertex count, 3) array.
+        :param normals: [optional] A (vertex count, 3) array.
+        """
+        mesh = self.mesh
+        mesh.vertices = np.asarray(vertices, dtype=np.float32)
+        if normals is None:
+            mesh.calculate_normals()
+        else:
+            mesh.normals = np.asarray(normals, dtype=np.float32)
+
+        # The bounds are recalculated when next used (e.g. for culling)
+        mesh.box = None
+        mesh.bounds = None
+
+        views = self.attribute_views(self.dynamic_buffer.begin_write())
+        np.copyto(views["position"], mesh.vertices)
+        written = mesh.vertices.nbytes
+        if "normal" in views:
+            np.copyto(views["normal"], mesh.normals)
+            written += mesh.normals.nbytes
+
+        self.dynamic_buffer.end_write(written)
+
+
+    def draw_elements(self, level: int):
+        """Draws a level of detail from the current region of the ring."""
+        count, offset = self.buffers.index_ranges[level]
+        base_vertex = self.dynamic_buffer.current * self.mesh.vertices.shape[0]
+        glDrawElementsBaseVertex(self.primitive, count, self.buffers.index_type,
+                                 ctypes.c_void_p(offset), base_vertex)
+
+
+    def __del__(self):
+        """Destructor."""
+        if self.dynamic_buffer is not None:
+            self.dynamic_buffer.delete()
+            glDeleteVertexArrays(1, np.array([self.vao], dtype=np.uint32))
+
+        super().__del__()
@@ -20,6 +20,10 @@ class EnvironmentMappingTexture(CubeMap):
         self.width = width
         self.height = height
 
+        # Reflections are blurred by distortion, so models are drawn with
+        # coarser LODs
+        self.lod_bias = 0.25
+
         # Assign the fbos (frame buffer objects)
         self.fbos = {
             GL_TEXTURE_CUBE_MAP_NEGATIVE_X: Framebuffer(),
@@ -60,6 +64,8 @@ class EnvironmentMappingTexture(CubeMap):
 
         Pscene = scene.P
         Vscene = scene.camera.V
+        bias_scene = scene.lod_bias
+        scene.lod_bias = self.lod_bias
 
         # Create env map projection
         scene.P = glm.frustum(-1.0, +1.0, -1.0, +1.0, 1.0, 20.0)
@@ -71,15 +77,17 @@ class EnvironmentMappingTexture(CubeMap):
             # For every face, temporarily set the camera's view matrix
             # And then draw the scene reflections.
             scene.camera.V = self.views[face]
+            scene.update_frame_uniforms()
             scene.draw_reflections()
             # Revert view matrix
             scene.camera.V = Vscene
             
             fbo.unbind()
 
-        # Revert viewport and projection matrix
+        # Revert viewport, projection matrix and LOD bias
         glViewport(0, 0, scene.window_size[0], scene.window_size[1])
         scene.P = Pscene
+        scene.lod_bias = bias_scene
 
         self.unbind()
 
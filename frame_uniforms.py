@@ -0,0 +1,114 @@
+from OpenGL.GL import *
+
+import glm
+import numpy as np
+
+'''
+A std140 uniform buffer holding the data which is the same for every model
+in a render pass: the camera (P, V and matrices derived from them), the light
+and the shadow map matrix. It is updated once at the start of each pass,
+rather than uploaded to every program for every model.
+
+Every program which uses the data declares the same block, and the program
+cache binds it to FRAME_UNIFORMS_BINDING when the program is linked:
+
+    layout (std140) uniform FrameUniforms {
+        mat4 P;
+        mat4 V;
+        mat4 PV;
+        mat4 V_t;
+        mat4 V_inverse;
+        mat4 light_PV;   // view space => shadow map texture coordinates
+        vec3 light_pos;  // in view space
+        vec3 Ia;
+        vec3 Id;
+        vec3 Is;
+    };
+
+In std140, each mat4 takes 64 bytes and each vec3 is padded to 16 bytes.
+'''
+
+FRAME_UNIFORMS_BLOCK = "FrameUniforms"
+FRAME_UNIFORMS_BINDING = 0
+
+# Size of the block, in floats
+MATRICES = 6
+VECTORS = 4
+FRAME_UNIFORMS_FLOATS = MATRICES * 16 + VECTORS * 4
+
+
+class FrameUniforms:
+    def __init__(self):
+        self.data = np.zeros(FRAME_UNIFORMS_FLOATS, dtype=np.float32)
+
+        self.buffer = glGenBuffers(1)
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+        glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+        glBindBufferBase(GL_UNIFORM_BUFFER, FRAME_UNIFORMS_BINDING, self.buffer)
+
+        # The inputs of the last update, so repeated updates with the same
+        # camera and light can be skipped
+        self.inputs = None
+
+        # Number of updates uploaded and skipped
+        self.uploads = 0
+        self.skips = 0
+
+
+    def update(self, P: glm.mat4, V: glm.mat4, light, shadow_map=None) -> None:
+        """
+        Calculates and uploads the frame data for a pass, drawn with the
+        projection P and view V.
+        :param light: The light source, with position, Ia, Id and Is.
+        :param shadow_map: [optional] The shadow map, with its light P and V
+        (once it has been rendered).
+        """
+        shadow_P = shadow_V = None
+        if shadow_map is not None and shadow_map.V is not None:
+            shadow_P, shadow_V = shadow_map.P, shadow_map.V
+
+        inputs = (glm.mat4(P), glm.mat4(V), glm.vec3(light.position), glm.vec3(light.Ia),
+                  glm.vec3(light.Id), glm.vec3(light.Is),
+                  None if shadow_P is None else glm.mat4(shadow_P),
+                  None if shadow_V is None else glm.mat4(shadow_V))
+        if inputs == self.inputs:
+            self.skips += 1
+            return
+        self.inputs = inputs
+
+        V_inverse = glm.inverse(V)
+
+        # Clip coordinates = P_s V_s V_vi
+        # Range is [-1, 1]
+        # Translate to move it to [0, 2]
+        # Scale it by 1/2 to move it to [0, 1]
+        light_PV = glm.mat4()
+        if shadow_P is not None:
+            light_PV = glm.scale(glm.vec3(0.5,0.5,0.5))\
+                    * glm.translate(glm.vec3(1,1,1))\
+                    * shadow_P * shadow_V * V_inverse
+
+        matrices = (P, V, glm.mul(P, V), glm.transpose(V), V_inverse, light_PV)
+        for i, matrix in enumerate(matrices):
+            # glm matrices are column-major, as std140 expects
+            self.data[16 * i:16 * (i + 1)] = np.array(matrix, dtype=np.float32).T.ravel()
+
+        light_pos = glm.mul(V, glm.vec4(light.position, 1)).xyz
+        for i, vector in enumerate((light_pos, light.Ia, light.Id, light.Is)):
+            start = MATRICES * 16 + 4 * i
+            self.data[start:start + 3] = tuple(vector)
+
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+        glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        self.uploads += 1
+
+
+    @staticmethod
+    def bind_block(program) -> None:
+        """Binds a program's frame uniform block (if it has one) to its binding point."""
+        index = glGetUniformBlockIndex(program, FRAME_UNIFORMS_BLOCK)
+        if index != GL_INVALID_INDEX:
+            glUniformBlockBinding(program, index, FRAME_UNIFORMS_BINDING)
@@ -0,0 +1,109 @@
+import glm
+import numpy as np
+
+from model_registry import model_registry, ModelRegistry
+
+'''
+View frustum culling. Before each pass is drawn, the bounds of every model
+(see Model.bounds) are transformed by its model matrix, and tested against
+the six planes of the pass's frustum, taken from its P * V:
+    - the bounding sphere, with its radius scaled by the largest scale
+      factor of M, and
+    - the bounding box, transformed to a world space box containing it.
+A model is drawn if neither lies wholly outside any plane. Every model of a
+pass is tested at once.
+
+Drawn and culled counts are kept per pass ("main", "shadow" and
+"environment", which sums the six faces of the cube map) for each frame.
+'''
+
+
+class FrustumCuller:
+    def __init__(self):
+        # Pass name => [drawn, culled] in this frame
+        self.counts = {}
+
+        # Counts for the last complete frame
+        self.frame_counts = {}
+
+
+    def cull(self, models: list, PV: glm.mat4, name: str) -> list:
+        """
+        Returns the visible models which are (at least partly) inside the
+        frustum of a pass.
+        :param PV: The projection and view matrices of the pass, multiplied.
+        :param name: The pass, whose counts are updated.
+        """
+        slots = ModelRegistry.slots(models)
+        visible = model_registry.visible[slots]
+        models = [model for model, keep in zip(models, visible) if keep]
+        counts = self.counts.setdefault(name, [0, 0])
+        if len(models) == 0:
+            return models
+
+        inside = FrustumCuller.test(models, FrustumCuller.planes(PV))
+
+        counts[0] += int(np.count_nonzero(inside))
+        counts[1] += len(models) - int(np.count_nonzero(inside))
+        return [model for model, keep in zip(models, inside) if keep]
+
+
+    @staticmethod
+    def planes(PV: glm.mat4) -> np.ndarray:
+        """
+        Returns the (6, 4) normalised planes (a, b, c, d) of a frustum, with
+        normals pointing inwards, from its P * V (Gribb & Hartmann).
+        """
+        rows = np.array(PV, dtype=np.float64)
+        planes = np.array([rows[3] + rows[0], rows[3] - rows[0],   # left, right
+                           rows[3] + rows[1], rows[3] - rows[1],   # bottom, top
+                           rows[3] + rows[2], rows[3] - rows[2]])  # near, far
+        return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+
+    @staticmethod
+    def test(models: list, planes: np.ndarray) -> np.ndarray:
+        """Returns whether each model's bounds are inside the planes."""
+        return FrustumCuller.inside(*FrustumCuller.world_bounds(models), planes)
+
+
+    @staticmethod
+    def world_bounds(models: list) -> tuple:
+        """
+        Returns the world space bounds of models: the (n, 3) centres, (n,)
+        bounding sphere radii and (n, 3) bounding box half-extents.
+        """
+        model_registry.update()
+        Ms = model_registry.world[ModelRegistry.slots(models)].astype(np.float64)
+        bounds = [model.bounds() for model in models]
+        centres = np.array([centre for centre, _, _ in bounds], dtype=np.float64)
+        radii = np.array([radius for _, radius, _ in bounds], dtype=np.float64)
+        extents = np.array([extent for _, _, extent in bounds], dtype=np.float64)
+
+        linear = Ms[:, :3, :3]
+        world_centres = np.einsum("nij,nj->ni", linear, centres) + Ms[:, :3, 3]
+
+        # The sphere's radius grows with the largest column of M, and the
+        # box's half-extents with the absolute values of M (Arvo)
+        world_radii = radii * np.linalg.norm(linear, axis=1).max(axis=1)
+        world_extents = np.einsum("nij,nj->ni", np.abs(linear), extents)
+
+        return world_centres, world_radii, world_extents
+
+
+    @staticmethod
+    def inside(centres: np.ndarray, radii: np.ndarray, extents: np.ndarray,
+               planes: np.ndarray) -> np.ndarray:
+        """Returns whether each of the world space bounds is inside the planes."""
+        # (bounds, planes) signed distances of the centres
+        distances = centres @ planes[:, :3].T + planes[:, 3]
+
+        in_spheres = np.all(distances >= -radii[:, None], axis=1)
+        in_boxes = np.all(distances >= -(extents @ np.abs(planes[:, :3]).T), axis=1)
+        return in_spheres & in_boxes
+
+
+    def end_frame(self) -> None:
+        """Stores the counts of the frame which just finished, and resets them."""
+        self.frame_counts = self.counts
+        self.counts = {}
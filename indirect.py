@@ -0,0 +1,237 @@
+import ctypes
+
+from OpenGL.GL import *
+
+import glm
+import numpy as np
+
+from lod import LOD
+from frustum import FrustumCuller
+from static_batch import StaticBatch
+from model_registry import model_registry, ModelRegistry
+from shaders import PhongShader, ShadowMappingShader
+from log import Logger
+
+'''
+GPU-driven submission of static models. An IndirectBatch merges static
+models with any model matrix and material (but the same shaders and
+texture) into one vertex and one index buffer, like a StaticBatch, and draws
+them all with one glMultiDrawElementsIndirect call.
+
+Each member is one DrawElementsIndirectCommand in a draw indirect buffer:
+
+    count, instanceCount, firstIndex, baseVertex, baseInstance   (5 x uint32)
+
+Before each draw, the commands are rebuilt with numpy: members which are
+hidden or outside the pass's frustum get an instanceCount of 0, and each
+member's level of detail selects its count and firstIndex. firstIndex and
+baseVertex locate the batch's ranges of its buffer pool block, so follow
+them if the pool is defragmented. The buffer is only uploaded when a command
+changes.
+
+The model matrix and material of each member are in a storage buffer (the
+draw data), which the INDIRECT variants of the phong and shadow mapping
+shaders index by gl_DrawIDARB (GL 4.6 or ARB_shader_draw_parameters):
+
+    mat4 M, mat4 M_it, vec4 Ka, vec4 Kd, vec4 Ks, vec4 tex_scale, vec4 (Ns, d)
+
+The batch itself is at the origin, with bounds containing every member, so
+the scene only culls it when every member is outside the frustum.
+
+Environment mapped and transparent materials are left to StaticBatches.
+'''
+
+logger = Logger(False, True, True)
+
+# Storage buffer binding of the draw data
+DRAW_DATA_BINDING = 1
+
+# Floats per member in the draw data: two mat4s and five vec4s (std430)
+DRAW_DATA_FLOATS = 16 + 16 + 5 * 4
+
+# uint32s per DrawElementsIndirectCommand
+COMMAND_SIZE = 5
+
+
+class IndirectBatch(StaticBatch):
+    def __init__(self, scene, models: list):
+        """
+        Merges static models, which must have the same key (see
+        IndirectBatch.key), into one multi-draw.
+        :param models: The models to draw, created with static=True.
+        """
+        super().__init__(scene, models)
+
+        # Members keep their own model matrices (in the draw data), so the
+        # batch itself is at the origin, and its bounds are in world space
+        self.M = glm.mat4()
+
+        # Use the multi-draw variants of the members' shaders
+        first = models[0]
+        self.shaders = {}
+        self.bind_shader(PhongShader.shared(blinn=True, indirect=True))
+        self.bind_shader(PhongShader.shared(blinn=False, indirect=True))
+        if "shadow_mapping" in first.shaders:
+            shadow_map = first.shaders["shadow_mapping"].shadow_map
+            self.bind_shader(ShadowMappingShader.shared(shadow_map, indirect=True))
+        self.set_shader(first.shader.name)
+
+        # World space bounds of each member, which never move
+        self.centres, self.radii, self.extents = FrustumCuller.world_bounds(models)
+
+        # First index (relative to the batch's indices, which may be moved by
+        # defragmenting the buffer pool) and index count of each member in
+        # each level
+        level_starts = np.array([offset // self.buffers.index_size
+                                 for _, offset in self.buffers.local_index_ranges], dtype=np.int64)
+        self.first_indices = level_starts[:, None] + self.member_ranges[:, :, 0]
+        self.index_counts = self.member_ranges[:, :, 1]
+
+        # The commands last uploaded, and the number of them drawing anything
+        self.commands = np.zeros((len(models), COMMAND_SIZE), dtype=np.uint32)
+        self.draw_count = 0
+
+        self.command_buffer = glGenBuffers(1)
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.command_buffer)
+        glBufferData(GL_DRAW_INDIRECT_BUFFER, self.commands.nbytes, self.commands, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, 0)
+
+        self.draw_buffer = glGenBuffers(1)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.draw_buffer)
+        glBufferData(GL_SHADER_STORAGE_BUFFER, IndirectBatch.draw_data(models), GL_STATIC_DRAW)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+
+    @staticmethod
+    def supported() -> bool:
+        """Returns whether the current context can draw IndirectBatches."""
+        major = glGetIntegerv(GL_MAJOR_VERSION)
+        minor = glGetIntegerv(GL_MINOR_VERSION)
+        if (major, minor) < (4, 3):
+            return False
+
+        extensions = {glGetStringi(GL_EXTENSIONS, i).decode()
+                      for i in range(glGetIntegerv(GL_NUM_EXTENSIONS))}
+        return "GL_ARB_shader_draw_parameters" in extensions
+
+
+    @staticmethod
+    def eligible(model) -> bool:
+        """Returns whether a static model can be drawn by an IndirectBatch."""
+        material = model.mesh.material
+        return "environment" not in model.shaders and material.d >= 1.0 \
+            and model.mesh.faces.shape[1] == 3
+
+
+    @staticmethod
+    def key(model) -> tuple:
+        """
+        Returns the properties which models must share to be drawn by the
+        same IndirectBatch: their shaders, texture and vertex attributes.
+        """
+        mesh = model.mesh
+        return (
+            tuple(sorted((name, id(shader)) for name, shader in model.shaders.items())),
+            mesh.material.texture,
+            tuple(getattr(mesh, name) is not None for name in ("vertices", "normals", "colors",
+                                                               "textureCoords")),
+            model.compact
+        )
+
+
+    @staticmethod
+    def draw_data(models: list) -> np.ndarray:
+        """Returns the draw data (see above) of each model, as one float32 array."""
+        # M and M_it are packed as the registry's uniform rows are
+        model_registry.update()
+        data = np.zeros((len(models), DRAW_DATA_FLOATS), dtype=np.float32)
+        data[:, :32] = model_registry.uniforms[ModelRegistry.slots(models)]
+
+        for i, model in enumerate(models):
+            material = model.mesh.material
+            data[i, 32:35] = tuple(material.Ka)
+            data[i, 36:39] = tuple(material.Kd)
+            data[i, 40:43] = tuple(material.Ks)
+            data[i, 44:47] = tuple(material.tex_scale)
+            data[i, 48:50] = (material.Ns, material.d)
+        return data
+
+
+    def bounds(self) -> tuple:
+        """
+        Returns the bounds (see Model.bounds) of the box containing every
+        member's world space bounding box, so the batch is culled and sorted
+        as a whole only when all of its members are.
+        """
+        low = (self.centres - self.extents).min(axis=0)
+        high = (self.centres + self.extents).max(axis=0)
+
+        extents = (high - low) / 2
+        return (low + high) / 2, float(np.linalg.norm(extents)), extents
+
+
+    def update_commands(self) -> None:
+        """
+        Rebuilds the draw commands for the current pass, and uploads them if
+        they have changed.
+        """
+        scene = self.scene
+        visible = model_registry.visible[self.member_slots]
+
+        planes = FrustumCuller.planes(scene.P * scene.camera.V)
+        visible &= FrustumCuller.inside(self.centres, self.radii, self.extents, planes)
+
+        V = np.array(scene.camera.V, dtype=np.float64)
+        depths = -(self.centres @ V[2, :3] + V[2, 3])
+        levels = LOD.select_levels(depths, self.radii, scene.P, scene.lod_bias,
+                                   self.first_indices.shape[0])
+
+        members = np.arange(len(self.members))
+        commands = np.zeros_like(self.commands)
+        commands[:, 0] = self.index_counts[levels, members]
+        commands[:, 1] = visible
+        commands[:, 2] = self.first_indices[levels, members] + self.buffers.index_allocation.offset
+        commands[:, 3] = self.buffers.base_vertex
+
+        self.draw_count = int(np.count_nonzero(visible))
+        if np.array_equal(commands, self.commands):
+            return
+
+        self.commands = commands
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.command_buffer)
+        glBufferSubData(GL_DRAW_INDIRECT_BUFFER, 0, commands.nbytes, commands)
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, 0)
+
+
+    def draw(self):
+        """Draws every visible member inside the frustum of the current pass."""
+        if not self.visible:
+            return
+
+        self.update_commands()
+        if self.draw_count == 0:
+            return
+
+        super().draw()
+
+
+    def select_level(self) -> int:
+        """Levels are chosen for each member by update_commands."""
+        return 0
+
+
+    def draw_elements(self, level: int):
+        """Issues the multi-draw, with the vao and shader already bound."""
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, DRAW_DATA_BINDING, self.draw_buffer)
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.command_buffer)
+
+        glMultiDrawElementsIndirect(self.primitive, self.buffers.index_type, ctypes.c_void_p(0),
+                                    len(self.members), 0)
+
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, 0)
+
+
+    def __del__(self):
+        """Destructor."""
+        glDeleteBuffers(2, np.array([self.command_buffer, self.draw_buffer], dtype=np.uint32))
+        super().__del__()
@@ -0,0 +1,291 @@
+import ctypes
+
+from OpenGL.GL import *
+
+import glm
+import numpy as np
+
+from model import DrawModelFromMesh
+from lod import LOD
+from vertex_format import INSTANCE_LOCATIONS
+from log import Logger
+
+'''
+Hardware instancing: an InstancedModel draws its mesh once per row of an
+array of transforms, with one glDrawElementsInstancedBaseVertex call.
+
+The per-instance data is interleaved in one instance buffer, read by the
+instanced variants of the phong, shadow mapping and environment shaders
+(compiled with INSTANCED defined) at the locations in INSTANCE_LOCATIONS:
+
+    instance_M     mat4 (64B)   the instance's transform, relative to the model
+    instance_M_it  mat4 (64B)   its inverse transpose, for normals
+    instance_tint  vec4 (16B)   multiplies the surface colour
+
+Transforms are given as (n, 4, 4) arrays in the usual mathematical layout
+(so transforms[i] @ [x, y, z, 1] transforms a point), and are drawn relative
+to the model matrix M, so a whole herd can be moved by changing M.
+
+The instances share the mesh's vertex and index buffers (ranges of a block
+of the buffer pool) with every other model of the mesh; only the vao (which
+adds the instance attributes) and the instance buffer belong to the
+InstancedModel.
+'''
+
+logger = Logger(False, True, True)
+
+# Floats per instance: two mat4s and a vec4
+INSTANCE_FLOATS = 16 + 16 + 4
+INSTANCE_STRIDE = INSTANCE_FLOATS * 4
+
+# (name, number of vec4 columns, byte offset) of each instance attribute
+INSTANCE_ATTRIBUTES = [
+    ("instance_M", 4, 0),
+    ("instance_M_it", 4, 64),
+    ("instance_tint", 1, 128)
+]
+
+
+class InstancedModel(DrawModelFromMesh):
+    def __init__(self, scene, M, mesh, transforms, tints=None, env_map=None, shadows=None,
+                 name=None, visible=True, compact=False):
+        """
+        Initialises a model drawing one instance of a mesh per transform.
+        :param transforms: An (n, 4, 4) array of instance transforms.
+        :param tints: [optional] An (n, 4) or (n, 3) array of RGB(A) tints,
+        or one tint for every instance. Instances are untinted by default.
+        """
+        # Per-instance data, as uploaded, and the transforms themselves (used
+        # to choose the level of detail)
+        self.instance_data = np.zeros((0, INSTANCE_FLOATS), dtype=np.float32)
+        self.transforms = np.zeros((0, 4, 4), dtype=np.float32)
+
+        self.instance_buffer = None
+
+        # Bounds of every instance together (see bounds), once calculated
+        self.instance_bounds = None
+
+        # Number of instances the instance buffer has room for
+        self.capacity = 0
+
+        super().__init__(scene=scene, M=M, mesh=mesh, env_map=env_map, shadows=shadows,
+                         name=name, visible=visible, compact=compact, instanced=True)
+
+        self.set_instances(transforms, tints)
+
+
+    @property
+    def instance_count(self) -> int:
+        return self.transforms.shape[0]
+
+
+    def bind(self):
+        """
+        Binds the mesh's buffers (see Model.bind), then creates the model's
+        own vao, adding the attributes of the instance buffer to the mesh's.
+        """
+        super().bind()
+
+        self.vao = self.buffers.create_vao()
+        self.instance_buffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_buffer)
+
+        for name, columns, offset in INSTANCE_ATTRIBUTES:
+            for column in range(columns):
+                location = INSTANCE_LOCATIONS[name] + column
+                glEnableVertexAttribArray(location)
+                glVertexAttribPointer(index=location, size=4, type=GL_FLOAT, normalized=False,
+                    stride=INSTANCE_STRIDE, pointer=ctypes.c_void_p(offset + 16 * column))
+
+                # Advance once per instance, rather than once per vertex
+                glVertexAttribDivisor(location, 1)
+
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+
+    def set_instances(self, transforms: np.ndarray, tints=None) -> None:
+        """
+        Replaces every instance. The instance buffer is reallocated (orphaned),
+        so the upload doesn't wait for draws still reading the old data.
+        :param transforms: An (n, 4, 4) array of instance transforms.
+        :param tints: [optional] The instances' tints (see __init__).
+        """
+        transforms = np.asarray(transforms, dtype=np.float32).reshape(-1, 4, 4)
+        count = transforms.shape[0]
+
+        self.transforms = transforms.copy()
+        self.instance_bounds = None
+        self.instance_data = np.empty((count, INSTANCE_FLOATS), dtype=np.float32)
+        InstancedModel.pack_transforms(transforms, self.instance_data)
+        self.instance_data[:, 32:] = InstancedModel.tint_array(tints, count)
+
+        self.capacity = max(self.capacity, count)
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_buffer)
+        glBufferData(GL_ARRAY_BUFFER, self.capacity * INSTANCE_STRIDE, None, GL_DYNAMIC_DRAW)
+        if count > 0:
+            glBufferSubData(GL_ARRAY_BUFFER, 0, self.instance_data.nbytes, self.instance_data)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+
+    def update_transforms(self, transforms: np.ndarray, first: int = 0) -> None:
+        """
+        Updates the transforms of a run of consecutive instances, uploading
+        only their part of the instance buffer.
+        :param transforms: A (k, 4, 4) array, for instances first to first + k - 1.
+        """
+        transforms = np.asarray(transforms, dtype=np.float32).reshape(-1, 4, 4)
+        last = first + transforms.shape[0]
+
+        self.transforms[first:last] = transforms
+        self.instance_bounds = None
+        InstancedModel.pack_transforms(transforms, self.instance_data[first:last])
+        self.upload(first, last)
+
+
+    def update_tints(self, tints, first: int = 0) -> None:
+        """
+        Updates the tints of a run of consecutive instances.
+        :param tints: A (k, 4) or (k, 3) array, for instances first to first + k - 1.
+        """
+        tints = np.asarray(tints, dtype=np.float32)
+        last = first + tints.reshape(-1, tints.shape[-1]).shape[0]
+
+        self.instance_data[first:last, 32:] = InstancedModel.tint_array(tints, last - first)
+        self.upload(first, last)
+
+
+    def upload(self, first: int, last: int) -> None:
+        """Uploads the data of instances first to last - 1 to the instance buffer."""
+        if last <= first:
+            return
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_buffer)
+        glBufferSubData(GL_ARRAY_BUFFER, first * INSTANCE_STRIDE,
+                        (last - first) * INSTANCE_STRIDE, self.instance_data[first:last])
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+
+    @staticmethod
+    def pack_transforms(transforms: np.ndarray, out: np.ndarray) -> None:
+        """
+        Writes transforms, and their inverse transposes, to the first 32
+        columns of instance data, column-major as the shaders expect.
+        """
+        count = transforms.shape[0]
+        out[:, :16] = transforms.transpose(0, 2, 1).reshape(count, 16)
+
+        # The column-major inverse transpose is the row-major inverse.
+        # np.linalg.inv raises for singular transforms (e.g. instances scaled
+        # to 0 to hide them), so those are inverted one at a time by glm,
+        # which gives inf/NaN instead
+        transforms = np.asarray(transforms, dtype=np.float64)
+        invertible = np.linalg.det(transforms) != 0
+        out[invertible, 16:32] = np.linalg.inv(transforms[invertible]).reshape(-1, 16)
+        for i in np.flatnonzero(~invertible):
+            M_it = glm.inverseTranspose(glm.mat4(*transforms[i].T.ravel()))
+            out[i, 16:32] = np.array(M_it).T.ravel()
+
+
+    @staticmethod
+    def tint_array(tints, count: int) -> np.ndarray:
+        """Returns tints (see __init__) as a (count, 4) RGBA array."""
+        array = np.ones((count, 4), dtype=np.float32)
+        if tints is not None:
+            tints = np.asarray(tints, dtype=np.float32)
+            array[:, :tints.shape[-1]] = tints
+        return array
+
+
+    @staticmethod
+    def compose(positions: np.ndarray, angles=None, scales=None) -> np.ndarray:
+        """
+        Builds instance transforms from positions, rotations about the y axis
+        and uniform scales, for every instance at once.
+        :param positions: An (n, 3) array.
+        :param angles: [optional] An (n,) array of angles in radians.
+        :param scales: [optional] An (n,) array, or one scale for every instance.
+        :return: the (n, 4, 4) transforms.
+        """
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        count = positions.shape[0]
+
+        angles = np.zeros(count) if angles is None else np.asarray(angles)
+        scales = np.ones(count) if scales is None else np.broadcast_to(scales, (count,))
+
+        cos = np.cos(angles) * scales
+        sin = np.sin(angles) * scales
+
+        transforms = np.zeros((count, 4, 4), dtype=np.float32)
+        transforms[:, 0, 0] = cos
+        transforms[:, 0, 2] = sin
+        transforms[:, 1, 1] = scales
+        transforms[:, 2, 0] = -sin
+        transforms[:, 2, 2] = cos
+        transforms[:, :3, 3] = positions
+        transforms[:, 3, 3] = 1.0
+        return transforms
+
+
+    def bounds(self) -> tuple:
+        """
+        Returns the bounds (see Model.bounds) of the box containing every
+        instance's transformed bounding box.
+        """
+        if self.instance_count == 0:
+            return super().bounds()
+
+        if self.instance_bounds is None:
+            low, high = self.mesh.bounding_box()
+            corners = np.array([[x, y, z, 1.0] for x in (low[0], high[0])
+                                for y in (low[1], high[1]) for z in (low[2], high[2])])
+
+            # (instances, corners, 4)
+            transformed = np.einsum("nij,cj->nci", self.transforms, corners)[:, :, :3]
+            low = transformed.min(axis=(0, 1))
+            high = transformed.max(axis=(0, 1))
+
+            extents = (high - low) / 2
+            self.instance_bounds = ((low + high) / 2, float(np.linalg.norm(extents)), extents)
+
+        return self.instance_bounds
+
+
+    def select_level(self) -> int:
+        """
+        Chooses the level of detail of the nearest instance (by the depth of
+        its centre), so no instance is drawn coarser than it should be.
+        """
+        if self.mesh.lod_ranges is None or self.instance_count == 0:
+            return 0
+
+        centre, _ = self.mesh.bounding_sphere()
+        VM = np.array(self.scene.camera.V * self.M, dtype=np.float32)
+
+        # View space depth of each instance's centre
+        centres = self.transforms @ np.array([*centre, 1.0], dtype=np.float32)
+        depths = -(centres @ VM[2])
+
+        nearest = glm.mat4(self.transforms[int(np.argmin(depths))])
+        return LOD.select(self.mesh, self.M * nearest, self.scene.camera.V, self.scene.P,
+                          self.scene.lod_bias)
+
+
+    def draw_elements(self, level: int):
+        """Draws every instance of a level of detail."""
+        if self.instance_count == 0:
+            return
+
+        count, offset = self.buffers.index_ranges[level]
+        glDrawElementsInstancedBaseVertex(self.primitive, count, self.buffers.index_type,
+                                          ctypes.c_void_p(offset), self.instance_count,
+                                          self.buffers.base_vertex)
+
+
+    def __del__(self):
+        """Destructor."""
+        if self.instance_buffer is not None:
+            glDeleteBuffers(1, np.array([self.instance_buffer], dtype=np.uint32))
+            glDeleteVertexArrays(1, np.array([self.vao], dtype=np.uint32))
+
+        super().__del__()
@@ -0,0 +1,230 @@
+import numpy as np
+import glm
+
+from mesh import Mesh
+from log import Logger
+
+'''
+Automatic level of detail (LOD) generation and selection.
+
+Simplified versions of a mesh are made by vertex clustering: the vertices are
+snapped to a grid, every cell of the grid becomes one vertex, and triangles
+which collapse are dropped. Each cell is represented by the vertex in it with
+the lowest quadric error (Garland & Heckbert) with respect to the summed
+quadrics of the cell, so the simplified surface keeps to the planes of the
+original. The grid resolution is binary searched to meet each triangle
+target.
+
+Representatives are existing vertices, so every LOD only needs its own index
+array and shares the vertex buffers of the full resolution mesh. The index
+arrays of all levels are stored together on the mesh:
+    - lod_faces: the faces of every level, one level after the other.
+    - lod_ranges: the [first, count] triangle range of each level in lod_faces.
+Both are stored in the mesh cache with the rest of the mesh.
+'''
+
+logger = Logger(False, True, True)
+
+# Fraction of the triangles of the full mesh kept by each level
+LOD_RATIOS = (0.5, 0.25, 0.1)
+
+# Meshes with fewer triangles than this are always drawn in full
+LOD_MIN_TRIANGLES = 256
+
+# A level is drawn once the mesh's projected diameter falls below the
+# corresponding fraction of the viewport height. Level 0 is the full mesh.
+LOD_SCREEN_SIZES = (0.25, 0.1, 0.04)
+
+# Largest grid resolution tried by the binary search
+MAX_GRID = 4096
+
+
+class LOD:
+    @staticmethod
+    def generate(mesh: Mesh) -> None:
+        """
+        Generates the LODs of a mesh, storing them in mesh.lod_faces and
+        mesh.lod_ranges. Meshes which are small or are not made of triangles
+        are left without LODs.
+        """
+        if mesh.faces is None or mesh.faces.ndim != 2 or mesh.faces.shape[1] != 3 \
+                or mesh.faces.shape[0] < LOD_MIN_TRIANGLES:
+            return
+
+        vertices = np.asarray(mesh.vertices, dtype=np.float64)
+        faces = np.asarray(mesh.faces, dtype=np.int64)
+        quadrics = LOD.vertex_quadrics(vertices, faces)
+
+        levels = []
+        ranges = []
+        first = 0
+        grid = MAX_GRID
+        for ratio in LOD_RATIOS:
+            target = int(faces.shape[0] * ratio)
+            lod, grid = LOD.simplify(vertices, faces, quadrics, target, grid)
+
+            # Reuse the previous level if this one could not be simplified
+            # any further
+            if len(levels) > 0 and lod.shape[0] >= levels[-1].shape[0]:
+                ranges.append(ranges[-1])
+                continue
+
+            levels.append(lod)
+            ranges.append([first, lod.shape[0]])
+            first += lod.shape[0]
+
+        mesh.lod_faces = np.concatenate(levels).astype(np.uint32)
+        mesh.lod_ranges = np.array(ranges, dtype=np.int64)
+
+        logger.info(f"Generated LODs for {mesh.name}: {faces.shape[0]} -> "
+                    f"{[int(count) for _, count in mesh.lod_ranges]} triangles")
+
+
+    @staticmethod
+    def vertex_quadrics(vertices: np.ndarray, faces: np.ndarray) -> np.ndarray:
+        """
+        Returns the error quadric of each vertex: the sum of the area weighted
+        quadrics of the planes of the faces around it, as a (n, 4, 4) array.
+        """
+        corners = vertices[faces]
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+
+        # The length of the cross product is twice the area
+        area = np.linalg.norm(normals, axis=1)
+        unit = np.divide(normals, area[:, None], out=np.zeros_like(normals),
+                         where=area[:, None] > 0)
+
+        planes = np.concatenate([unit, -np.sum(unit * corners[:, 0], axis=1, keepdims=True)], axis=1)
+        face_quadrics = (0.5 * area)[:, None, None] * planes[:, :, None] * planes[:, None, :]
+
+        quadrics = np.zeros((vertices.shape[0], 16))
+        indices = faces.ravel()
+        face_quadrics = np.repeat(face_quadrics.reshape(-1, 16), 3, axis=0)
+        for i in range(16):
+            quadrics[:, i] = np.bincount(indices, weights=face_quadrics[:, i],
+                                         minlength=vertices.shape[0])
+        return quadrics.reshape(-1, 4, 4)
+
+
+    @staticmethod
+    def cluster(vertices: np.ndarray, faces: np.ndarray, grid: int) -> np.ndarray:
+        """
+        Snaps the vertices to a grid with grid cells along the longest side
+        of the mesh's bounding box.
+        :return: the faces, with each vertex replaced by the index of its cell
+        (degenerate and duplicate triangles removed), and the cell of each vertex.
+        """
+        low = vertices.min(axis=0)
+        size = max(float(np.max(vertices.max(axis=0) - low)), 1e-12)
+
+        cells = np.floor((vertices - low) * (grid / size)).astype(np.int64)
+        cells = np.minimum(cells, grid - 1)
+
+        _, cell_ids = np.unique(cells, axis=0, return_inverse=True)
+        cell_ids = cell_ids.reshape(-1)
+
+        clustered = cell_ids[faces]
+        keep = (clustered[:, 0] != clustered[:, 1]) & (clustered[:, 1] != clustered[:, 2]) \
+            & (clustered[:, 2] != clustered[:, 0])
+        clustered = clustered[keep]
+
+        # Triangles which collapse onto the same three cells are kept once
+        _, first = np.unique(np.sort(clustered, axis=1), axis=0, return_index=True)
+        return clustered[np.sort(first)], cell_ids
+
+
+    @staticmethod
+    def simplify(vertices: np.ndarray, faces: np.ndarray, quadrics: np.ndarray,
+                 target: int, max_grid: int = MAX_GRID) -> tuple:
+        """
+        Simplifies a mesh to at most target triangles.
+        :param max_grid: The finest grid to try, e.g. the grid found for the
+        previous (larger) target.
+        :return: the simplified faces, indexing into the original vertices,
+        and the grid resolution used.
+        """
+        # Find the finest grid with few enough triangles
+        low, high = 1, max_grid
+        while low < high:
+            grid = (low + high + 1) // 2
+            if LOD.cluster(vertices, faces, grid)[0].shape[0] <= target:
+                low = grid
+            else:
+                high = grid - 1
+
+        grid = low
+        clustered, cell_ids = LOD.cluster(vertices, faces, grid)
+        if clustered.shape[0] == 0:
+            return np.zeros((0, 3), dtype=np.int64), grid
+
+        # Sum the quadrics of each cell, and choose the vertex of the cell
+        # with the least error
+        cell_count = int(cell_ids.max()) + 1
+        cell_quadrics = np.zeros((cell_count, 16))
+        flat = quadrics.reshape(-1, 16)
+        for i in range(16):
+            cell_quadrics[:, i] = np.bincount(cell_ids, weights=flat[:, i], minlength=cell_count)
+        cell_quadrics = cell_quadrics.reshape(-1, 4, 4)
+
+        homogeneous = np.concatenate([vertices, np.ones((vertices.shape[0], 1))], axis=1)
+        error = np.einsum("ni,nij,nj->n", homogeneous, cell_quadrics[cell_ids], homogeneous)
+
+        order = np.lexsort((error, cell_ids))
+        first = np.ones(order.shape[0], dtype=bool)
+        first[1:] = cell_ids[order[1:]] != cell_ids[order[:-1]]
+
+        representatives = np.zeros(cell_count, dtype=np.int64)
+        representatives[cell_ids[order[first]]] = order[first]
+
+        return representatives[clustered], grid
+
+
+    @staticmethod
+    def select(mesh: Mesh, M: glm.mat4, V: glm.mat4, P: glm.mat4, bias: float = 1.0) -> int:
+        """
+        Chooses the level of a mesh to draw from its projected size.
+        :param bias: Multiplies the projected size, so a smaller bias selects
+        coarser levels (e.g. for the shadow and environment passes).
+        :return: 0 for the full mesh, or 1 + the index of an LOD.
+        """
+        if mesh.lod_ranges is None:
+            return 0
+
+        centre, radius = mesh.bounding_sphere()
+
+        # Scale the radius by the largest scale factor of the model matrix
+        scale = max(glm.length(glm.vec3(M[0])), glm.length(glm.vec3(M[1])),
+                    glm.length(glm.vec3(M[2])))
+        distance = -(V * M * glm.vec4(centre, 1.0)).z
+
+        if distance <= radius * scale:
+            return 0
+
+        # Fraction of the viewport height covered by the diameter
+        size = bias * radius * scale * P[1][1] / distance
+
+        level = 0
+        for screen_size in LOD_SCREEN_SIZES:
+            if size >= screen_size:
+                break
+            level += 1
+        return level
+
+
+    @staticmethod
+    def select_levels(depths: np.ndarray, radii: np.ndarray, P: glm.mat4, bias: float = 1.0,
+                      level_count: int = len(LOD_SCREEN_SIZES) + 1) -> np.ndarray:
+        """
+        Chooses levels for many meshes at once, in the same way as select.
+        :param depths: The view space depth of each mesh's bounding sphere centre.
+        :param radii: The radius of each bounding sphere, in world space.
+        :param level_count: The number of levels the meshes have (including
+        the full mesh); levels are clamped to the last one.
+        :return: the level of each mesh.
+        """
+        size = bias * radii * P[1][1] / np.maximum(depths, 1e-12)
+
+        # Screen sizes get smaller, so the level is the number the mesh is below
+        levels = np.sum(size[:, None] < np.array(LOD_SCREEN_SIZES), axis=1)
+        levels[depths <= radii] = 0
+        return np.minimum(levels, level_count - 1)
@@ -2,16 +2,22 @@ import math
 import pygame
 import glm
 import time
+import numpy as np
 from OpenGL.GL import *
 
 from scene import Scene
 from model import DrawModelFromMesh
+from indirect import IndirectBatch
 from texture import Texture
 from material import Material
-from shaders import Shader
+from shaders import Shader, program_cache, uniform_stats
 from light_source import LightSource
 from skybox import SkyBox
 from matrix import Matrix
+from asset_registry import asset_registry
+from buffer_pool import buffer_pool
+from mesh import GridMesh
+from dynamic import DynamicModel, dynamic_stats
 
 
 class Program(Scene):
@@ -24,19 +30,41 @@ class Program(Scene):
         # Setup every model in the scene
         self.skybox = SkyBox(folder="skybox", file_format="jpg", scene=self)
 
+        # Parse every model file in parallel before creating the models
+        self.preload_obj_files(["models/scene_nofloor.obj", "models/floor.obj",
+                                "models/trex_plane.obj"])
+
         # Contains all non-moving models except for the floor, for conciseness.
-        self.add_models_from_obj("models/scene_nofloor.obj", name="scene", shadows=True)
+        self.add_models_from_obj("models/scene_nofloor.obj", name="scene", shadows=True,
+                                 static=True)
         # All floor objects, separated for environment mapping purposes.
-        self.add_models_from_obj("models/floor.obj", name="floor", shadows=True, in_environment=True)
+        floor = self.add_models_from_obj("models/floor.obj", name="floor", shadows=True,
+                                         in_environment=True, static=True)
+        # The lake (if any) is replaced by rippling water (see add_water), so isn't batched
+        self.water = None
+        lake = next((model for model in floor if model.mesh.material.name == "Water"), None)
+        if lake is not None:
+            self.add_water(lake)
+        # Draw the non-moving models with a few calls per material, or per
+        # texture with multi-draws if the driver supports them
+        static_batches = self.batch_static_models(indirect=IndirectBatch.supported())
 
         # The only moving model.
         self.trex_plane_pos = glm.vec3(0,15,0)
         self.trex_plane = self.add_models_from_obj("models/trex_plane.obj", pos=self.trex_plane_pos,
                                  rotation=glm.vec3(-math.pi/16, 0, math.pi/16),
                                  name="TrexOnPlane", in_environment=True)
+        self.trex_plane_node = self.trex_plane[0].transform.parent
         
         # Finish logging
         time_end = time.time()
+        self.asset_loader.print_report()
+        asset_registry.print_report()
+        program_cache.print_report()
+        buffer_pool.print_report()
+        multi_draws = sum(isinstance(batch, IndirectBatch) for batch in static_batches)
+        print(f"\nStatic batching: {sum(len(batch.members) for batch in static_batches)} models "
+              f"drawn as {len(static_batches)} batches ({multi_draws} multi-draws)")
         print(f"\n\nScene loaded after {time_end - time_start}s\n\n")
         
     
@@ -61,15 +89,18 @@ class Program(Scene):
             clock.tick()
             fps = clock.get_fps()
 
-            for model in self.trex_plane:
-                # Plane follows an orbital motion
-                omega = 0.05
+            # Plane follows an orbital motion. Its meshes are children of
+            # one node, so they all move with one update.
+            omega = 0.05
+
+            if fps == 0:
+                fps = 60
+            T = glm.translate(glm.vec3(0,0,1.75) / (fps / 15))
+            R = glm.rotate(omega / (fps / 15), glm.vec3(0,1,0))
+            self.trex_plane_node.apply(R * T * R)
 
-                if fps == 0:
-                    fps = 60
-                T = glm.translate(glm.vec3(0,0,1.75) / (fps / 15))
-                R = glm.rotate(omega / (fps / 15), glm.vec3(0,1,0))
-                model.M *= R * T * R
+            if self.water is not None:
+                self.ripple_water(pygame.time.get_ticks() / 1000)
             
             # Carries out next scene frame
             super().next_frame()
@@ -88,9 +119,42 @@ class Program(Scene):
                       Update Environment: {self.settings.updates["environment"]}
                       Camera Position: {V_decomp[0]}
                       Camera Pan Velocity: {self.pan_velocity}
+                      Uniform Uploads (last frame): {uniform_stats.frame_uploads} issued, {uniform_stats.frame_skips} skipped
+                      State Changes (last frame): {self.render_queue.frame_unsorted_changes} unsorted, {self.render_queue.frame_sorted_changes} sorted
+                      Culling (last frame, drawn/culled): {self.frustum_culler.frame_counts}
+                      Dynamic Uploads (last frame): {dynamic_stats.frame_bytes / 1024:.1f} KiB, {dynamic_stats.frame_waits} waits
                       """)
 
 
+    def add_water(self, lake) -> None:
+        """
+        Replaces the flat lake with a grid covering the same area, whose
+        vertices are deformed on the CPU every frame (see ripple_water).
+        """
+        low, high = lake.mesh.bounding_box()
+        centre = (low + high) / 2
+        half_size = (high - low) / 2
+
+        # The grid covers [-1, 1] in x and z, so is scaled to the lake's half size
+        M = lake.M * glm.translate(glm.vec3(*centre)) \
+            * glm.scale(glm.vec3(half_size[0], 1, half_size[2]))
+        self.water = DynamicModel(scene=self, mesh=GridMesh(48, 48, material=lake.mesh.material),
+                                  M=M, shadows=self.shadows, name="Water")
+        self.water_grid = self.water.mesh.vertices.copy()
+
+        self.remove_model(lake)
+        self.add_model(self.water)
+        self.in_environment.append(self.water)
+
+
+    def ripple_water(self, seconds: float) -> None:
+        """Moves the water's vertices up and down in two travelling waves."""
+        x, z = self.water_grid[:, 0], self.water_grid[:, 2]
+        vertices = self.water_grid.copy()
+        vertices[:, 1] = 0.15 * (np.sin(14 * x + 2 * seconds) + np.sin(9 * z + 1.3 * seconds))
+        self.water.update_vertices(vertices)
+
+
 # Entry point
 def main():    
     prog = Program()
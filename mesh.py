@@ -1,7 +1,9 @@
+import functools
+
 from material import Material
 import numpy as np
 
-from texture import Texture
+from asset_registry import asset_registry
 import glm
 
 from log import Logger
@@ -32,6 +34,32 @@ class Mesh:
         self.textures = []
         self.tangents = None
         self.binormals = None
+        
+        # Whether the material's texture has been added to self.textures,
+        # and the texture (shared through the asset registry) if it has one
+        self.material_texture_loaded = False
+        self.material_texture = None
+        
+        # Where the normals came from: "calculated" from the faces, "file"
+        # for normals read from an .obj file, or "provided" otherwise.
+        self.normals_source = None
+        
+        # GPU buffers, shared by every model drawing this mesh (see
+        # model.MeshBuffers)
+        self.buffers = None
+        
+        # Simplified index arrays, if generated (see lod.py), and the
+        # bounding sphere used to choose between them
+        self.lod_faces = None
+        self.lod_ranges = None
+        self.bounds = None
+        
+        # Axis-aligned bounding box, as (low, high) corners, used for culling
+        self.box = None
+        
+        # (before, after) average cache miss ratio, if the mesh has been
+        # optimised (see mesh_optimiser.py)
+        self.acmr = None
 
         if vertices is not None:
             logger.info('Creating mesh')
@@ -44,211 +72,321 @@ class Mesh:
                 logger.warning('The current code only calculates normals using the face vector of indices, which was not provided here.')
             else:
                 self.calculate_normals()
+                self.normals_source = "calculated"
         else:
             self.normals = normals
-
-        if material.texture is not None:
-            self.textures.append(Texture(material.texture))
+            self.normals_source = "provided"
+    
+    
+    def load_textures(self):
+        """
+        Loads the material's texture, if it has one. This needs an OpenGL
+        context, so it is done when the mesh is bound to a model rather than
+        when it is created (meshes may be created by worker processes).
+        """
+        if self.material_texture_loaded:
+            return
+        
+        self.material_texture_loaded = True
+        if self.material.texture is not None:
+            self.material_texture = asset_registry.acquire_texture(self.material.texture)
+            self.textures.append(self.material_texture)
+    
+    
+    def __del__(self):
+        """Destructor."""
+        if self.material_texture is not None:
+            asset_registry.release_texture(self.material_texture)
+    
+    
+    def bounding_sphere(self):
+        """
+        Returns the centre (of the bounding box) and radius of a sphere
+        containing every vertex. This is calculated on first use.
+        """
+        if self.bounds is None:
+            low, high = self.bounding_box()
+            centre = (low + high) / 2
+            radius = float(np.max(np.linalg.norm(self.vertices - centre, axis=1)))
+            self.bounds = (glm.vec3(*(float(x) for x in centre)), radius)
+        return self.bounds
+    
+    
+    def bounding_box(self):
+        """
+        Returns the (low, high) corners of the axis-aligned box containing
+        every vertex. This is calculated on first use.
+        """
+        if self.box is None:
+            vertices = np.asarray(self.vertices, dtype=np.float64)
+            self.box = (vertices.min(axis=0), vertices.max(axis=0))
+        return self.box
     
     
     def safe_normalise(self, arr):
         """
-        Normalises a vector/matrix, unless its norm is 0.
-        If its norm is 0, returns the original vector/matrix.
+        Normalises each row of a matrix, except rows with a norm of 0, which
+        are left as they are.
         """
         norm = np.linalg.norm(arr, axis=1, keepdims=True)
-        if len(norm) == 1:
-            if norm == 0:
-                return arr
-        else:
-            for n in norm:
-                if n == 0:
-                    return arr
+        return np.divide(arr, norm, out=np.array(arr, dtype='f'), where=norm > 0)
+    
+    
+    def scatter_add(self, values):
+        """
+        Sums per-face values onto the vertices of each face.
+        :param values: A (num_faces, 3) array with one vector per face.
+        :return: A (num_vertices, 3) array, where each row is the sum of the
+        values of every face that uses that vertex.
+        """
+        indices = self.faces.ravel()
+        values = np.repeat(values, self.faces.shape[1], axis=0)
         
-        return arr / norm
+        result = np.zeros((self.vertices.shape[0], 3), dtype='f')
+        for axis in range(3):
+            result[:, axis] = np.bincount(indices, weights=values[:, axis],
+                                          minlength=self.vertices.shape[0])
+        return result
 
 
     def calculate_normals(self):
         '''
         method to calculate normals from the mesh faces.
-        TODO WS3: Fix this code to calculate the correct normals
         Use the approach discussed in class:
         1. calculate normal for each face using cross product
         2. set each vertex normal as the average of the normals over all faces it belongs to.
+        All faces are processed at once with numpy. When the mesh has texture
+        coordinates, tangents and binormals are calculated in the same way.
         '''
+        corners = self.vertices[self.faces]
+        
+        # first calculate the face normals using the cross product of the triangles' sides
+        a = corners[:, 1] - corners[:, 0]
+        b = corners[:, 2] - corners[:, 0]
+        
+        # blend normals on all 3 vertices (faces with a larger area have
+        # more weight, as the cross product is not normalised)
+        self.normals = self.safe_normalise(self.scatter_add(np.cross(a, b)))
+        
+        if self.textureCoords is None:
+            return
+        
+        # tangent and binormal: solve a = txa.u * T + txa.v * B and
+        # b = txb.u * T + txb.v * B for each face
+        uv = self.textureCoords[self.faces]
+        txa = uv[:, 1] - uv[:, 0]
+        txb = uv[:, 2] - uv[:, 0]
+        
+        det = txa[:, 0] * txb[:, 1] - txb[:, 0] * txa[:, 1]
+        
+        # Faces with degenerate texture coordinates have no tangent
+        inv_det = np.divide(1.0, det, out=np.zeros_like(det), where=det != 0)[:, None]
+        face_tangents = (txb[:, 1:2] * a - txa[:, 1:2] * b) * inv_det
+        face_binormals = (txa[:, 0:1] * b - txb[:, 0:1] * a) * inv_det
+        
+        tangents = self.scatter_add(face_tangents)
+        binormals = self.scatter_add(face_binormals)
+        
+        # Make the tangents perpendicular to the normals (Gram-Schmidt)
+        tangents -= self.normals * np.sum(self.normals * tangents, axis=1, keepdims=True)
+        self.tangents = self.safe_normalise(tangents)
+        
+        # The binormals are perpendicular to both, on the side of the
+        # averaged binormals (which is flipped where the texture is mirrored)
+        binormals_nt = np.cross(self.normals, self.tangents)
+        handedness = np.where(np.sum(binormals_nt * binormals, axis=1, keepdims=True) < 0, -1.0, 1.0)
+        self.binormals = self.safe_normalise(handedness * binormals_nt)
 
-        self.normals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-        if self.textureCoords is not None:
-            self.tangents = np.zeros((self.vertices.shape[0], 3), dtype='f')
-            self.binormals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-
-        #TODO WS3
-        for f in range(self.faces.shape[0]):
-            # first calculate the face normal using the cross product of the triangle's sides
-            a = self.vertices[self.faces[f, 1]] - self.vertices[self.faces[f, 0]]
-            b = self.vertices[self.faces[f, 2]] - self.vertices[self.faces[f, 0]]
-            face_normal = np.cross(a, b)
-
-            # tangent
-            if self.textureCoords is not None:
-                txa = self.textureCoords[self.faces[f, 1], :] - self.textureCoords[self.faces[f, 0], :]
-                txb = self.textureCoords[self.faces[f, 2], :] - self.textureCoords[self.faces[f, 2], :]
-                
-                face_tangent = txb[0]*a - txa[0]*b
-                face_binormal = -txb[1]*a + txa[1]*b
-
-            # blend normal on all 3 vertices
-            for j in range(3):
-                self.normals[self.faces[f, j], :] += face_normal
-                if self.textureCoords is not None:
-                    self.tangents[self.faces[f, j], :] += face_tangent
-                    self.binormals[self.faces[f, j], :] += face_binormal
-
-        # Normalise the arrays (if they have a length)
-        self.safe_normalise(self.normals)
-            
-        if self.textureCoords is not None:
-            self.safe_normalise(self.tangents)
-            self.safe_normalise(self.binormals)
 
+@functools.lru_cache(maxsize=None)
+def cube_geometry(inside=False):
+    '''
+    Creates the vertices, faces and normals of a cube, once for each value of
+    inside. The arrays are read-only, as they are shared by every CubeMesh.
+    :param inside: If True, the faces point into the cube (e.g. for a skybox)
+    '''
+    vertices = np.array([
 
-class CubeMesh(Mesh):
-    def __init__(self, texture=None, inside=False):
+        [-1.0, -1.0, -1.0],  # 0
+        [+1.0, -1.0, -1.0],  # 1
 
-        vertices = np.array([
+        [-1.0, +1.0, -1.0],  # 2
+        [+1.0, +1.0, -1.0],  # 3
 
-            [-1.0, -1.0, -1.0],  # 0
-            [+1.0, -1.0, -1.0],  # 1
+        [-1.0, -1.0, +1.0],  # 4
+        [-1.0, +1.0, +1.0],  # 5
 
-            [-1.0, +1.0, -1.0],  # 2
-            [+1.0, +1.0, -1.0],  # 3
+        [+1.0, -1.0, +1.0],  # 6
+        [+1.0, +1.0, +1.0]  # 7
 
-            [-1.0, -1.0, +1.0],  # 4
-            [-1.0, +1.0, +1.0],  # 5
+    ], dtype='f')
 
-            [+1.0, -1.0, +1.0],  # 6
-            [+1.0, +1.0, +1.0]  # 7
+    faces = np.array([
 
-        ], dtype='f')
+        # back
+        [1, 0, 2],
+        [1, 2, 3],
 
-        faces = np.array([
+        # right
+        [2, 0, 4],
+        [2, 4, 5],
 
-            # back
-            [1, 0, 2],
-            [1, 2, 3],
+        # left
+        [1, 3, 7],
+        [1, 7, 6],
 
-            # right
-            [2, 0, 4],
-            [2, 4, 5],
+        # front
+        [5, 4, 6],
+        [5, 6, 7],
 
-            # left
-            [1, 3, 7],
-            [1, 7, 6],
+        # bottom
+        [0, 1, 4],
+        [4, 1, 6],
 
-            # front
-            [5, 4, 6],
-            [5, 6, 7],
+        # top
+        [2, 5, 3],
+        [5, 7, 3],
 
-            # bottom
-            [0, 1, 4],
-            [4, 1, 6],
+    ], dtype=np.uint32)
 
-            # top
-            [2, 5, 3],
-            [5, 7, 3],
+    if inside:
+        faces = np.ascontiguousarray(faces[:, np.argsort([0, 2, 1])])
 
-        ], dtype=np.uint32)
+    normals = Mesh(vertices=vertices, faces=faces).normals
+    
+    for array in (vertices, faces, normals):
+        array.setflags(write=False)
+    return vertices, faces, normals
 
-        if inside:
-            faces = faces[:, np.argsort([0, 2, 1])]
 
-        textureCoords = None # np.array([], dtype='f')
+@functools.lru_cache(maxsize=None)
+def sphere_geometry(nvert=10, nhoriz=20):
+    '''
+    Creates the vertices, faces, texture coordinates and normals of a sphere,
+    once for each (nvert, nhoriz). The arrays are read-only, as they are
+    shared by every SphereMesh.
+    :param nvert: The number of rings from pole to pole (plus one)
+    :param nhoriz: The number of vertices in each ring
+    '''
+    n = (nvert-1)*nhoriz+2
+    vertices = np.zeros((n, 3), 'f')
+
+    vslice = np.pi/nvert
+    hslice = 2.*np.pi/nhoriz
+    vertices[0,:] = [0., 1., 0.]
+    vertices[-1, :] = [0., -1., 0.]
+
+    # texture coordinates
+    textureCoords = np.zeros((n, 2), 'f')
+
+    # start by creating vertices: vertex 1+i*nhoriz+j is the j-th vertex of
+    # the i-th ring
+    i, j = np.meshgrid(np.arange(nvert-1), np.arange(nhoriz), indexing='ij')
+    y = np.cos((i+1) * vslice)
+    r = np.sin((i+1) * vslice)
+    vertices[1:-1, 0] = (r * np.cos(j*hslice)).ravel()
+    vertices[1:-1, 1] = y.ravel()
+    vertices[1:-1, 2] = (r * np.sin(j*hslice)).ravel()
+    textureCoords[1:-1, 0] = (j / nhoriz).ravel()
+    textureCoords[1:-1, 1] = (i / nvert).ravel()
+
+    # Vertex i of each ring, and the next vertex (wrapping around)
+    i = np.arange(nhoriz)
+    i_next = (i + 1) % nhoriz
+
+    # top and bottom fans
+    lastrow = n - nhoriz - 1
+    top = np.stack([np.zeros(nhoriz, dtype=np.int64), 1 + i_next, 1 + i], axis=1)
+    bottom = np.stack([lastrow + i_next, np.full(nhoriz, n - 1), lastrow + i], axis=1)
+    
+    # Top and bottom triangles alternate, with the triangles that wrap
+    # around last
+    caps = np.stack([top, bottom], axis=1)
+    caps = np.concatenate([caps[:-1].reshape(-1, 3), caps[-1]])
+
+    # two triangles between each pair of neighbouring rings
+    lastrow = nhoriz * np.arange(nvert-2)[:, None] + 1
+    row = lastrow + nhoriz
+    rings = np.stack([
+        np.stack([row + i, lastrow + i, row + i_next], axis=-1),
+        np.stack([row + i_next, lastrow + i, lastrow + i_next], axis=-1)
+    ], axis=2)
+
+    indices = np.concatenate([caps, rings.reshape(-1, 3)]).astype(np.uint32)
+
+    normals = Mesh(vertices=vertices, faces=indices, textureCoords=textureCoords).normals
+    
+    for array in (vertices, indices, textureCoords, normals):
+        array.setflags(write=False)
+    return vertices, indices, textureCoords, normals
 
-        super().__init__(vertices=vertices, faces=faces, textureCoords=textureCoords)
+
+class CubeMesh(Mesh):
+    def __init__(self, texture=None, inside=False):
+        vertices, faces, normals = cube_geometry(inside)
+
+        super().__init__(vertices=vertices, faces=faces, normals=normals)
+        self.normals_source = "calculated"
 
         if texture is not None:
             self.textures = [
                 texture
             ]
+    
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def shared(inside=False):
+        """
+        Returns one untextured CubeMesh for each value of inside, so that
+        every model drawing it also shares its GPU buffers.
+        """
+        return CubeMesh(inside=inside)
 
 
 class SphereMesh(Mesh):
     def __init__(self, nvert=10, nhoriz=20, material=Material(Ka=[0.5,0.5,0.5], Kd=[0.6,0.6,0.9], Ks=[1.,1.,0.9], Ns=15.0)):
-        n = (nvert-1)*nhoriz+2
-        vertices = np.zeros((n, 3), 'f')
-        vertex_colors = np.zeros((n, 3), 'f')
-
-        vslice = np.pi/nvert
-        hslice = 2.*np.pi/nhoriz
-        vertices[0,:] = [0., 1., 0.]
-        vertices[-1, :] = [0., -1., 0.]
-
-        # texture coordinates
-        textureCoords = np.zeros((n, 2), 'f')
-
-        # start by creating vertices
-        for i in range(nvert-1):
-            y = np.cos((i+1) * vslice)
-            r = np.sin((i+1) * vslice)
-            for j in range(nhoriz):
-                v = 1+i*nhoriz+j
-                vertices[v, 0] = r * np.cos(j*hslice)
-                vertices[v, 1] = y
-                vertices[v, 2] = r * np.sin(j*hslice)
-                vertex_colors[v, 0] = float(i) / float(nvert)
-                vertex_colors[v, 1] = float(j) / float(nhoriz)
-                textureCoords[v, 1] = float(i) / float(nvert)
-                textureCoords[v, 0] = float(j) / float(nhoriz)
-
-        nfaces = nhoriz*2 + (nvert-2)*(nhoriz)*2
-        indices = np.zeros((nfaces, 3), dtype=np.uint32)
-        k = 0
-
-        for i in range(nhoriz-1):
-
-            # top
-            indices[k, 0] = 0
-            indices[k, 2] = i + 1
-            indices[k, 1] = i + 2
-            k+=1
-
-            # bottom
-            lastrow = n - nhoriz - 2
-            indices[k, 0] = lastrow + i + 2
-            indices[k, 2] = lastrow + i + 1
-            indices[k, 1] = n-1
-            k+=1
-
-        # last triangle at the top
-        indices[k, :] = [0, 1, nhoriz]
-
-        # last triangle at the bottom
-        indices[k + 1, :] = [lastrow + 1, n - 1, n-2]
-        k+=2
-
-        for j in range(1, nvert-1):
-            for i in range(nhoriz-1):
-                lastrow = nhoriz*(j-1)+1
-                row = nhoriz*j+1
-                indices[k, 0] = row + i
-                indices[k, 2] = row + i + 1
-                indices[k, 1] = lastrow + i
-                k += 1
-
-                indices[k, 0] = row + i + 1
-                indices[k, 2] = lastrow + i + 1
-                indices[k, 1] = lastrow + i
-                k += 1
-
-            # last two triangles on this row
-            indices[k, :] = [row + nhoriz - 1, lastrow + nhoriz - 1, row]
-            k += 1
-            indices[k, :] = [row, lastrow + nhoriz - 1, lastrow]
-            k += 1
+        vertices, indices, textureCoords, normals = sphere_geometry(nvert, nhoriz)
 
         Mesh.__init__(self,
                       vertices=vertices,
                       faces=indices,
+                      normals=normals,
                       textureCoords=textureCoords,
                       material=material
                       )
+        self.normals_source = "calculated"
+    
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def shared(nvert=10, nhoriz=20):
+        """
+        Returns one SphereMesh (with the default material) for each
+        (nvert, nhoriz), so that every model drawing it also shares its GPU
+        buffers.
+        """
+        return SphereMesh(nvert, nhoriz)
+
+
+class GridMesh(Mesh):
+    def __init__(self, columns=32, rows=32, material=Material()):
+        """
+        A flat, upward facing grid of columns x rows squares (two triangles
+        each) covering [-1, 1] in x and z, at y = 0. Useful as a surface to
+        deform, e.g. with a DynamicModel (see dynamic.py).
+        """
+        x, z = np.meshgrid(np.linspace(-1, 1, columns + 1), np.linspace(-1, 1, rows + 1))
+        vertices = np.stack([x.ravel(), np.zeros(x.size), z.ravel()], axis=1).astype(np.float32)
+        textureCoords = np.stack([(x.ravel() + 1) / 2, (z.ravel() + 1) / 2], axis=1).astype(np.float32)
+
+        # Corners of each square; z increases with each row
+        corner = (np.arange(rows)[:, None] * (columns + 1) + np.arange(columns)).ravel()
+        below = corner + columns + 1
+        faces = np.concatenate([
+            np.stack([corner, below, corner + 1], axis=1),
+            np.stack([corner + 1, below, below + 1], axis=1)
+        ]).astype(np.uint32)
+
+        super().__init__(vertices=vertices, faces=faces, textureCoords=textureCoords,
+                         material=material)
@@ -0,0 +1,308 @@
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+import glm
+
+from blender import Obj
+from material import Material
+from mesh import Mesh
+from lod import LOD
+from mesh_optimiser import MeshOptimiser
+from log import Logger
+
+'''
+A persistent, content-addressed cache of the meshes created from .obj files.
+
+Each cache file holds every mesh of one .obj file, and is named after a hash
+of the .obj and .mtl file contents plus the cache format version, so editing
+either file (or changing the format) simply results in a cache miss.
+
+File layout:
+    - 4 byte magic (b"MESH"), then the format version and header length
+      (both little-endian uint32).
+    - A JSON header describing each mesh: its material record, and the
+      dtype, shape and offset of each of its arrays.
+    - The array data, starting at the first ALIGNMENT byte boundary after
+      the header. Each array is aligned to ALIGNMENT bytes, and its offset
+      in the header is relative to the start of the array data.
+
+The arrays are returned as read-only views into a memory map of the file, so
+a cache hit does not copy (or even read) any vertex data until it is used.
+'''
+
+logger = Logger(False, True, True)
+
+# Increment whenever the contents or layout of the cache files change.
+FORMAT_VERSION = 7
+
+MAGIC = b"MESH"
+ALIGNMENT = 16
+
+# Mesh attributes stored in the cache (when they are not None)
+MESH_ARRAYS = ["vertices", "faces", "normals", "colors", "textureCoords",
+               "tangents", "binormals", "lod_faces", "lod_ranges"]
+
+_MTLLIB_LINE = re.compile(rb'^[ \t]*mtllib[ \t]+(\S+)', re.M)
+
+
+class MeshCache:
+    """A folder of cached meshes, keyed by the contents of their source files."""
+    def __init__(self, folder="cache"):
+        self.folder = folder
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def key(self, obj_file: str) -> str:
+        """
+        Returns the cache key of an .obj file, which depends on the contents
+        of the file, every material library it uses and the format version.
+        """
+        sha = hashlib.sha1(f"{FORMAT_VERSION}".encode())
+
+        with open(obj_file, "rb") as file:
+            data = file.read()
+        sha.update(data)
+
+        # Material libraries are loaded from the models folder (see Obj)
+        for name in _MTLLIB_LINE.findall(data):
+            mtl_file = "models/{}".format(name.decode())
+            if os.path.exists(mtl_file):
+                with open(mtl_file, "rb") as file:
+                    sha.update(file.read())
+
+        return sha.hexdigest()
+
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.mesh")
+
+
+    def load_obj_file(self, obj_file: str) -> list[Mesh]:
+        """
+        Returns the meshes of an .obj file from the cache if present,
+        otherwise loads them with Obj, prepares them and stores them in the
+        cache.
+        """
+        key = self.key(obj_file)
+
+        meshes = self.load(key)
+        if meshes is not None:
+            self.hits += 1
+            logger.info(f"Loaded {len(meshes)} mesh(es) for {obj_file} from the cache.")
+            return meshes
+
+        self.misses += 1
+        meshes = Obj(obj_file).load_obj_file()
+        for mesh in meshes:
+            MeshCache.prepare(mesh)
+        self.store(key, meshes)
+        return meshes
+
+
+    def stream_obj_file(self, obj_file: str):
+        """
+        Generator version of load_obj_file. On a miss, each mesh is yielded as
+        soon as Obj.stream_obj_file creates it, and the meshes are stored in
+        the cache once the whole file has been read.
+        """
+        key = self.key(obj_file)
+
+        meshes = self.load(key)
+        if meshes is not None:
+            self.hits += 1
+            logger.info(f"Loaded {len(meshes)} mesh(es) for {obj_file} from the cache.")
+            yield from meshes
+            return
+
+        self.misses += 1
+        meshes = []
+        for mesh in Obj(obj_file).stream_obj_file():
+            MeshCache.prepare(mesh)
+            meshes.append(mesh)
+            yield mesh
+        self.store(key, meshes)
+
+
+    def load(self, key: str) -> list[Mesh] | None:
+        """Loads the meshes stored under a key, or returns None on a miss."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            return MeshCache.read(np.memmap(path, dtype=np.uint8, mode="r"))
+        except (OSError, ValueError) as error:
+            logger.warning(f"Could not read mesh cache file {path}: {error}")
+            return None
+
+
+    def store(self, key: str, meshes: list[Mesh]) -> None:
+        """Writes meshes to the cache under a key."""
+        layout = MeshCache.layout(meshes)
+
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.path(key)
+
+        # Write to a temporary file first, so an interrupted write never
+        # leaves a corrupt cache file behind.
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        data = np.memmap(temp_path, dtype=np.uint8, mode="w+", shape=(max(layout[3], 1),))
+        MeshCache.write(data, layout)
+        data.flush()
+        del data
+        os.replace(temp_path, path)
+
+        logger.info(f"Stored {len(meshes)} mesh(es) in the cache as {path}.")
+
+
+    @staticmethod
+    def prepare(mesh: Mesh) -> None:
+        """
+        Does the work on a newly loaded mesh which is worth caching:
+        generating its LODs, then reordering it for the GPU.
+        """
+        LOD.generate(mesh)
+        MeshOptimiser.optimise(mesh)
+
+
+    @staticmethod
+    def layout(meshes: list[Mesh]) -> tuple:
+        """
+        Works out where each array of a list of meshes is stored.
+        :return: the header bytes, the offset of the array data, a list of
+        (offset, array) pairs and the total size in bytes.
+        """
+        header = {"meshes": []}
+        blobs = []
+        offset = 0
+
+        for mesh in meshes:
+            record = {
+                "name": mesh.name,
+                "normals_source": mesh.normals_source,
+                "acmr": mesh.acmr,
+                "material": MeshCache.material_to_record(mesh.material),
+                "arrays": {}
+            }
+
+            for name in MESH_ARRAYS:
+                array = getattr(mesh, name)
+                if array is None:
+                    continue
+
+                array = np.ascontiguousarray(array)
+                record["arrays"][name] = {
+                    "dtype": array.dtype.str,
+                    "shape": list(array.shape),
+                    "offset": offset
+                }
+                blobs.append((offset, array))
+                offset += MeshCache.align(array.nbytes)
+
+            header["meshes"].append(record)
+
+        header_bytes = json.dumps(header).encode()
+        data_start = MeshCache.align(12 + len(header_bytes))
+
+        return header_bytes, data_start, blobs, data_start + offset
+
+
+    @staticmethod
+    def write(data: np.ndarray, layout: tuple) -> None:
+        """
+        Writes meshes to a uint8 array (a file or shared memory) of at least
+        the size given by their layout.
+        """
+        header_bytes, data_start, blobs, _ = layout
+
+        data[:4] = np.frombuffer(MAGIC, dtype=np.uint8)
+        data[4:12] = np.array([FORMAT_VERSION, len(header_bytes)], dtype="<u4").view(np.uint8)
+        data[12:12 + len(header_bytes)] = np.frombuffer(header_bytes, dtype=np.uint8)
+
+        for offset, array in blobs:
+            start = data_start + offset
+            data[start:start + array.nbytes] = array.reshape(-1).view(np.uint8)
+
+
+    @staticmethod
+    def read(data: np.ndarray) -> list[Mesh] | None:
+        """
+        Reads meshes from a uint8 array written by MeshCache.write. The
+        mesh arrays are views of data, not copies.
+        Returns None if the data is from a different format version.
+        """
+        if bytes(data[:4]) != MAGIC:
+            raise ValueError("Not mesh cache data.")
+
+        version, header_size = (int(x) for x in data[4:12].view("<u4"))
+        if version != FORMAT_VERSION:
+            return None
+
+        header = json.loads(bytes(data[12:12 + header_size]).decode())
+        data_start = MeshCache.align(12 + header_size)
+
+        meshes = []
+        for record in header["meshes"]:
+            arrays = {}
+            for name, layout in record["arrays"].items():
+                dtype = np.dtype(layout["dtype"])
+                size = int(np.prod(layout["shape"])) * dtype.itemsize
+                start = data_start + layout["offset"]
+                arrays[name] = data[start:start + size].view(dtype).reshape(layout["shape"])
+
+            # Normals are provided, so the mesh does not calculate them again
+            mesh = Mesh(vertices=arrays.get("vertices"),
+                        faces=arrays.get("faces"),
+                        normals=arrays.get("normals"),
+                        textureCoords=arrays.get("textureCoords"),
+                        material=MeshCache.material_from_record(record["material"]))
+            mesh.name = record["name"]
+            mesh.normals_source = record["normals_source"]
+            mesh.acmr = record["acmr"]
+            mesh.colors = arrays.get("colors")
+            mesh.tangents = arrays.get("tangents")
+            mesh.binormals = arrays.get("binormals")
+            mesh.lod_faces = arrays.get("lod_faces")
+            mesh.lod_ranges = arrays.get("lod_ranges")
+            meshes.append(mesh)
+
+        return meshes
+
+
+    @staticmethod
+    def align(size: int) -> int:
+        """Rounds a size up to the next multiple of ALIGNMENT."""
+        return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+    @staticmethod
+    def material_to_record(material: Material) -> dict:
+        """Converts a material to a JSON-serialisable dictionary."""
+        return {
+            "name": material.name,
+            "Ka": [float(x) for x in material.Ka],
+            "Kd": [float(x) for x in material.Kd],
+            "Ks": [float(x) for x in material.Ks],
+            "Ns": float(material.Ns),
+            "illumination": material.illumination,
+            "texture": material.texture,
+            "tex_scale": [float(x) for x in material.tex_scale],
+            "d": float(material.d)
+        }
+
+
+    @staticmethod
+    def material_from_record(record: dict) -> Material:
+        """Converts a dictionary from material_to_record back to a material."""
+        material = Material(record["name"], Ka=glm.vec3(record["Ka"]),
+                            Kd=glm.vec3(record["Kd"]), Ks=glm.vec3(record["Ks"]),
+                            Ns=record["Ns"], texture=record["texture"])
+        material.illumination = record["illumination"]
+        material.tex_scale = glm.vec3(record["tex_scale"])
+        material.d = record["d"]
+        return material
@@ -1,9 +1,16 @@
+import ctypes
+
 from OpenGL.GL import *
 
 import glm
 import numpy as np
 
 from mesh import Mesh
+from lod import LOD
+from vertex_format import VertexFormat, ATTRIBUTE_LOCATIONS
+from buffer_pool import buffer_pool
+from transform import TransformNode
+from model_registry import model_registry
 from texture import Texture
 from shaders import Shader, EnvironmentShader, ShadowMappingShader, PhongShader 
 from log import Logger
@@ -11,11 +18,153 @@ from log import Logger
 logger = Logger(False, True, True)
 
 
+class MeshBuffers:
+    """
+    A mesh's ranges of the shared vertex and index buffers (see
+    buffer_pool.py), which are drawn with the vao of their block. These are
+    shared by every model which draws the mesh, and freed once the last of
+    them is deleted.
+    If compact is True, the vertices are stored in the compact formats of
+    vertex_format.py; otherwise every attribute is stored as floats.
+    """
+    def __init__(self, mesh, compact=False):
+        self.compact = compact
+
+        # The pool block holding the mesh, and its ranges of the block's
+        # vertex buffer (in vertices) and index buffer (in indices)
+        self.block = None
+        self.vertex_allocation = None
+        self.index_allocation = None
+
+        # (index count, byte offset) of the full mesh, followed by each of
+        # its LODs, relative to the start of the mesh's indices
+        self.local_index_ranges = []
+        self.index_type = GL_UNSIGNED_INT
+        self.index_size = 4
+
+        # Maps the stored positions to the mesh's positions (in the vertex
+        # shaders), for quantised positions
+        self.position_transform = glm.mat4()
+
+        # Location of each attribute in the shaders, and the (location,
+        # size, type, normalized, offset) of each in a vertex of stride bytes
+        self.attributes = {}
+        self.formats = []
+        self.stride = 0
+
+        # Number of models using these buffers
+        self.users = 0
+
+        if compact:
+            layout, self.position_transform = VertexFormat.compact_layout(mesh)
+        else:
+            layout = VertexFormat.float_layout(mesh)
+        self.initialise_layout(layout)
+
+        faces = np.zeros(0, dtype=np.uint32)
+        if mesh.faces is not None:
+            faces = self.initialise_index_ranges(mesh)
+
+        self.block, self.vertex_allocation, self.index_allocation = buffer_pool.allocate(
+            self.stride, tuple(self.formats), self.index_size, layout.build(), faces)
+
+
+    @property
+    def vao(self):
+        return self.block.vao
+
+
+    @property
+    def vertex_buffer(self):
+        return self.block.vertex_buffer
+
+
+    @property
+    def index_buffer(self):
+        return self.block.index_buffer
+
+
+    @property
+    def base_vertex(self) -> int:
+        """The index of the mesh's first vertex in the vertex buffer."""
+        return self.vertex_allocation.offset
+
+
+    @property
+    def index_ranges(self) -> list:
+        """
+        The (index count, byte offset) in the index buffer of the full mesh,
+        followed by each of its LODs. The indices are relative to the mesh's
+        first vertex, so must be drawn with base_vertex.
+        """
+        start = self.index_allocation.offset * self.index_size
+        return [(count, start + offset) for count, offset in self.local_index_ranges]
+
+
+    def initialise_layout(self, layout):
+        """Records the location and format of each attribute of a layout."""
+        missing = set(ATTRIBUTE_LOCATIONS) - {attribute.name for attribute in layout.attributes}
+        if len(missing) > 0:
+            logger.warning(f"MeshBuffers.initialise_layout: No data for attribute(s) {sorted(missing)}.")
+
+        self.stride = layout.stride
+        for attribute in layout.attributes:
+            # Location must correspond to an "in" variable in the GLSL vertex shader code
+            self.attributes[attribute.name] = attribute.location
+            self.formats.append((attribute.location, attribute.size, attribute.type,
+                                 attribute.normalized, attribute.offset))
+
+
+    def point_attributes(self):
+        """Points the bound vao's attribute locations at the vertex buffer."""
+        VertexFormat.point_attributes(self.formats, self.stride)
+
+
+    def create_vao(self):
+        """
+        Creates (and leaves bound) another vao reading the same vertex and
+        index buffers, for a model which adds attributes of its own (e.g.
+        per-instance data). The caller owns, and must delete, the vao.
+        """
+        vao = glGenVertexArrays(1)
+        glBindVertexArray(vao)
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertex_buffer)
+        self.point_attributes()
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+
+        return vao
+
+
+    def initialise_index_ranges(self, mesh) -> np.ndarray:
+        """
+        Chooses the index type, and returns the faces of the mesh followed by
+        the faces of its LODs (if it has any), as one array.
+        """
+        dtype, self.index_type = VertexFormat.index_type(mesh.vertices.shape[0], self.compact)
+        index_size = self.index_size = np.dtype(dtype).itemsize
+
+        faces = np.asarray(mesh.faces, dtype=dtype)
+        self.local_index_ranges = [(faces.size, 0)]
+        
+        if mesh.lod_faces is not None:
+            lod_faces = np.asarray(mesh.lod_faces, dtype=dtype)
+            for first, count in mesh.lod_ranges:
+                self.local_index_ranges.append((3 * int(count), (faces.size + 3 * int(first)) * index_size))
+            faces = np.concatenate([faces.ravel(), lod_faces.ravel()])
+
+        return np.ascontiguousarray(faces).ravel()
+
+
+    def delete(self):
+        """Frees the mesh's ranges of the shared buffers."""
+        buffer_pool.free(self.block, self.vertex_allocation, self.index_allocation)
+
+
 class Model:
     """Base class for all models."""
-    def __init__(self, scene, M, mesh=Mesh(), colour=[1,1,1], primitive=GL_TRIANGLES, visible=True):
-        self.visible = visible
-        
+    def __init__(self, scene, M, mesh=Mesh(), colour=[1,1,1], primitive=GL_TRIANGLES, visible=True,
+                 compact=False, parent=None):
         self.scene = scene
 
         self.primitive = primitive
@@ -30,44 +179,44 @@ class Model:
 
         self.name = self.mesh.name
 
-        self.vao = glGenVertexArrays(1)
-        self.vbos = {}
-        self.missing_attributes = []
+        # GPU buffers of the mesh, created in bind (and shared with every
+        # other model of the same mesh). If compact is True, they use the
+        # compact vertex formats, unless another model created them first.
+        self.buffers = None
+        self.compact = compact
 
-        # Will store indices if using shared vertex representation
-        self.index_buffer = None
+        # Vertex array object drawn by the model (the buffers' vao, unless
+        # the model needs one of its own)
+        self.vao = None
 
-        self.attributes = {}
+        # Position of the model in the scene (see transform.py), whose world
+        # matrix is the model matrix M
+        self.transform = TransformNode(M, parent=parent, name=self.name)
 
-        self.M = M
+        # Row of the model's matrices, visibility and material in the model
+        # registry (see model_registry.py)
+        self.slot = model_registry.register(self.transform, self.mesh.material, visible)
 
 
-    def initialise_vbo(self, name, data):
-        #print(f"Initialising VBO for attribute {name}.")
+    @property
+    def visible(self) -> bool:
+        return bool(model_registry.visible[self.slot])
+
+
+    @visible.setter
+    def visible(self, visible: bool):
+        model_registry.visible[self.slot] = visible
 
-        if data is None:
-            logger.warning(f"{self.__class__.__name__}.initialise_vbo: Data array for attribute \
-{name} is None.")
-            self.missing_attributes.append(name)
-            return
-        
-        # Bind location of attribute in GLSL program to the next index (which is len(self.vbos))
-        # Location name must correspond to an "in" variable in the GLSL vertex shader code
-        self.attributes[name] = len(self.vbos) + len(self.missing_attributes)
-        
-        # Create a buffer object
-        self.vbos[name] = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
 
-        # Enable attrib (using location of attribute)
-        glEnableVertexAttribArray(self.attributes[name])
+    @property
+    def M(self) -> glm.mat4:
+        """The model matrix: the world matrix of the model's transform node."""
+        return self.transform.world
 
-        # Associate bound buffer to corresponding input location in shader
-        # Every vertex shader instance gets one row of the array, so can be processed in parallel
-        glVertexAttribPointer(index=self.attributes[name], size=data.shape[1], type=GL_FLOAT,
-            normalized=False, stride=0, pointer=None)
 
-        glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+    @M.setter
+    def M(self, M: glm.mat4):
+        self.transform.set_world(M)
 
 
     def bind_shader(self, shader):
@@ -123,29 +272,20 @@ class Model:
     def bind(self):
         """
         Stores vertex data in a Vertex Buffer Object (VBO) which can be uploaded to the GPU
-        at render time
+        at render time. If the mesh has already been uploaded by another model, its buffers
+        are reused instead.
         """
-        glBindVertexArray(self.vao)
-
         if self.mesh.vertices is None:
             print("Warning - No vertices")
         
-        # Initialise vertex VBOs and link to shader attributes
-        self.initialise_vbo("position", self.mesh.vertices)
-        self.initialise_vbo("normal", self.mesh.normals)
-        self.initialise_vbo("colour", self.mesh.colors)
-        self.initialise_vbo("tex_coord", self.mesh.textureCoords)
-        # self.initialise_vbo('tangent', self.mesh.tangents)
-        # self.initialise_vbo('binormal', self.mesh.binormals)
-
-        if self.mesh.faces is not None:
-            self.index_buffer = glGenBuffers(1)
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
-            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.mesh.faces, GL_STATIC_DRAW)
-
-        # Unbind VAO and VBO to avoid side effects
-        glBindVertexArray(0)
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.mesh.load_textures()
+        
+        if self.mesh.buffers is None:
+            self.mesh.buffers = MeshBuffers(self.mesh, self.compact)
+        
+        self.buffers = self.mesh.buffers
+        self.buffers.users += 1
+        self.vao = self.buffers.vao
 
 
     def draw(self):
@@ -173,19 +313,64 @@ class Model:
 
         # Check whether stored as vertex or index array
         if self.mesh.faces is not None:
-            glDrawElements(self.primitive, self.mesh.faces.flatten().shape[0], GL_UNSIGNED_INT, None)
+            # Draw the level of detail suited to the model's size on screen
+            self.draw_elements(self.select_level())
         else:
-            glDrawArrays(self.primitive, 0, self.mesh.vertices.shape[0])
+            glDrawArrays(self.primitive, self.buffers.base_vertex, self.mesh.vertices.shape[0])
 
         # Unbind vao
         glBindVertexArray(0)
 
 
+    def bounds(self) -> tuple:
+        """
+        Returns the bounds of everything the model draws, in model space: the
+        centre, the radius of the bounding sphere and the half-extents of the
+        bounding box (both centred on the centre).
+        """
+        low, high = self.mesh.bounding_box()
+        _, radius = self.mesh.bounding_sphere()
+        return (low + high) / 2, radius, (high - low) / 2
+
+
+    def select_level(self) -> int:
+        """Chooses the level of detail to draw (see LOD.select)."""
+        return LOD.select(self.mesh, self.M, self.scene.camera.V, self.scene.P,
+                          self.scene.lod_bias)
+
+
+    def draw_elements(self, level: int):
+        """
+        Draws the faces of a level of detail (0 for the full mesh), with the
+        vao and shader already bound.
+        """
+        count, offset = self.buffers.index_ranges[level]
+        glDrawElementsBaseVertex(self.primitive, count, self.buffers.index_type,
+                                 ctypes.c_void_p(offset), self.buffers.base_vertex)
+
+
+    def release(self):
+        """
+        Stops using the mesh's buffers, freeing its ranges of the buffer pool
+        if no other model uses them.
+        """
+        if self.buffers is None:
+            return
+        
+        self.buffers.users -= 1
+        if self.buffers.users == 0:
+            self.buffers.delete()
+            if self.mesh.buffers is self.buffers:
+                self.mesh.buffers = None
+        self.buffers = None
+
+
     def __del__(self):
         """Destructor."""
-        vbo_ids = list(self.vbos.values())
-        glDeleteBuffers(len(vbo_ids), vbo_ids)        
-        glDeleteVertexArrays(1, self.vao.tolist())
+        self.release()
+        if getattr(self, "slot", None) is not None:
+            model_registry.unregister(self.slot)
+            self.slot = None
 
 
 class DrawModelFromMesh(Model):
@@ -194,14 +379,25 @@ class DrawModelFromMesh(Model):
     '''
 
     def __init__(self, scene, M, mesh, env_map=None, shadows=None,
-                 name=None, shader=None, visible=True):
+                 name=None, shader=None, visible=True, compact=False, static=False,
+                 instanced=False, indirect=False, parent=None):
         '''
         Initialises the model data
+        :param parent: [optional] A transform node the model moves with, in
+        which case M is relative to it.
+        :param static: [optional] If True, the model is drawn as part of a
+        static batch (see static_batch.py), so its mesh is not uploaded.
+        :param instanced: [optional] If True, the instanced variants of the
+        standard shaders are used (see instancing.py).
+        :param indirect: [optional] If True, the multi-draw variants of the
+        phong and shadow mapping shaders are used (see indirect.py).
         '''
-        super().__init__(scene=scene, M=M, mesh=mesh, visible=visible)
+        super().__init__(scene=scene, M=M, mesh=mesh, visible=visible, compact=compact,
+                         parent=parent)
 
         if name is not None:
             self.name = name
+            self.transform.name = name
 
         if self.mesh.faces.shape[1] == 3:
             self.primitive = GL_TRIANGLES
@@ -211,7 +407,9 @@ class DrawModelFromMesh(Model):
             print(f"(E) Error in DrawModelFromObjFile.__init__(): index array must have 3 (triangles) or 4 (quads) columns, found {self.indices.shape[1]}!")
             raise
         
-        self.bind()
+        self.static = static
+        if not static:
+            self.bind()
         
         if shader is not None:
             # Non-standard shader, won't have shadows assigned (only case
@@ -219,13 +417,16 @@ class DrawModelFromMesh(Model):
             self.bind_shader(shader)
         else:
             if mesh.material is not None and mesh.material.illumination >= 3:
-                self.bind_shader(EnvironmentShader(env_map))
+                self.bind_shader(EnvironmentShader.shared(env_map, instanced=instanced))
             else:
                 # Bind both phong and blinn-phong shaders
-                self.bind_shader(PhongShader(blinn=True))
-                self.bind_shader(PhongShader(blinn=False))
+                self.bind_shader(PhongShader.shared(blinn=True, instanced=instanced,
+                                                    indirect=indirect))
+                self.bind_shader(PhongShader.shared(blinn=False, instanced=instanced,
+                                                    indirect=indirect))
             
             if shadows is not None:
-                self.bind_shader(ShadowMappingShader(shadows))
+                self.bind_shader(ShadowMappingShader.shared(shadows, instanced=instanced,
+                                                            indirect=indirect))
 
         self.set_shader_default()
\ No newline at end of file
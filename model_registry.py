@@ -0,0 +1,141 @@
+import json
+
+import numpy as np
+
+from mesh_cache import MeshCache
+
+'''
+A structure-of-arrays store of every model's per-draw data. Each model has
+a slot (a row) in contiguous arrays of:
+    - its world matrix M, as an (N, 4, 4) float32 array (mathematical layout),
+    - M and its inverse transpose M_it, packed column-major as the shaders'
+      uniforms expect (N, 32),
+    - the version of M stored (see transform.py),
+    - whether it is visible, and
+    - the index of its material (equal materials share an index).
+
+When a model's transform node is marked dirty, its slot is queued; update
+then reads the world matrices of the queued slots and calculates all their
+inverse transposes and packed rows in one batch, so a frame costs a few
+numpy calls plus one row per model which moved. Shaders upload M and M_it
+from the packed rows, and culling and sorting read the arrays directly.
+'''
+
+# Slots the arrays start with, doubling whenever they are full
+INITIAL_CAPACITY = 256
+
+
+class ModelRegistry:
+    def __init__(self):
+        self.capacity = 0
+        self.world = np.zeros((0, 4, 4), dtype=np.float32)
+        self.uniforms = np.zeros((0, 32), dtype=np.float32)
+        self.versions = np.zeros(0, dtype=np.int64)
+        self.visible = np.zeros(0, dtype=bool)
+        self.materials = np.zeros(0, dtype=np.int32)
+
+        # Transform node of each slot (None if free), and the free slots
+        self.nodes = []
+        self.free_slots = []
+
+        # Slots whose transform nodes have changed since the last update
+        self.pending = set()
+
+        # Material record => index, so equal materials (which may be
+        # separate objects) share one
+        self.material_ids = {}
+
+        self.grow(INITIAL_CAPACITY)
+
+
+    def grow(self, capacity: int) -> None:
+        """Enlarges the arrays to hold capacity slots."""
+        count = capacity - self.capacity
+        self.world = np.concatenate([self.world, np.tile(np.eye(4, dtype=np.float32), (count, 1, 1))])
+        self.uniforms = np.concatenate([self.uniforms, np.zeros((count, 32), dtype=np.float32)])
+        self.versions = np.concatenate([self.versions, np.zeros(count, dtype=np.int64)])
+        self.visible = np.concatenate([self.visible, np.zeros(count, dtype=bool)])
+        self.materials = np.concatenate([self.materials, np.zeros(count, dtype=np.int32)])
+
+        self.free_slots.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.nodes.extend([None] * count)
+        self.capacity = capacity
+
+
+    def register(self, node, material=None, visible=True) -> int:
+        """
+        Gives a model a slot.
+        :param node: The model's transform node, which queues the slot
+        whenever it is marked dirty.
+        :return: the slot.
+        """
+        if len(self.free_slots) == 0:
+            self.grow(2 * self.capacity)
+
+        slot = self.free_slots.pop()
+        self.nodes[slot] = node
+        self.visible[slot] = visible
+        self.materials[slot] = self.material_id(material)
+        self.versions[slot] = 0
+
+        node.on_dirty = lambda: self.pending.add(slot)
+        self.pending.add(slot)
+        return slot
+
+
+    def unregister(self, slot: int) -> None:
+        """Frees a model's slot."""
+        node = self.nodes[slot]
+        if node is not None:
+            node.on_dirty = None
+
+        self.nodes[slot] = None
+        self.visible[slot] = False
+        self.pending.discard(slot)
+        self.free_slots.append(slot)
+
+
+    def material_id(self, material) -> int:
+        """Returns the index shared by every material equal to this one."""
+        if material is None:
+            return -1
+
+        record = json.dumps(MeshCache.material_to_record(material), sort_keys=True)
+        return self.material_ids.setdefault(record, len(self.material_ids))
+
+
+    def update(self) -> None:
+        """Stores the world matrices of the queued slots, and packs their uniforms."""
+        if len(self.pending) == 0:
+            return
+
+        slots = np.fromiter(self.pending, dtype=np.int64, count=len(self.pending))
+        self.pending = set()
+
+        for slot in slots:
+            node = self.nodes[slot]
+            self.world[slot] = node.world_array
+            self.versions[slot] = node.version
+
+        # Column-major M, and M_it (the column-major inverse transpose is
+        # the row-major inverse)
+        world = self.world[slots]
+        self.uniforms[slots, :16] = world.transpose(0, 2, 1).reshape(-1, 16)
+
+        # np.linalg.inv raises for singular matrices (e.g. a zero scale), so
+        # those are inverted one at a time by glm, which gives inf/NaN as before
+        world = world.astype(np.float64)
+        invertible = np.linalg.det(world) != 0
+        self.uniforms[slots[invertible], 16:] = np.linalg.inv(world[invertible]).reshape(-1, 16)
+        for slot in slots[~invertible]:
+            self.uniforms[slot, 16:] = np.array(self.nodes[slot].normal_matrix).T.ravel()
+
+
+    @staticmethod
+    def slots(models: list) -> np.ndarray:
+        """Returns the slots of models, as an array to index the registry's arrays."""
+        return np.fromiter((model.slot for model in models), dtype=np.int64, count=len(models))
+
+
+# The model registry of the whole program
+model_registry = ModelRegistry()
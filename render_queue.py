@@ -0,0 +1,108 @@
+import glm
+import numpy as np
+
+from model_registry import model_registry, ModelRegistry
+
+'''
+Orders the models drawn in each pass to reduce GPU state changes, and to
+blend transparent materials correctly.
+
+Each model gets a sort key of its program, texture and material (each mapped
+to a small integer, the material's by the model registry), and the view
+space depth of its bounding sphere centre:
+    - Opaque models (material d = 1) are sorted by program, then texture,
+      then material, then front to back, so models which share state are
+      drawn together, and near models fill the depth buffer first.
+    - Transparent models are drawn after every opaque model, back to front,
+      so each blends over what is behind it.
+The depths and orders of a pass are calculated for every model at once.
+
+The number of state changes (a program, vao, texture or material differing
+from the previous draw's) is counted in the order the models were given and
+in the sorted order, summed over every pass of a frame.
+'''
+
+# State columns of the array built for each pass
+PROGRAM, TEXTURE, MATERIAL, VAO = range(4)
+
+
+class RenderQueue:
+    def __init__(self):
+        # State changes in this frame, in the given and sorted orders
+        self.unsorted_changes = 0
+        self.sorted_changes = 0
+
+        # Counts for the last complete frame
+        self.frame_unsorted_changes = 0
+        self.frame_sorted_changes = 0
+
+
+    def sort(self, models: list, V: glm.mat4) -> list:
+        """
+        Returns the visible models in the order to draw them, for a pass
+        with view matrix V.
+        """
+        slots = ModelRegistry.slots(models)
+        visible = model_registry.visible[slots]
+        models = [model for model, keep in zip(models, visible) if keep]
+        if len(models) == 0:
+            return models
+
+        slots = slots[visible]
+        states = np.array([RenderQueue.state(model) for model in models], dtype=np.int64)
+        states[:, MATERIAL] = model_registry.materials[slots]
+        depths = RenderQueue.view_depths(models, slots, V)
+        transparent = np.array([model.mesh.material.d < 1.0 for model in models])
+
+        opaque = np.flatnonzero(~transparent)
+        opaque = opaque[np.lexsort((depths[opaque], states[opaque, MATERIAL],
+                                    states[opaque, TEXTURE], states[opaque, PROGRAM]))]
+
+        blended = np.flatnonzero(transparent)
+        blended = blended[np.argsort(-depths[blended], kind="stable")]
+
+        order = np.concatenate([opaque, blended])
+
+        self.unsorted_changes += RenderQueue.state_changes(states)
+        self.sorted_changes += RenderQueue.state_changes(states[order])
+
+        return [models[i] for i in order]
+
+
+    @staticmethod
+    def state(model) -> tuple:
+        """
+        Returns the (program, texture, material, vao) of a model's draws,
+        with the material left for the model registry's array.
+        """
+        textures = model.mesh.textures
+        texture = textures[0].textureid if len(textures) > 0 else 0
+        return (model.shader.program, texture, 0, model.vao)
+
+
+    @staticmethod
+    def view_depths(models: list, slots: np.ndarray, V: glm.mat4) -> np.ndarray:
+        """Returns the view space depth of the centre of each model's bounds (see Model.bounds)."""
+        centres = np.array([(*model.bounds()[0], 1.0) for model in models])
+
+        model_registry.update()
+        Ms = model_registry.world[slots].astype(np.float64)
+
+        world = np.einsum("nij,nj->ni", Ms, centres)
+
+        # Depth is the distance along -z in view space
+        return -(world @ np.array(V)[2])
+
+
+    @staticmethod
+    def state_changes(states: np.ndarray) -> int:
+        """Counts the state values which differ from the previous draw's."""
+        return int(np.count_nonzero(states[1:] != states[:-1]))
+
+
+    def end_frame(self) -> None:
+        """Stores the counts of the frame which just finished, and resets them."""
+        self.frame_unsorted_changes = self.unsorted_changes
+        self.frame_sorted_changes = self.sorted_changes
+        self.unsorted_changes = 0
+        self.sorted_changes = 0
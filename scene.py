@@ -1,18 +1,33 @@
 from OpenGL.GL import *
 
+import time
 import pygame
 import glm
 
 from settings import Settings
-from blender import Obj
+from mesh_cache import MeshCache
+from asset_loader import AssetLoader
 from camera import Camera
 from mesh import CubeMesh, SphereMesh
 from model import *
-from shaders import ShadowMappingShader
+from buffer_pool import buffer_pool
+from transform import TransformNode
+from model_registry import model_registry
+from static_batch import StaticBatch
+from indirect import IndirectBatch
+from instancing import InstancedModel
+from dynamic import dynamic_stats
+from shaders import ShadowMappingShader, uniform_stats
+from frame_uniforms import FrameUniforms
+from render_queue import RenderQueue
+from frustum import FrustumCuller
 from cube_map import FlattenCubeMap
 from environment_mapping import EnvironmentMappingTexture
 from shadow_mapping import ShadowMap
 from light_source import LightSource
+from log import Logger
+
+logger = Logger(False, True, True)
 
 
 class Scene:
@@ -22,6 +37,18 @@ class Scene:
 
         # Objects to be rendered
         self.models: list = []
+        
+        # Meshes loaded from .obj files are cached on disk between runs
+        self.mesh_cache = MeshCache()
+        
+        # Loads .obj files in parallel; meshes loaded ahead of time by
+        # preload_obj_files are kept here until their models are added.
+        self.asset_loader = AssetLoader(self.mesh_cache)
+        self.preloaded_meshes = {}
+
+        # Static models waiting to be merged by batch_static_models, each
+        # with whether it is part of the environment
+        self.static_models: list = []
 
         # Initialise pygame
         pygame.init()
@@ -50,6 +77,10 @@ class Scene:
         far = 1000
         self.P = glm.frustum(left, right, bottom, top, near, far)
 
+        # Multiplies the projected size of models when choosing their level
+        # of detail; the shadow and environment passes lower it while drawing
+        self.lod_bias = 1.0
+
         self.pan_acceleration = 1.25
         self.pan_velocity = glm.vec3()
         self.pan_speed = 0.1
@@ -64,7 +95,7 @@ class Scene:
                                  Is=glm.vec3(1,1,1))
         
         # Display the light source with a sphere
-        sun_mesh = SphereMesh()
+        sun_mesh = SphereMesh.shared()
         self.show_light = DrawModelFromMesh(scene=self,
                                         M=glm.translate(self.light.position + glm.vec3(0,5,0)),
                                         name="Sun", mesh=sun_mesh)
@@ -77,6 +108,15 @@ class Scene:
         # Shadow mapping
         self.shadows = ShadowMap(light=self.light)
 
+        # Camera and light data shared by every shader, updated once per pass
+        self.frame_uniforms = FrameUniforms()
+
+        # Orders each pass's draws by state and depth
+        self.render_queue = RenderQueue()
+
+        # Skips the models outside each pass's frustum
+        self.frustum_culler = FrustumCuller()
+
         # When this is made false, the mainloop breaks and program ends
         self.running = True
 
@@ -113,12 +153,73 @@ class Scene:
         """Adds a list of models to the scene."""
         for model in models:
             self.add_model(model)
+
+
+    def remove_model(self, model: Model, defragment=False) -> None:
+        """
+        Removes a model from the scene, and frees its mesh's buffers if no
+        other model draws the mesh. Static models can be removed until they
+        are batched (see batch_static_models).
+        :param defragment: [optional] If True, the buffer pool is compacted
+        afterwards, so the freed space can hold larger meshes.
+        """
+        self.static_models = [(static, in_environment) for static, in_environment
+                              in self.static_models if static is not model]
+        if model in self.models:
+            self.models.remove(model)
+        if model in self.in_environment:
+            self.in_environment.remove(model)
+        model.release()
+
+        if defragment:
+            buffer_pool.defragment()
+    
+    
+    def preload_obj_files(self, obj_files: list[str]) -> None:
+        """
+        Loads the meshes of several .obj files in parallel, ready for
+        add_models_from_obj to use.
+        """
+        self.preloaded_meshes.update(self.asset_loader.load_obj_files(obj_files))
+    
+    
+    def load_meshes(self, obj_file: str, stream=False):
+        """
+        Returns the meshes of an .obj file: preloaded, streamed (as a
+        generator) or loaded through the mesh cache.
+        """
+        if obj_file in self.preloaded_meshes:
+            return self.preloaded_meshes.pop(obj_file)
+        if stream:
+            return self.mesh_cache.stream_obj_file(obj_file)
+
+        time_start = time.perf_counter()
+        meshes = self.mesh_cache.load_obj_file(obj_file)
+        self.asset_loader.add_time(obj_file, "load", time.perf_counter() - time_start)
+        return meshes
     
     
     def add_models_from_obj(self, obj_file: str, pos=glm.vec3(),
                             scale=glm.vec3(1,1,1), rotation=glm.vec3(0,0,0),
-                            name="", shadows=False, in_environment=False) -> None:
-        meshes = Obj(obj_file).load_obj_file()
+                            name="", shadows=False, in_environment=False,
+                            stream=False, compact=False, static=False) -> None:
+        """
+        Adds a model to the scene for each mesh in an .obj file.
+        If stream is True, the file is read as a stream, and each model is
+        created as soon as its mesh has been read, which bounds the memory
+        used while loading large files.
+        If compact is True, the models' vertices are uploaded in compact
+        formats (see vertex_format.py), which use less memory and bandwidth
+        at a small cost in precision.
+        If static is True, the models must never move; they are drawn in
+        batches made by batch_static_models, rather than one at a time.
+        The models' transforms are children of one node, so the whole file
+        can be moved by moving models[0].transform.parent.
+        """
+        time_start = time.perf_counter()
+        meshes = self.load_meshes(obj_file, stream)
+        if not stream:
+            time_start = time.perf_counter()
         
         P = glm.translate(pos)
         S = glm.scale(scale)
@@ -129,6 +230,9 @@ class Scene:
         R = glm.mat4_cast(y_rot * z_rot * x_rot)
         
         M = P * R * S
+
+        # The meshes move together, as children of one node
+        node = TransformNode(M, name=name)
         
         models = []
         
@@ -138,19 +242,88 @@ class Scene:
         env_map = self.environment
         
         for mesh in meshes:
-            model = DrawModelFromMesh(scene=self, M=M, mesh=mesh,
+            model = DrawModelFromMesh(scene=self, M=glm.mat4(), mesh=mesh,
                                       env_map=env_map, shadows=shadow_map,
-                                      name=name)
+                                      name=name, compact=compact, static=static,
+                                      parent=node)
             models.append(model)
-                
-        self.add_models(models)
+        
+        if static:
+            self.static_models.extend((model, in_environment) for model in models)
+        else:
+            self.add_models(models)
+            if in_environment:
+                self.in_environment.extend(models)
 
+        self.asset_loader.add_time(obj_file, "bind", time.perf_counter() - time_start)
+        self.asset_loader.add_meshes(obj_file, [model.mesh for model in models])
+
+        return models
+    
+
+    def add_instances_from_obj(self, obj_file: str, transforms, tints=None, M=glm.mat4(),
+                               name="", shadows=False, in_environment=False,
+                               compact=False) -> list[InstancedModel]:
+        """
+        Adds an instanced model to the scene for each mesh in an .obj file,
+        drawing every mesh once per transform (see instancing.py).
+        :param transforms: An (n, 4, 4) array of instance transforms, relative to M.
+        :param tints: [optional] The instances' tints.
+        """
+        meshes = self.load_meshes(obj_file)
+        time_start = time.perf_counter()
+        
+        shadow_map = None
+        if shadows:
+            shadow_map = self.shadows
+        
+        models = []
+        for mesh in meshes:
+            model = InstancedModel(scene=self, M=M, mesh=mesh, transforms=transforms,
+                                   tints=tints, env_map=self.environment, shadows=shadow_map,
+                                   name=name, compact=compact)
+            models.append(model)
+        
+        self.add_models(models)
         if in_environment:
             self.in_environment.extend(models)
-
+        
+        self.asset_loader.add_time(obj_file, "bind", time.perf_counter() - time_start)
+        self.asset_loader.add_meshes(obj_file, [model.mesh for model in models])
+        
         return models
     
 
+    def batch_static_models(self, indirect=False) -> list[StaticBatch]:
+        """
+        Merges the static models added since the last call into batches of
+        models with the same model matrix, shaders and material, and adds
+        the batches to the scene.
+        If indirect is True, the models which can be are instead merged into
+        IndirectBatches, which only need the same shaders and texture, and
+        draw all their models with one multi-draw (see indirect.py).
+        """
+        groups = {}
+        for model, in_environment in self.static_models:
+            if indirect and IndirectBatch.eligible(model):
+                key = (in_environment, IndirectBatch, IndirectBatch.key(model))
+            else:
+                key = (in_environment, StaticBatch, StaticBatch.key(model))
+            groups.setdefault(key, []).append(model)
+        
+        batches = []
+        for (in_environment, batch_class, _), models in groups.items():
+            batch = batch_class(self, models)
+            self.add_model(batch)
+            if in_environment:
+                self.in_environment.append(batch)
+            batches.append(batch)
+        
+        logger.info(f"Batched {len(self.static_models)} static models into {len(batches)} batches")
+        self.static_models = []
+        return batches
+    
+
     def handle_key_event(self, key: int, keydown: bool) -> None:
         """Handles all keyboard input events."""
         # Direction of the press; -1 is keyup, 1 is keydown
@@ -240,11 +413,21 @@ class Scene:
             model.set_shader(name)
     
     
+    def update_frame_uniforms(self) -> None:
+        """
+        Updates the frame uniform buffer for the current pass, from the
+        scene's projection, the camera's view and the light. Call this
+        whenever P or the camera's V are changed for a pass.
+        """
+        self.frame_uniforms.update(self.P, self.camera.V, self.light, self.shadows)
+
+
     def draw_shadow_map(self) -> None:
         """Draw the shadows to the shadow map."""
         glClear(GL_DEPTH_BUFFER_BIT)
         
-        for item in self.models:
+        models = self.frustum_culler.cull(self.models, self.P * self.camera.V, "shadow")
+        for item in self.render_queue.sort(models, self.camera.V):
             item.draw()
 
 
@@ -252,17 +435,26 @@ class Scene:
         """Draw the reflection in an environment-mapped object."""
         self.skybox.draw()
         
-        for model in self.in_environment:
+        models = self.frustum_culler.cull(self.in_environment, self.P * self.camera.V, "environment")
+        for model in self.render_queue.sort(models, self.camera.V):
             model.draw()
 
 
     def draw(self) -> None:
         """Handles all drawing in the scene."""
         
+        # Static models added since the last frame have not been batched yet
+        if len(self.static_models) > 0:
+            self.batch_static_models()
+
+        # Pack the matrices of every model which moved since the last frame
+        model_registry.update()
+
         # Clears the colour and depth bits from previous frame
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         
         # Draw skybox - gives impression of increased scale.
+        self.update_frame_uniforms()
         self.skybox.draw()
         
         # Render/store depth of scene in shadow map texture
@@ -273,13 +465,20 @@ class Scene:
         if self.settings.updates["environment"]:
             self.environment.update(self) 
         
-        # Render the scene as normal
-        for model in self.models:
+        # Render the scene as normal (the passes above change the camera)
+        self.update_frame_uniforms()
+        models = self.frustum_culler.cull(self.models, self.P * self.camera.V, "main")
+        for model in self.render_queue.sort(models, self.camera.V):
             model.draw()
 
         # Double-buffering; flip the buffer.
         pygame.display.flip()
 
+        uniform_stats.end_frame()
+        dynamic_stats.end_frame()
+        self.render_queue.end_frame()
+        self.frustum_culler.end_frame()
+
 
     def next_frame(self) -> None:
         """Carries out one frame of the scene."""
@@ -1,18 +1,53 @@
+import functools
+import time
+
 # imports all openGL functions
 from OpenGL.GL import *
 from OpenGL.GL import shaders
 import glm
 import numpy as np
+from frame_uniforms import FrameUniforms
+from model_registry import model_registry
 from log import Logger
 
 
 logger = Logger(False, False, True)
 
+# GLSL version and extension of the multi-draw (INDIRECT) shader variants
+INDIRECT_GLSL_VERSION = "450 core"
+INDIRECT_GLSL_EXTENSION = "GL_ARB_shader_draw_parameters"
+
+
+class UniformStats:
+    """Counts the uniform uploads issued and skipped (as unchanged) each frame."""
+    def __init__(self):
+        self.uploads = 0
+        self.skips = 0
+
+        # Counts for the last complete frame
+        self.frame_uploads = 0
+        self.frame_skips = 0
+
+
+    def end_frame(self):
+        """Stores the counts of the frame which just finished, and resets them."""
+        self.frame_uploads = self.uploads
+        self.frame_skips = self.skips
+        self.uploads = 0
+        self.skips = 0
+
+
+# The uniform statistics of the whole program
+uniform_stats = UniformStats()
+
 
 class Uniform:
     '''
     We create a simple class to handle uniforms, this is not necessary,
-    but allow to put all relevant code in one place
+    but allow to put all relevant code in one place.
+    Values are only uploaded when they differ from the value the program
+    last received at the uniform's location, and are passed to OpenGL by
+    pointer (glm.value_ptr) rather than copied into new arrays.
     '''
     def __init__(self, name, value=None):
         '''
@@ -23,25 +58,72 @@ class Uniform:
         self.value = value
         self.location = -1
 
+        # Location => last value uploaded, for every uniform of the program
+        # (shared with the program's other Uniform objects)
+        self.uploaded = {}
+
 
-    def link(self, program):
+    def link(self, program, uploaded=None):
         '''
         This function needs to be called after compiling the GLSL program to fetch the location of the uniform
         in the program from its name
         :param program: the GLSL program where the uniform is used
+        :param uploaded: the program's record of the last value uploaded to each location
         '''
         self.location = glGetUniformLocation(program=program, name=self.name)
         if self.location == -1:
             logger.warning(f"No uniform {self.name}")
+
+        if uploaded is not None:
+            self.uploaded = uploaded
+
+
+    def changed(self, value) -> bool:
+        """
+        Sets the value, and returns whether it needs uploading: it does if
+        the uniform exists and the program does not already have this value.
+        """
+        self.value = value
+        if self.location == -1:
+            return False
+
+        last = self.uploaded.get(self.location)
+        if type(last) is type(value) and last == value:
+            uniform_stats.skips += 1
+            return False
+
+        self.uploaded[self.location] = value
+        uniform_stats.uploads += 1
+        return True
+
+
+    def upload_mat4x4(self, data: np.ndarray):
+        """
+        Uploads 16 column-major floats (e.g. a row of the model registry) to
+        a 4x4 matrix uniform, unless they equal the last floats uploaded.
+        """
+        if self.location == -1:
+            return
+
+        # Models with separate transforms often have equal matrices
+        last = self.uploaded.get(self.location)
+        if isinstance(last, np.ndarray) and np.array_equal(last, data):
+            uniform_stats.skips += 1
+            return
+
+        self.uploaded[self.location] = data.copy()
+        uniform_stats.uploads += 1
+        glUniformMatrix4fv(self.location, 1, GL_FALSE, data)
     
     
     def bind_int(self, value: int):
         """Binds an integer uniform."""
-        if value is not None:
-            self.value = value
+        if value is None:
+            value = self.value
             
         try:
-            glUniform1i(self.location, self.value)
+            if self.changed(int(value)):
+                glUniform1i(self.location, self.value)
         except:
             logger.type_error("int", value)
             raise
@@ -49,11 +131,12 @@ class Uniform:
     
     def bind_float(self, value: float):
         """Binds a float uniform."""
-        if value is not None:
-            self.value = value
+        if value is None:
+            value = self.value
             
         try:
-            glUniform1f(self.location, self.value)
+            if self.changed(float(value)):
+                glUniform1f(self.location, self.value)
         except:
             logger.type_error("float", value)
             raise
@@ -61,65 +144,169 @@ class Uniform:
     
     def bind_vec3(self, value: glm.vec3):
         """Binds a 3D vector uniform."""
-        if value is not None:
-            self.value = value
+        if value is None:
+            value = self.value
         
-        data = np.array(self.value, "f")
         try:
-            glUniform3fv(self.location, 1, data)
+            # Copied, so later changes to value are not missed
+            if self.changed(glm.vec3(value)):
+                glUniform3fv(self.location, 1, glm.value_ptr(self.value))
         except:
-            logger.type_error("vec3", data)
+            logger.type_error("vec3", value)
             raise
     
     
     def bind_vec4(self, value: glm.vec4):
         """Binds a 4D vector uniform."""
-        if value is not None:
-            self.value = value
+        if value is None:
+            value = self.value
         
-        data = np.array(self.value, "f")
         try:
-            glUniform4fv(self.location, 1, data)
+            if self.changed(glm.vec4(value)):
+                glUniform4fv(self.location, 1, glm.value_ptr(self.value))
         except:
-            logger.type_error("vec4", data)
+            logger.type_error("vec4", value)
             raise
     
     
     def bind_mat3x3(self, value: glm.mat3x3, transpose=True):
-        """Binds a 3x3 matrix uniform."""
-        if value is not None:
-            self.value = value
+        """
+        Binds a 3x3 matrix uniform. glm matrices are column-major, so
+        transpose=True uploads them as they are.
+        """
+        if value is None:
+            value = self.value
         
-        data = np.array(self.value, "f")
         try:
-            glUniformMatrix3fv(self.location, 1, transpose, data)
+            if self.changed(glm.mat3(value)):
+                glUniformMatrix3fv(self.location, 1, not transpose, glm.value_ptr(self.value))
         except:
-            logger.type_error("mat3x3", data)
+            logger.type_error("mat3x3", value)
             raise
     
     
     def bind_mat4x4(self, value, transpose=True):
-        """Binds a 4x4 matrix uniform."""
-        if value is not None:
-            self.value = value
-                
-        data = np.array(self.value, "f")
+        """
+        Binds a 4x4 matrix uniform. glm matrices are column-major, so
+        transpose=True uploads them as they are.
+        """
+        if value is None:
+            value = self.value
+        
         try:
-            glUniformMatrix4fv(self.location, 1, transpose, data)
+            if self.changed(glm.mat4(value)):
+                glUniformMatrix4fv(self.location, 1, not transpose, glm.value_ptr(self.value))
         except:
-            logger.type_error("mat4x4", data)
+            logger.type_error("mat4x4", value)
             raise
 
 
+class LinkedProgram:
+    """
+    A compiled and linked GLSL program. Every shader object with the same
+    name and source code uses the same one.
+    """
+    def __init__(self, program):
+        self.program = program
+
+        # Version of the model matrix last uploaded to the program (see
+        # BaseShaderProgram.bind_model_matrices and transform.py). This belongs to the program rather
+        # than a shader object, as any shader object using the program may
+        # have uploaded it.
+        self.M_version = None
+
+        # Location => value last uploaded to it (see Uniform)
+        self.uniform_values = {}
+
+
+class ProgramCache:
+    """Compiles and links each distinct shader program once."""
+    def __init__(self):
+        # (vertex source, fragment source) => LinkedProgram. Shaders with
+        # different names but the same source (e.g. phong and blinn, which
+        # differ only by a uniform) share a program.
+        self.programs: dict[tuple, LinkedProgram] = {}
+
+        self.requests = 0
+        self.compile_time = 0.0
+
+
+    def get(self, name, vertex_shader_source, fragment_shader_source) -> LinkedProgram:
+        """
+        Returns the linked program for a source, compiling it if necessary.
+        :param name: The name of the shader, for logging.
+        """
+        self.requests += 1
+
+        key = (vertex_shader_source, fragment_shader_source)
+        if key not in self.programs:
+            time_start = time.perf_counter()
+            program = ProgramCache.link(name, vertex_shader_source, fragment_shader_source)
+            self.compile_time += time.perf_counter() - time_start
+
+            self.programs[key] = LinkedProgram(program)
+
+        return self.programs[key]
+
+
+    @staticmethod
+    def link(name, vertex_shader_source, fragment_shader_source):
+        """Compiles and links a program from the source of its shaders."""
+        logger.info(f"Compiling {name} shaders...")
+        
+        try:
+            shader_vert = shaders.compileShader(vertex_shader_source, shaders.GL_VERTEX_SHADER)
+            shader_frag = shaders.compileShader(fragment_shader_source, shaders.GL_FRAGMENT_SHADER)
+            
+            program = glCreateProgram()
+            glAttachShader(program, shader_vert)
+            glAttachShader(program, shader_frag)
+        except RuntimeError as error:
+            logger.error(f"An error occured while compiling {name} shader:")
+            raise error
+
+        glLinkProgram(program)
+
+        # Read camera and light data from the frame uniform buffer
+        FrameUniforms.bind_block(program)
+
+        # Shader info logs
+        log = glGetShaderInfoLog(shader_frag)
+        logger.info(log)
+
+        log = glGetShaderInfoLog(shader_vert)
+        logger.info(log)
+
+        log = glGetProgramInfoLog(program)
+        logger.info(log)
+
+        return program
+
+
+    def print_report(self) -> None:
+        """Prints the number of live programs against the number of requests."""
+        print(f"Shader programs: {len(self.programs)} linked for {self.requests} "
+              f"request(s), in {self.compile_time:.3f}s")
+
+
+# The program cache shared by the whole program
+program_cache = ProgramCache()
+
+
 class BaseShaderProgram:
     '''
     This is the base class for loading and compiling the GLSL shaders.
     '''
-    def __init__(self, name=None, vertex_shader=None, fragment_shader=None):
+    def __init__(self, name=None, vertex_shader=None, fragment_shader=None, instanced=False,
+                 indirect=False):
         '''
         Initialises the shaders
         :param vertex_shader: the name of the file containing the vertex shader GLSL code
         :param fragment_shader: the name of the file containing the fragment shader GLSL code
+        :param instanced: compile the shaders with INSTANCED defined, so they read per-instance
+        transforms and tints from the instance buffer (see instancing.py)
+        :param indirect: compile the shaders with INDIRECT defined, so they read per-draw model
+        matrices and materials from the draw data of a multi-draw (see indirect.py)
         '''
 
         self.name = name
@@ -150,9 +337,31 @@ class BaseShaderProgram:
             with open(fragment_shader_file, 'r') as file:
                 self.fragment_shader_source = file.read()
 
+        # The instanced variant is the same source, with INSTANCED defined
+        # after the #version line (which must come first)
+        self.instanced = instanced
+        if instanced:
+            self.vertex_shader_source = BaseShaderProgram.define(self.vertex_shader_source, "INSTANCED")
+            self.fragment_shader_source = BaseShaderProgram.define(self.fragment_shader_source, "INSTANCED")
+
+        # The multi-draw variant needs storage buffers and gl_DrawIDARB
+        self.indirect = indirect
+        if indirect:
+            self.vertex_shader_source = BaseShaderProgram.define(
+                self.vertex_shader_source, "INDIRECT", version=INDIRECT_GLSL_VERSION,
+                extension=INDIRECT_GLSL_EXTENSION)
+            self.fragment_shader_source = BaseShaderProgram.define(
+                self.fragment_shader_source, "INDIRECT", version=INDIRECT_GLSL_VERSION)
+
+        # The linked program, from the program cache, once compiled
+        self.linked = None
+        self.program = None
+
         # in order to simplify extension of the class in the future, we start storing uniforms in a dictionary.
+        # Camera and light data are in the frame uniform buffer (see frame_uniforms.py),
+        # so only per-model data is stored here.
         self.uniforms = {
-            "PVM": Uniform("PVM"),
+            "M": Uniform("M"),
         }
 
 
@@ -160,42 +369,53 @@ class BaseShaderProgram:
         self.uniforms[name] = Uniform(name)
 
 
+    @staticmethod
+    def define(source: str, macro: str, version=None, extension=None) -> str:
+        """
+        Returns GLSL source with a macro defined after its #version line.
+        :param version: [optional] A version to replace the source's with.
+        :param extension: [optional] An extension to require.
+        """
+        version_line, rest = source.split("\n", 1)
+        if version is not None:
+            version_line = f"#version {version}"
+        if extension is not None:
+            version_line += f"\n#extension {extension} : require"
+        return f"{version_line}\n#define {macro}\n{rest}"
+
+
     def compile(self):
         '''
-        Call this function to compile the GLSL codes for both shaders.
+        Call this function to compile the GLSL codes for both shaders. The
+        program is taken from the program cache if the same shaders have
+        already been compiled, and nothing is done if this object is already
+        compiled.
         :return:
         '''
-        logger.info(f"Compiling {self.name} shaders...")
+        if self.linked is not None:
+            return
         
-        try:
-            shader_vert = shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER)
-            shader_frag = shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER)
-            
-            self.program = glCreateProgram()
-            glAttachShader(self.program, shader_vert)
-            glAttachShader(self.program, shader_frag)
-        except RuntimeError as error:
-            logger.error(f"An error occured while compiling {self.name} shader:")
-            raise error
-
-        glLinkProgram(self.program)
-
-        # Shader info logs
-        log = glGetShaderInfoLog(shader_frag)
-        logger.info(log)
-
-        log = glGetShaderInfoLog(shader_vert)
-        logger.info(log)
-
-        log = glGetProgramInfoLog(self.program)
-        logger.info(log)
+        self.linked = program_cache.get(self.name, self.vertex_shader_source,
+                                        self.fragment_shader_source)
+        self.program = self.linked.program
 
         # tell OpenGL to use this shader program for rendering
         glUseProgram(self.program)
 
         # link all uniforms
         for uniform in self.uniforms:
-            self.uniforms[uniform].link(self.program)
+            self.uniforms[uniform].link(self.program, self.linked.uniform_values)
+    
+    
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def shared(cls, *args, **kwargs):
+        """
+        Returns one instance of a shader class for each set of arguments, so
+        models with the same kind of shader share it (and its per-program
+        state) rather than each making their own.
+        """
+        return cls(*args, **kwargs)
 
 
     def bind(self, model, M):
@@ -205,37 +425,40 @@ class BaseShaderProgram:
         # tell OpenGL to use this shader program for rendering
         glUseProgram(self.program)
 
-        P = model.scene.P
-        V = model.scene.camera.V
+        self.uniforms["M"].bind_mat4x4(M)
 
-        self.uniforms["PVM"].bind_mat4x4(glm.mul(P, glm.mul(V, M)))
+
+    def bind_model_matrices(self, model):
+        """
+        Uploads a model's M and M_it from its row of the model registry,
+        unless the program already has that version of them.
+        """
+        if model.slot in model_registry.pending:
+            model_registry.update()
+
+        version = model_registry.versions[model.slot]
+        if self.linked.M_version != version:
+            self.linked.M_version = version
+            row = model_registry.uniforms[model.slot]
+            self.uniforms["M"].upload_mat4x4(row[:16])
+            self.uniforms["M_it"].upload_mat4x4(row[16:])
 
 
 class Shader(BaseShaderProgram):
-    def __init__(self, name: str):
+    def __init__(self, name: str, instanced=False, indirect=False):
         '''
         Initialises the shaders
         :param vertex_shader: the name of the file containing the vertex shader GLSL code
         :param fragment_shader: the name of the file containing the fragment shader GLSL code
         '''
 
-        super().__init__(name=name)
-        
-        # Store temp values so that the inverse matrix doesn't need to be
-        # calculated when these haven't changed
-        self.P = None
-        self.V = None
-        self.M = None
+        super().__init__(name=name, instanced=instanced, indirect=indirect)
 
         # in order to simplify extension of the class in the future, we start storing uniforms in a dictionary.
         self.uniforms = {
             "M": Uniform("M"),
-            "V_t": Uniform("V_t"),
-            "PV": Uniform("PV"),
-            "VM": Uniform("VM"),
             "M_it": Uniform("M_it"),
-            "VM_it": Uniform("VM_it"),
-            "PVM": Uniform("PVM"),
+            "position_transform": Uniform("position_transform"),
             'mode': Uniform('mode', 0),  # rendering mode (only for illustration, in general you will want one shader program per mode)
             'alpha': Uniform('alpha', 0),
             'Ka': Uniform('Ka'),
@@ -243,10 +466,6 @@ class Shader(BaseShaderProgram):
             'Ks': Uniform('Ks'),
             'Ns': Uniform('Ns'),
             "tex_scale": Uniform("tex_scale"),
-            'light_pos': Uniform('light_pos', glm.vec3(0.,0.,0.)),
-            'Ia': Uniform('Ia'),
-            'Id': Uniform('Id'),
-            'Is': Uniform('Is'),
             'has_texture': Uniform('has_texture'),
             'texture_object': Uniform('texture_object')
             #'textureObject2': Uniform('textureObject2'),
@@ -260,54 +479,13 @@ class Shader(BaseShaderProgram):
         # tell OpenGL to use this shader program for rendering
         glUseProgram(self.program)
 
-        recalculate_P = False
-        recalculate_V = False
-        recalculate_M = False
-        
-        # Scene's projection matrix
-        _P = model.scene.P
-        if self.P != _P:
-            self.P = _P
-            recalculate_P = True
-        
-        # Camera's view matrix
-        _V = model.scene.camera.V
-        if self.V != _V:
-            self.V = _V
-            recalculate_V = True
-        
-        # Model matrix
-        if self.M != M:
-            self.M = M
-            recalculate_M = True
-        
-        # Only recalculates matrices if necessary - allows faster
-        # frame times when camera is not moving, and environment and shadow
-        # maps are disabled.
-        
-        # Binds the following calculations to shader uniforms.
-        if recalculate_M:
-            self.uniforms["M"].bind_mat4x4(M)
-        
-        if recalculate_V:
-            self.uniforms["V_t"].bind_mat4x4(glm.transpose(_V))
-        
-        if recalculate_P or recalculate_V:
-            self.uniforms["PV"].bind_mat4x4(glm.mul(_P, _V))
-
-        if recalculate_V or recalculate_M:
-            VM = glm.mul(_V, M)
-            self.uniforms["VM"].bind_mat4x4(VM)
-            
-            M_it = glm.inverseTranspose(M)
-            self.uniforms["M_it"].bind_mat4x4(M_it)
-            
-            VM_it = glm.inverseTranspose(VM)
-            self.uniforms["VM_it"].bind_mat4x4(VM_it)
-
+        # The camera and light are in the frame uniform buffer, so only the
+        # model matrix and its inverse transpose (for normals) are bound,
+        # from the model's precomputed row of the model registry.
+        self.bind_model_matrices(model)
 
-        if recalculate_P or recalculate_M or recalculate_V:
-            self.uniforms["PVM"].bind_mat4x4(glm.mul(_P, glm.mul(_V, M)))
+        # Dequantisation of the model's positions, if they are compact
+        self.uniforms["position_transform"].bind_mat4x4(model.buffers.position_transform)
 
         # bind the mode to the program
         self.uniforms['mode'].bind_int(model.scene.mode)
@@ -323,17 +501,6 @@ class Shader(BaseShaderProgram):
         # bind material properties
         self.bind_material_uniforms(model.mesh.material)
 
-        # bind the light properties
-        self.bind_light_uniforms(model.scene.light, self.V)
-
-    def bind_light_uniforms(self, light, V):
-        """Binds all relevant uniforms for a light to the shader."""
-        light_pos_homog = glm.vec4(light.position, 1)
-        self.uniforms['light_pos'].bind_vec3(glm.mul(V, light_pos_homog).xyz)
-        self.uniforms['Ia'].bind_vec3(light.Ia)
-        self.uniforms['Id'].bind_vec3(light.Id)
-        self.uniforms['Is'].bind_vec3(light.Is)
-
     def bind_material_uniforms(self, material):
         """Binds all relevant uniforms for a material to the shader."""
         self.uniforms['Ka'].bind_vec3(material.Ka)
@@ -355,14 +522,14 @@ class PhongShader(Shader):
     """
     A shader which can use Phong or Blinn-Phong shading based on parameters.
     """
-    def __init__(self, blinn, name=None):
+    def __init__(self, blinn, name=None, instanced=False, indirect=False):
         if name is None:
             if blinn:
                 name = "blinn"
             else:
                 name = "phong"
         
-        super().__init__(name)
+        super().__init__(name, instanced=instanced, indirect=indirect)
         self.add_uniform("blinn")
         
         self.blinn = blinn
@@ -381,13 +548,12 @@ class EnvironmentShader(BaseShaderProgram):
     """
     A shader for environment mapping.
     """
-    def __init__(self, env_map=None):
-        super().__init__(name="environment")
+    def __init__(self, env_map=None, instanced=False):
+        super().__init__(name="environment", instanced=instanced)
         self.add_uniform('sampler_cube')
-        self.add_uniform('VM')
-        self.add_uniform('VM_it')
-        self.add_uniform('V_t')
+        self.add_uniform('M_it')
         self.add_uniform("alpha")
+        self.add_uniform("position_transform")
 
         self.map = env_map
 
@@ -402,25 +568,19 @@ class EnvironmentShader(BaseShaderProgram):
         
         self.uniforms['sampler_cube'].bind_int(0)
 
-        P = model.scene.P  # get projection matrix from the scene
-        V = model.scene.camera.V
-
-        # set the PVM matrix uniform
-        self.uniforms['PVM'].bind_mat4x4(glm.mul(P, glm.mul(V, M)))
-        self.uniforms['VM'].bind_mat4x4(glm.mul(V, M))
-        self.uniforms['VM_it'].bind_mat4x4(glm.inverseTranspose(glm.mul(V, M)))
-        self.uniforms['V_t'].bind_mat4x4(glm.transpose(V))
+        # set the model matrix uniforms (the camera is in the frame uniform buffer)
+        self.bind_model_matrices(model)
         self.uniforms['alpha'].bind_float(model.mesh.material.d)
+        self.uniforms["position_transform"].bind_mat4x4(model.buffers.position_transform)
 
 
 class ShadowMappingShader(PhongShader):
     """
     A shader for shadow mapping combined with Phong/Blinn-Phong shading.
     """
-    def __init__(self, shadow_map=None):
-        super().__init__(blinn=True, name='shadow_mapping')
+    def __init__(self, shadow_map=None, instanced=False, indirect=False):
+        super().__init__(blinn=True, name='shadow_mapping', instanced=instanced, indirect=indirect)
         self.add_uniform('shadow_map')
-        self.add_uniform('light_PV')
         
         self.shadow_map = shadow_map
 
@@ -433,16 +593,3 @@ class ShadowMappingShader(PhongShader):
         glActiveTexture(GL_TEXTURE1)
         self.shadow_map.bind()
         glActiveTexture(GL_TEXTURE0)
-        
-        V = model.scene.camera.V
-        V_i = glm.inverse(V)
-
-        # Clip coordinates = P_s V_s V_vi
-        # Range is [-1, 1]
-        # Translate to move it to [0, 2]
-        # Scale it by 1/2 to move it to [0, 1]
-        light_PV = glm.scale(glm.vec3(0.5,0.5,0.5))\
-                * glm.translate(glm.vec3(1,1,1))\
-                * self.shadow_map.P * self.shadow_map.V * V_i
-                
-        self.uniforms["light_PV"].bind_mat4x4(light_PV)
\ No newline at end of file
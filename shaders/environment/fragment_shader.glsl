@@ -1,13 +1,29 @@
-#version 130
+#version 330 core
 
 in vec3 normal_view_space;
 in vec3 position_view_space;
 in vec3 fragment_tex_coord;
+
+#ifdef INSTANCED
+in vec4 fragment_tint; // multiplies the surface colour of each instance
+#endif
 out vec4 final_color;
 
 uniform float alpha;
 uniform samplerCube sampler_cube;
-uniform mat4 V_t;
+// Frame-global data, shared by every program (see frame_uniforms.py)
+layout (std140) uniform FrameUniforms {
+    mat4 P;
+    mat4 V;
+    mat4 PV;
+    mat4 V_t;
+    mat4 V_inverse;
+    mat4 light_PV;   // view space => shadow map texture coordinates
+    vec3 light_pos;  // in view space
+    vec3 Ia;
+    vec3 Id;
+    vec3 Is;
+};
 
 void main(void)
 {
@@ -15,5 +31,8 @@ void main(void)
     vec3 R = (V_t * vec4(reflect(I, normalize(normal_view_space)), 1.0f)).xyz;
     
     vec4 color = vec4(texture(sampler_cube, R).rgb, alpha);
+#ifdef INSTANCED
+    color *= fragment_tint;
+#endif
     final_color = color;
 }
@@ -1,24 +1,58 @@
 #version 460 core
 
 //=== in attributes are read from the vertex array, one row per instance of the shader
-in vec3 position;	// the position attribute contains the vertex position
-in vec3 normal;		// store the vertex normal
+layout (location = 0) in vec3 position;	// the position attribute contains the vertex position
+layout (location = 1) in vec3 normal;		// store the vertex normal
 
 //=== out attributes are interpolated on the face, and passed on to the fragment shader
 out vec3 position_view_space;   // the position of the vertex in view coordinates
 out vec3 normal_view_space;     // the normal of the vertex in view coordinates
 out vec3 fragment_tex_coord;
 
-uniform mat4 PVM;
-uniform mat4 VM;
-uniform mat4 VM_it; // V * transpose(inverse(M))
+// Frame-global data, shared by every program (see frame_uniforms.py)
+layout (std140) uniform FrameUniforms {
+    mat4 P;
+    mat4 V;
+    mat4 PV;
+    mat4 V_t;
+    mat4 V_inverse;
+    mat4 light_PV;   // view space => shadow map texture coordinates
+    vec3 light_pos;  // in view space
+    vec3 Ia;
+    vec3 Id;
+    vec3 Is;
+};
+
+uniform mat4 M;
+uniform mat4 M_it; // transpose(inverse(M))
+uniform mat4 position_transform; // dequantises compact positions (identity otherwise)
 uniform int mode;	// the rendering mode (better to code different shaders!)
 
+#ifdef INSTANCED
+// Per-instance data, from the instance buffer (see instancing.py)
+layout (location = 4) in mat4 instance_M;
+layout (location = 8) in mat4 instance_M_it;
+layout (location = 12) in vec4 instance_tint;
+out vec4 fragment_tint;
+#endif
+
 void main(void)
 {
-    gl_Position = PVM * vec4(position, 1.0f);
-    position_view_space = vec3(VM * vec4(position, 1.0f) );
+    vec4 model_position = position_transform * vec4(position, 1.0f);
+    mat4 model_M = M;
+    mat4 model_M_it = M_it;
+#ifdef INSTANCED
+    // Each instance is placed relative to the model
+    model_M = M * instance_M;
+    model_M_it = M_it * instance_M_it;
+    fragment_tint = instance_tint;
+#endif
+    mat4 VM = V * model_M;
+    mat4 VM_it = transpose(V_inverse) * model_M_it;
+
+    gl_Position = P * VM * model_position;
+    position_view_space = vec3(VM * model_position);
     normal_view_space = normalize(VM_it * vec4(normal, 1.0f)).xyz;
 	//fragment_tex_coord = normalize(-VM_it * vec4(position, 1.0f)).xyz;
-	fragment_tex_coord = reflect(-normalize(position), normal);
+	fragment_tex_coord = reflect(-normalize(model_position.xyz), normal);
 }
@@ -5,6 +5,14 @@ in vec3 fragment_normal;
 in vec3 fragment_pos; // View coordinates position of this fragment
 in vec2 fragment_tex_coord;
 
+#ifdef INDIRECT
+flat in int draw_id;
+#endif
+
+#ifdef INSTANCED
+in vec4 fragment_tint; // multiplies the surface colour of each instance
+#endif
+
 //=== 'out' attributes are the output image, usually only one for the colour of each pixel
 out vec4 final_color;
 
@@ -16,30 +24,75 @@ uniform int has_texture;
 // Texture Sampler
 uniform sampler2D texture_object; // first texture object
 
-// Material properties
+// Material properties, and texture scaling in blender
+#ifdef INDIRECT
+// The draw's material, read from the draw data at the start of main
+vec3 Ka;
+vec3 Kd;
+vec3 Ks;
+float Ns;
+vec3 tex_scale;
+float alpha;
+#else
 uniform vec3 Ka;
 uniform vec3 Kd;
 uniform vec3 Ks;
 uniform float Ns;
-
-// Texture scaling in blender
 uniform vec3 tex_scale;
+uniform float alpha;
+#endif
 
 // light source
-uniform vec3 light_pos;
-uniform vec3 Ia;
-uniform vec3 Id;
-uniform vec3 Is;
+// Frame-global data, shared by every program (see frame_uniforms.py)
+layout (std140) uniform FrameUniforms {
+    mat4 P;
+    mat4 V;
+    mat4 PV;
+    mat4 V_t;
+    mat4 V_inverse;
+    mat4 light_PV;   // view space => shadow map texture coordinates
+    vec3 light_pos;  // in view space
+    vec3 Ia;
+    vec3 Id;
+    vec3 Is;
+};
 
-uniform float alpha;
 uniform int blinn;
 
+#ifdef INDIRECT
+// Per-draw data of a multi-draw, indexed by gl_DrawID (see indirect.py)
+struct DrawData {
+    mat4 M;
+    mat4 M_it;
+    vec4 Ka;
+    vec4 Kd;
+    vec4 Ks;
+    vec4 tex_scale;
+    vec4 material;   // Ns, alpha
+};
+
+layout (std430, binding = 1) readonly buffer DrawBuffer {
+    DrawData draws[];
+};
+#endif
+
 
 ///=== main shader code
 void main() {    
+#ifdef INDIRECT
+    Ka = draws[draw_id].Ka.xyz;
+    Kd = draws[draw_id].Kd.xyz;
+    Ks = draws[draw_id].Ks.xyz;
+    Ns = draws[draw_id].material.x;
+    alpha = draws[draw_id].material.y;
+    tex_scale = draws[draw_id].tex_scale.xyz;
+#endif
     vec4 texval = vec4(1.0f);
     if(has_texture == 1)
-        texval = texture2D(texture_object, fragment_tex_coord * tex_scale.xy);
+        texval = texture(texture_object, fragment_tex_coord * tex_scale.xy);
+#ifdef INSTANCED
+    texval *= fragment_tint;
+#endif
     
     vec3 normal = normalize(fragment_normal);
     vec3 light_dir = normalize(light_pos - fragment_pos);
@@ -10,15 +10,75 @@ out vec3 fragment_normal;     // the normal of the vertex in view coordinates
 out vec2 fragment_tex_coord;
 out vec4 fragment_pos_lightPV;
 
-uniform mat4 PVM;
-uniform mat4 VM;
-uniform mat4 VM_it;
-uniform mat4 light_PV;
+// Frame-global data, shared by every program (see frame_uniforms.py)
+layout (std140) uniform FrameUniforms {
+    mat4 P;
+    mat4 V;
+    mat4 PV;
+    mat4 V_t;
+    mat4 V_inverse;
+    mat4 light_PV;   // view space => shadow map texture coordinates
+    vec3 light_pos;  // in view space
+    vec3 Ia;
+    vec3 Id;
+    vec3 Is;
+};
+
+uniform mat4 M;
+uniform mat4 M_it;
+uniform mat4 position_transform; // dequantises compact positions (identity otherwise)
+
+#ifdef INDIRECT
+// Per-draw data of a multi-draw, indexed by gl_DrawID (see indirect.py)
+struct DrawData {
+    mat4 M;
+    mat4 M_it;
+    vec4 Ka;
+    vec4 Kd;
+    vec4 Ks;
+    vec4 tex_scale;
+    vec4 material;   // Ns, alpha
+};
+
+layout (std430, binding = 1) readonly buffer DrawBuffer {
+    DrawData draws[];
+};
+#endif
+
+#ifdef INDIRECT
+flat out int draw_id;
+#endif
+
+#ifdef INSTANCED
+// Per-instance data, from the instance buffer (see instancing.py)
+layout (location = 4) in mat4 instance_M;
+layout (location = 8) in mat4 instance_M_it;
+layout (location = 12) in vec4 instance_tint;
+out vec4 fragment_tint;
+#endif
 
 
 void main() {
-	gl_Position = PVM * vec4(position, 1.0f);
-    fragment_pos = vec3(VM * vec4(position, 1.0f));
+    vec4 model_position = position_transform * vec4(position, 1.0f);
+    mat4 model_M = M;
+    mat4 model_M_it = M_it;
+#ifdef INDIRECT
+    // Each draw of a multi-draw has its own model matrix
+    draw_id = gl_DrawIDARB;
+    model_M = draws[draw_id].M;
+    model_M_it = draws[draw_id].M_it;
+#endif
+#ifdef INSTANCED
+    // Each instance is placed relative to the model
+    model_M = M * instance_M;
+    model_M_it = M_it * instance_M_it;
+    fragment_tint = instance_tint;
+#endif
+    mat4 VM = V * model_M;
+    mat4 VM_it = transpose(V_inverse) * model_M_it;
+
+	gl_Position = P * VM * model_position;
+    fragment_pos = vec3(VM * model_position);
     fragment_normal = vec3(VM_it * normalize(vec4(normal, 1.0f)));
     fragment_tex_coord = tex_coord;
     fragment_pos_lightPV = light_PV * vec4(fragment_pos, 1.0f);
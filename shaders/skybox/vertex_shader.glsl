@@ -6,11 +6,25 @@ layout (location = 0) in vec3 position;
 //=== out attributes are interpolated on the face, and passed on to the fragment shader
 out vec3 fragment_tex_coord;
 
-uniform mat4 PVM;
+// Frame-global data, shared by every program (see frame_uniforms.py)
+layout (std140) uniform FrameUniforms {
+    mat4 P;
+    mat4 V;
+    mat4 PV;
+    mat4 V_t;
+    mat4 V_inverse;
+    mat4 light_PV;   // view space => shadow map texture coordinates
+    vec3 light_pos;  // in view space
+    vec3 Ia;
+    vec3 Id;
+    vec3 Is;
+};
+
+uniform mat4 M;
 
 void main(void)
 {
-	gl_Position = PVM * vec4(position, 1);
+	gl_Position = PV * M * vec4(position, 1);
 	gl_Position.z = gl_Position.w * 0.999;
 	fragment_tex_coord = -position;
 }
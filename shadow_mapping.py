@@ -44,6 +44,9 @@ class ShadowMap(Texture):
 
         self.V = None
 
+        # Shadows are low resolution, so models are drawn with coarser LODs
+        self.lod_bias = 0.5
+
 
     def render(self, scene):
         if self.light is not None:
@@ -53,9 +56,12 @@ class ShadowMap(Texture):
             self.P = glm.frustum(-1, +1, -1.4, +1.1, 1.5, 775)
             self.V = glm.lookAt(self.light.position, glm.vec3(), glm.vec3(0,1,0))
             
-            # Store and set camera view matrix
+            # Store and set camera view matrix and LOD bias
             Vscene = scene.camera.V
             scene.camera.V = self.V
+            bias_scene = scene.lod_bias
+            scene.lod_bias = self.lod_bias
+            scene.update_frame_uniforms()
             
             # Render shadows to shadow map
             glViewport(0, 0, self.width, self.height)
@@ -63,6 +69,7 @@ class ShadowMap(Texture):
             scene.draw_shadow_map()
             self.fbo.unbind()
 
-            # Revert viewport and camera view matrix
+            # Revert viewport, camera view matrix and LOD bias
             glViewport(0, 0, scene.window_size[0], scene.window_size[1])
-            scene.camera.V = Vscene
\ No newline at end of file
+            scene.camera.V = Vscene
+            scene.lod_bias = bias_scene
\ No newline at end of file
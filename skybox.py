@@ -13,11 +13,8 @@ class SkyBoxShader(BaseShaderProgram):
         self.add_uniform('sampler_cube')
 
     def bind(self, model, M):
+        # The camera is in the frame uniform buffer, so only M is bound
         super().bind(model, M)
-        P = model.scene.P  # get projection matrix from the scene
-        V = model.scene.camera.V  # get view matrix from the camera
-
-        self.uniforms['PVM'].bind_mat4x4(glm.mul(P, glm.mul(V, M)))
 
 
 class SkyBox(DrawModelFromMesh):
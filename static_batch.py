@@ -0,0 +1,172 @@
+import ctypes
+import json
+
+from OpenGL.GL import *
+
+import numpy as np
+
+from mesh import Mesh
+from mesh_cache import MeshCache
+from model import Model
+from model_registry import model_registry, ModelRegistry
+from log import Logger
+
+'''
+Static batching: models which never move, and which share a model matrix,
+shaders and material, are merged into one StaticBatch at load time. The
+batch has one range of vertices and one range of indices (in the buffer
+pool) holding every member's mesh, so the members are drawn with one shader
+bind, one vao bind and (while they are all visible) one draw call.
+
+The faces of each level of detail are stored member after member, so the
+members of a level occupy consecutive sub-ranges of the index buffer:
+
+    level 0:  [member 0][member 1][member 2]...
+    level 1:  [member 0][member 1][member 2]...
+
+Each member is still a model, whose visible flag is honoured: hidden members
+split the level into runs of visible members, each drawn from its sub-range.
+
+The batch chooses its level of detail from the bounding sphere of every
+member together, rather than each member's own.
+'''
+
+logger = Logger(False, True, True)
+
+# Per-vertex arrays merged into the batch's mesh
+VERTEX_ARRAYS = ["vertices", "normals", "colors", "textureCoords"]
+
+
+class StaticBatch(Model):
+    def __init__(self, scene, models: list):
+        """
+        Merges the meshes of static models, which must have the same key
+        (see StaticBatch.key), into one model.
+        :param models: The models to draw, created with static=True.
+        """
+        self.members = models
+        self.member_slots = ModelRegistry.slots(models)
+
+        mesh, self.member_ranges = StaticBatch.merge([model.mesh for model in models])
+
+        first = models[0]
+        super().__init__(scene=scene, M=first.M, mesh=mesh, primitive=first.primitive,
+                         compact=first.compact)
+        if len(models) > 1:
+            self.name = f"{first.name} ({len(models)} meshes)"
+
+        # Members' shaders are shared, so the batch uses the same ones
+        self.shaders = dict(first.shaders)
+        self.shader = first.shader
+
+        self.bind()
+
+
+    @staticmethod
+    def key(model) -> tuple:
+        """
+        Returns the properties which models must share to be batched together:
+        their model matrix, shaders, material and vertex attributes.
+        """
+        mesh = model.mesh
+        return (
+            tuple(float(x) for column in model.M for x in column),
+            tuple(sorted((name, id(shader)) for name, shader in model.shaders.items())),
+            json.dumps(MeshCache.material_to_record(mesh.material), sort_keys=True),
+            tuple(getattr(mesh, name) is not None for name in VERTEX_ARRAYS),
+            mesh.faces.shape[1],
+            model.compact
+        )
+
+
+    @staticmethod
+    def merge(meshes: list) -> tuple:
+        """
+        Merges meshes into one, with their LODs (if any).
+        :return: the merged mesh, and a (levels, meshes, 2) array of the
+        [first, count] index range of each mesh in each level, relative to
+        the start of the level.
+        """
+        vertex_offsets = np.cumsum([0] + [mesh.vertices.shape[0] for mesh in meshes[:-1]])
+
+        def stack(name):
+            arrays = [getattr(mesh, name) for mesh in meshes]
+            if arrays[0] is None:
+                return None
+            return np.concatenate(arrays)
+
+        level_count = 1 + max(0 if mesh.lod_ranges is None else len(mesh.lod_ranges)
+                              for mesh in meshes)
+
+        levels = []
+        ranges = np.zeros((level_count, len(meshes), 2), dtype=np.int64)
+        for level in range(level_count):
+            faces = [np.asarray(StaticBatch.level_faces(mesh, level), dtype=np.int64) + offset
+                     for mesh, offset in zip(meshes, vertex_offsets)]
+
+            counts = np.array([f.size for f in faces], dtype=np.int64)
+            ranges[level, :, 0] = np.cumsum(counts) - counts
+            ranges[level, :, 1] = counts
+
+            levels.append(np.concatenate(faces).astype(np.uint32))
+
+        mesh = Mesh(vertices=stack("vertices"), faces=levels[0], normals=stack("normals"),
+                    textureCoords=stack("textureCoords"), material=meshes[0].material)
+        mesh.colors = stack("colors")
+        mesh.name = meshes[0].name
+
+        if level_count > 1:
+            mesh.lod_faces = np.concatenate(levels[1:])
+            counts = [level.shape[0] for level in levels[1:]]
+            mesh.lod_ranges = np.array([[sum(counts[:i]), count] for i, count in enumerate(counts)],
+                                       dtype=np.int64)
+
+        return mesh, ranges
+
+
+    @staticmethod
+    def level_faces(mesh, level: int) -> np.ndarray:
+        """
+        Returns the faces of a mesh's level of detail, or its coarsest level
+        if it has fewer. Meshes without LODs return their full faces.
+        """
+        if level == 0 or mesh.lod_ranges is None:
+            return mesh.faces
+
+        first, count = mesh.lod_ranges[min(level, len(mesh.lod_ranges)) - 1]
+        return mesh.lod_faces[first:first + count]
+
+
+    def draw(self):
+        """Draws the visible members, if there are any."""
+        if not model_registry.visible[self.member_slots].any():
+            return
+
+        super().draw()
+
+
+    def draw_elements(self, level: int):
+        """
+        Draws the visible members of a level: with one call if they are all
+        visible, otherwise with one call per run of consecutive visible members.
+        """
+        visible = model_registry.visible[self.member_slots]
+        if visible.all():
+            super().draw_elements(level)
+            return
+
+        _, level_offset = self.buffers.index_ranges[level]
+        ranges = self.member_ranges[level]
+
+        # Runs start where visible goes from False to True, and end where it
+        # goes back to False
+        edges = np.diff(np.concatenate([[0], visible.astype(np.int8), [0]]))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+
+        for start, end in zip(starts, ends):
+            first = ranges[start, 0]
+            count = ranges[end - 1, 0] + ranges[end - 1, 1] - first
+            glDrawElementsBaseVertex(self.primitive, int(count), self.buffers.index_type,
+                ctypes.c_void_p(level_offset + int(first) * self.buffers.index_size),
+                self.buffers.base_vertex)
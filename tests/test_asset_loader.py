@@ -0,0 +1,47 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import pytest
+
+import asset_loader
+from asset_loader import AssetLoader, load_in_worker
+from blender import Obj
+from mesh_cache import MeshCache
+
+
+def test_load_obj_files_in_workers(tmp_path):
+    obj_files = ["models/quad_table.obj", "models/floor.obj"]
+    loader = AssetLoader(MeshCache(str(tmp_path)), processes=2)
+
+    meshes = loader.load_obj_files(obj_files)
+
+    for obj_file in obj_files:
+        expected = Obj(obj_file).load_obj_file()
+        assert len(meshes[obj_file]) == len(expected)
+        for mesh, expected_mesh in zip(meshes[obj_file], expected):
+            assert mesh.vertices.shape == expected_mesh.vertices.shape
+    assert set(loader.timings) == set(obj_files)
+
+
+def test_worker_error_unlinks_block(tmp_path, monkeypatch):
+    created = []
+
+    class RecordingSharedMemory(SharedMemory):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            created.append(self.name)
+
+    def fail(data, layout):
+        raise OSError("disk full")
+
+    # Fill the mesh cache first, so only the write to shared memory fails
+    MeshCache(str(tmp_path)).load_obj_file("models/quad_table.obj")
+    monkeypatch.setattr(asset_loader, "SharedMemory", RecordingSharedMemory)
+    monkeypatch.setattr(MeshCache, "write", staticmethod(fail))
+
+    with pytest.raises(OSError):
+        load_in_worker("models/quad_table.obj", str(tmp_path))
+
+    assert len(created) == 1
+    assert created[0] not in asset_loader._worker_blocks
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=created[0])
@@ -0,0 +1,105 @@
+import glob
+
+import numpy as np
+import pytest
+
+from blender import Obj, _VERTEX_LINE, _TEXTURE_LINE, _NORMAL_LINE, _FACE_LINE
+
+
+def parse_lines(lines, size):
+    """Parses vectors one line at a time, as the original loader did."""
+    return np.array([[float(field) for field in line.split()[:size]] for line in lines],
+                    dtype='f').reshape(-1, size)
+
+
+@pytest.mark.parametrize("obj_file", sorted(glob.glob("models/*.obj")))
+def test_parse_vectors_matches_line_by_line(obj_file):
+    with open(obj_file) as file:
+        text = file.read()
+
+    for pattern, size in ((_VERTEX_LINE, 3), (_TEXTURE_LINE, 2), (_NORMAL_LINE, 3)):
+        lines = pattern.findall(text)
+        np.testing.assert_array_equal(Obj.parse_vectors(lines, size), parse_lines(lines, size))
+
+
+def test_parse_vectors_mixed_widths():
+    lines = ['0.1 0.2', '0.3 0.4 0.0 0.9']
+    np.testing.assert_array_equal(Obj.parse_vectors(lines, 2), parse_lines(lines, 2))
+
+    lines = ['0.1 0.2 0.0', '0.3 0.4', '0.5 0.6', '0.7 0.8 0.0']
+    np.testing.assert_array_equal(Obj.parse_vectors(lines, 2), parse_lines(lines, 2))
+
+
+def test_parse_vectors_extra_field():
+    lines = ['0.1 0.2 0.0', '0.3 0.4 0.0']
+    np.testing.assert_array_equal(Obj.parse_vectors(lines, 2),
+                                  np.array([[0.1, 0.2], [0.3, 0.4]], dtype='f'))
+
+
+def parse_corners(lines):
+    """Parses face corners one at a time, padding each to v/vt/vn."""
+    rows = []
+    for line in lines:
+        for corner in line.split():
+            fields = corner.split('/')
+            rows.append([int(field or 0) for field in fields] + [0] * (3 - len(fields)))
+    return np.array(rows, dtype=np.uint32).reshape(-1, 3)
+
+
+@pytest.mark.parametrize("obj_file", sorted(glob.glob("models/*.obj")))
+def test_parse_faces_matches_corner_by_corner(obj_file):
+    with open(obj_file) as file:
+        lines = _FACE_LINE.findall(file.read())
+
+    corners, _ = Obj.parse_faces(lines)
+    np.testing.assert_array_equal(corners, parse_corners(lines))
+
+
+@pytest.mark.parametrize("lines", [
+    ['1/1 2 3/3/3'],
+    ['1 2 3', '4/4 5/5 6/6'],
+    ['1//1 2//2 3//3', '4/4 5/5 6/6'],
+    ['1/1/1 2/2/2 3/3/3', '4//4 5//5 6//6 7//7'],
+    ['1 2 3 4', '5/5/5 6/6/6 7/7/7'],
+], ids=["within a line", "v then v/vt", "v//vn then v/vt", "v/vt/vn then v//vn", "v then v/vt/vn"])
+def test_parse_faces_mixed_formats(lines):
+    corners, counts = Obj.parse_faces(lines)
+
+    np.testing.assert_array_equal(corners, parse_corners(lines))
+    np.testing.assert_array_equal(counts, [len(line.split()) for line in lines])
+
+
+
+# Vertices, then faces in three formats (with a material from models/).
+# Streamed 30 lines at a time, the second chunk starts at the v/vt face, and
+# has as many values as if every corner were v/vt.
+MIXED_FORMAT_OBJ = "".join(
+    ["mtllib quad_table.mtl\n", "usemtl Material.008\n"]
+    + [f"v {i} {i % 3} {i % 2}\n" for i in range(9)]
+    + [f"vt {i / 9} {i % 2}\n" for i in range(9)]
+    + ["vn 0 1 0\n"] * 9
+    + ["f 1 2 3\n", "f 1/1 2/2 3/3\n", "f 4 5 6\n", "f 7/7/7 8/8/8 9/9/9\n"])
+
+
+def assert_meshes_equal(meshes, expected):
+    assert len(meshes) == len(expected)
+    for mesh, expected_mesh in zip(meshes, expected):
+        for name in ("vertices", "faces", "textureCoords", "normals"):
+            np.testing.assert_array_equal(getattr(mesh, name), getattr(expected_mesh, name))
+
+
+@pytest.mark.parametrize("chunk_lines", [5, 30, 64, 16384])
+def test_stream_mixed_formats(chunk_lines, tmp_path):
+    obj_file = tmp_path / "mixed.obj"
+    obj_file.write_text(MIXED_FORMAT_OBJ)
+
+    meshes = list(Obj(str(obj_file)).stream_obj_file(chunk_lines=chunk_lines))
+    assert_meshes_equal(meshes, Obj(str(obj_file)).load_obj_file())
+
+
+@pytest.mark.parametrize("chunk_lines", [5, 64, 16384])
+def test_stream_quad_table(chunk_lines):
+    # quad_table.obj mixes v and v/vt corners, so a chunk may start with
+    # either format whatever the rest of it uses
+    meshes = list(Obj("models/quad_table.obj").stream_obj_file(chunk_lines=chunk_lines))
+    assert_meshes_equal(meshes, Obj("models/quad_table.obj").load_obj_file())
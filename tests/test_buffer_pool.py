@@ -0,0 +1,138 @@
+from buffer_pool import FreeListAllocator
+
+
+def test_allocate_first_fit():
+    allocator = FreeListAllocator(100)
+    a = allocator.allocate(30)
+    b = allocator.allocate(20)
+
+    assert (a.offset, a.size) == (0, 30)
+    assert (b.offset, b.size) == (30, 20)
+    assert allocator.free_ranges == [[50, 50]]
+    assert allocator.used() == 50
+
+
+def test_allocate_exact_fit_removes_range():
+    allocator = FreeListAllocator(40)
+    allocator.allocate(40)
+
+    assert allocator.free_ranges == []
+    assert allocator.allocate(1) is None
+
+
+def test_allocate_reuses_first_hole_that_fits():
+    allocator = FreeListAllocator(100)
+    a, b, c, d = (allocator.allocate(size) for size in (10, 30, 10, 20))
+    allocator.free(a)
+    allocator.free(c)
+
+    # Too big for the 10 unit holes, so it goes after d
+    e = allocator.allocate(15)
+    assert e.offset == 70
+
+    f = allocator.allocate(10)
+    assert f.offset == 0
+
+
+def test_allocate_too_large():
+    allocator = FreeListAllocator(10)
+    assert allocator.allocate(11) is None
+    assert allocator.allocations == []
+
+
+def test_free_merges_with_following_range():
+    allocator = FreeListAllocator(100)
+    a = allocator.allocate(30)
+    allocator.allocate(20)
+    allocator.free(a)
+
+    # b separates a from the free range after it, so nothing merges
+    assert allocator.free_ranges == [[0, 30], [50, 50]]
+
+    allocator = FreeListAllocator(100)
+    a = allocator.allocate(30)
+    b = allocator.allocate(20)
+    allocator.free(b)
+    assert allocator.free_ranges == [[30, 70]]
+
+
+def test_free_merges_with_preceding_range():
+    allocator = FreeListAllocator(100)
+    a = allocator.allocate(30)
+    b = allocator.allocate(20)
+    allocator.allocate(50)
+    allocator.free(a)
+    allocator.free(b)
+
+    assert allocator.free_ranges == [[0, 50]]
+
+
+def test_free_merges_with_both_neighbours():
+    allocator = FreeListAllocator(100)
+    a, b, c, d = (allocator.allocate(size) for size in (10, 20, 30, 40))
+    allocator.free(a)
+    allocator.free(c)
+    assert allocator.free_ranges == [[0, 10], [30, 30]]
+
+    allocator.free(b)
+    assert allocator.free_ranges == [[0, 60]]
+
+    allocator.free(d)
+    assert allocator.free_ranges == [[0, 100]]
+    assert allocator.allocations == []
+
+
+def test_zero_size_allocations():
+    allocator = FreeListAllocator(10)
+    allocator.allocate(10)
+
+    # Zero sizes fit even when the allocator is full, and take no space
+    empty = allocator.allocate(0)
+    assert empty is not None
+    assert empty.size == 0
+    assert allocator.used() == 10
+
+    allocator.free(empty)
+    assert empty not in allocator.allocations
+    assert allocator.free_ranges == []
+
+    allocator = FreeListAllocator(0)
+    assert allocator.free_ranges == []
+    assert allocator.allocate(0).size == 0
+
+
+def test_compact():
+    allocator = FreeListAllocator(100)
+    a, b, c, d = (allocator.allocate(size) for size in (10, 20, 30, 40))
+    allocator.free(a)
+    allocator.free(c)
+
+    moves = allocator.compact()
+
+    assert [(allocation, old_offset) for allocation, old_offset in moves] == [(b, 10), (d, 60)]
+    assert (b.offset, d.offset) == (0, 20)
+    assert allocator.free_ranges == [[60, 40]]
+    assert allocator.compact() == []
+
+
+def test_compact_full():
+    allocator = FreeListAllocator(30)
+    a = allocator.allocate(10)
+    allocator.allocate(20)
+    allocator.free(a)
+    allocator.allocate(10)
+
+    allocator.compact()
+    assert allocator.free_ranges == []
+    assert allocator.largest_free() == 0
+
+
+def test_largest_free():
+    allocator = FreeListAllocator(100)
+    assert allocator.largest_free() == 100
+
+    a, b, c, d = (allocator.allocate(size) for size in (10, 20, 30, 25))
+    allocator.free(a)
+    allocator.free(c)
+    assert allocator.free_ranges == [[0, 10], [30, 30], [85, 15]]
+    assert allocator.largest_free() == 30
@@ -0,0 +1,56 @@
+import glm
+import numpy as np
+
+from frustum import FrustumCuller
+from indirect import IndirectBatch
+from model_registry import model_registry
+from render_queue import RenderQueue
+from transform import TransformNode
+
+
+class BoundsOnlyBatch(IndirectBatch):
+    """An IndirectBatch without GL buffers, for testing its bounds."""
+    def __del__(self):
+        pass
+
+
+def make_batch(centres, radii, extents) -> IndirectBatch:
+    """Returns a batch with members of the given world bounds."""
+    batch = BoundsOnlyBatch.__new__(BoundsOnlyBatch)
+    batch.centres = np.array(centres, dtype=np.float64)
+    batch.radii = np.array(radii, dtype=np.float64)
+    batch.extents = np.array(extents, dtype=np.float64)
+    batch.slot = model_registry.register(TransformNode())
+    return batch
+
+
+def test_bounds_contain_every_member():
+    batch = make_batch([[-10, 0, 0], [20, 1, 2]], [1, 2], [[1, 1, 1], [2, 1, 1]])
+    try:
+        centre, radius, extents = batch.bounds()
+
+        assert np.allclose(centre, [5.5, 0.5, 1])
+        assert np.allclose(extents, [16.5, 1.5, 2])
+        assert np.isclose(radius, np.linalg.norm(extents))
+    finally:
+        model_registry.unregister(batch.slot)
+
+
+def test_batch_is_drawn_when_only_a_later_member_is_in_view():
+    # Camera at the origin looking down -z: the first member is behind it,
+    # and the second is in front of it
+    P = glm.perspective(glm.radians(60), 1.0, 0.1, 100)
+    V = glm.lookAt(glm.vec3(0, 0, 0), glm.vec3(0, 0, -1), glm.vec3(0, 1, 0))
+    batch = make_batch([[0, 0, 50], [0, 0, -20]], [1, 1], [[0.5, 0.5, 0.5]] * 2)
+    try:
+        planes = FrustumCuller.planes(P * V)
+        inside = FrustumCuller.inside(batch.centres, batch.radii, batch.extents, planes)
+        assert inside.tolist() == [False, True]
+
+        assert FrustumCuller().cull([batch], P * V, "main") == [batch]
+
+        # Sorted by the depth of the centre of every member together
+        depth, = RenderQueue.view_depths([batch], np.array([batch.slot]), V)
+        assert np.isclose(depth, -15)
+    finally:
+        model_registry.unregister(batch.slot)
@@ -0,0 +1,37 @@
+import glm
+import numpy as np
+
+from instancing import InstancedModel, INSTANCE_FLOATS
+
+
+def column_major(M: glm.mat4) -> np.ndarray:
+    return np.array(M, dtype=np.float32).T.ravel()
+
+
+def test_pack_transforms():
+    transforms = InstancedModel.compose(np.array([[0, 0, 0], [1, 2, 3], [-4, 0, 5]]),
+                                        angles=np.array([0, 0.5, 2.0]), scales=np.array([1, 2, 0.5]))
+    out = np.zeros((3, INSTANCE_FLOATS), dtype=np.float32)
+
+    InstancedModel.pack_transforms(transforms, out)
+
+    for i, transform in enumerate(transforms):
+        M = glm.mat4(*transform.T.ravel())
+        assert np.allclose(out[i, :16], column_major(M))
+        assert np.allclose(out[i, 16:32], column_major(glm.inverseTranspose(M)), atol=1e-6)
+
+
+def test_pack_transforms_zero_scale():
+    # The middle instance is hidden by scaling it to 0
+    transforms = InstancedModel.compose(np.array([[0, 0, 0], [1, 2, 3], [-4, 0, 5]]),
+                                        scales=np.array([1, 0, 2]))
+    out = np.zeros((3, INSTANCE_FLOATS), dtype=np.float32)
+
+    InstancedModel.pack_transforms(transforms, out)
+
+    for i, transform in enumerate(transforms):
+        M = glm.mat4(*transform.T.ravel())
+        assert np.allclose(out[i, :16], column_major(M))
+        assert np.allclose(out[i, 16:32], column_major(glm.inverseTranspose(M)),
+                           atol=1e-6, equal_nan=True)
+    assert not np.all(np.isfinite(out[1, 16:32]))
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from mesh import GridMesh
+
+
+def wavy_grid(mirror=False) -> GridMesh:
+    """A grid with a curved surface, so its normals vary, and (optionally) mirrored texture coordinates."""
+    mesh = GridMesh(8, 8)
+    mesh.vertices[:, 1] = 0.3 * np.sin(3 * mesh.vertices[:, 0]) * np.cos(2 * mesh.vertices[:, 2])
+    if mirror:
+        mesh.textureCoords[:, 0] = 1 - mesh.textureCoords[:, 0]
+    mesh.calculate_normals()
+    return mesh
+
+
+@pytest.mark.parametrize("mirror", [False, True], ids=["unmirrored", "mirrored"])
+def test_tangent_basis_is_orthonormal(mirror):
+    mesh = wavy_grid(mirror)
+    N, T, B = mesh.normals, mesh.tangents, mesh.binormals
+
+    for vectors in (N, T, B):
+        assert np.allclose(np.linalg.norm(vectors, axis=1), 1, atol=1e-5)
+    for u, v in ((N, T), (N, B), (T, B)):
+        assert np.allclose(np.sum(u * v, axis=1), 0, atol=1e-5)
+
+
+@pytest.mark.parametrize("mirror", [False, True], ids=["unmirrored", "mirrored"])
+def test_binormals_follow_texture_v(mirror):
+    mesh = wavy_grid(mirror)
+
+    # v increases with z on a grid, so the binormals point along +z,
+    # whichever way u goes
+    assert np.all(mesh.binormals[:, 2] > 0)
+
+
+def test_mirroring_flips_handedness():
+    def handedness(mesh):
+        return np.sum(np.cross(mesh.normals, mesh.tangents) * mesh.binormals, axis=1)
+
+    unmirrored = handedness(wavy_grid())
+    mirrored = handedness(wavy_grid(mirror=True))
+
+    assert np.allclose(np.abs(unmirrored), 1, atol=1e-5)
+    assert np.allclose(unmirrored, unmirrored[0])
+    assert np.allclose(mirrored, -unmirrored)
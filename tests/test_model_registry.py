@@ -0,0 +1,57 @@
+import glm
+import numpy as np
+import pytest
+
+from model_registry import ModelRegistry
+from transform import TransformNode
+
+
+def column_major(M: glm.mat4) -> np.ndarray:
+    return np.array(M, dtype=np.float32).T.ravel()
+
+
+@pytest.mark.parametrize("M", [
+    glm.mat4(),
+    glm.translate(glm.vec3(1, -2, 3)) * glm.rotate(0.7, glm.vec3(0, 1, 0)) * glm.scale(glm.vec3(2, 3, 0.5)),
+    glm.scale(glm.vec3(0, 1, 1)),
+    glm.mat4(0),
+], ids=["identity", "affine", "zero scale", "zero"])
+def test_update_packs_M_and_inverse_transpose(M):
+    registry = ModelRegistry()
+    slot = registry.register(TransformNode(M))
+
+    registry.update()
+
+    assert np.allclose(registry.uniforms[slot, :16], column_major(M))
+    assert np.allclose(registry.uniforms[slot, 16:], column_major(glm.inverseTranspose(M)),
+                       rtol=1e-5, atol=1e-6, equal_nan=True)
+
+
+def test_update_mixed_singular_and_invertible():
+    registry = ModelRegistry()
+    nodes = [TransformNode(glm.translate(glm.vec3(i, 0, 0)) * glm.scale(glm.vec3(i % 2)))
+             for i in range(4)]
+    slots = [registry.register(node) for node in nodes]
+
+    registry.update()
+
+    for slot, node in zip(slots, nodes):
+        assert np.allclose(registry.uniforms[slot, 16:], column_major(glm.inverseTranspose(node.world)),
+                           rtol=1e-5, atol=1e-6, equal_nan=True)
+    assert registry.pending == set()
+
+
+def test_update_only_dirty_slots():
+    registry = ModelRegistry()
+    moved, still = TransformNode(), TransformNode()
+    moved_slot, still_slot = registry.register(moved), registry.register(still)
+    registry.update()
+    still_version = registry.versions[still_slot]
+
+    moved.set_local(glm.translate(glm.vec3(0, 5, 0)))
+    assert registry.pending == {moved_slot}
+
+    registry.update()
+    assert np.allclose(registry.world[moved_slot], np.array(moved.world))
+    assert registry.versions[moved_slot] == moved.version
+    assert registry.versions[still_slot] == still_version
@@ -100,3 +100,6 @@ class Texture:
 
     def unbind(self):
         glBindTexture(self.target, 0)
+
+    def delete(self):
+        glDeleteTextures(1, [self.textureid])
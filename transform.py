@@ -0,0 +1,147 @@
+import itertools
+
+import glm
+import numpy as np
+
+'''
+A hierarchy of transforms (a scene graph). Each TransformNode has a local
+matrix, relative to its parent, and caches:
+    - its world matrix, parent.world * local, and
+    - its normal matrix, the inverse transpose of the world matrix.
+Changing a node's local matrix marks it and its descendants dirty, and they
+are recalculated the next time they are read, so moving an object made of
+several meshes (one child node each) is one update of their parent, and
+nodes which haven't changed cost nothing.
+
+Every recalculated world matrix gets a new version number, unique across
+all nodes, so shaders can tell whether the matrix they last uploaded is
+still current by comparing one integer.
+'''
+
+# Source of world matrix versions
+_versions = itertools.count(1)
+
+
+class TransformNode:
+    def __init__(self, local=glm.mat4(), parent=None, name: str = ""):
+        """
+        :param local: The node's matrix, relative to its parent.
+        :param parent: [optional] The node this one moves with.
+        """
+        self.name = name
+        self.local = glm.mat4(local)
+
+        self.parent = None
+        self.children: list[TransformNode] = []
+
+        # Cached world and normal matrices, and the world matrix as a numpy
+        # array (for the vectorised culling and sorting of models)
+        self._world = glm.mat4()
+        self._normal = glm.mat4()
+        self._array = None
+
+        # Whether the world matrix needs recalculating, and the version of
+        # the world matrix the normal matrix and array were calculated from
+        self.dirty = True
+        self.version = 0
+        self.normal_version = 0
+        self.array_version = 0
+
+        # Called whenever the node goes from clean to dirty (see
+        # model_registry.py)
+        self.on_dirty = None
+
+        if parent is not None:
+            parent.add_child(self)
+
+
+    def add_child(self, child) -> None:
+        """Makes a node (removing it from any previous parent) a child of this one."""
+        if child.parent is not None:
+            child.parent.children.remove(child)
+
+        child.parent = self
+        self.children.append(child)
+        child.mark_dirty()
+
+
+    def remove_child(self, child) -> None:
+        """Detaches a child, which keeps its local matrix as its world matrix."""
+        self.children.remove(child)
+        child.parent = None
+        child.mark_dirty()
+
+
+    def mark_dirty(self) -> None:
+        """
+        Marks the node and its descendants as needing their world matrices
+        recalculated. A dirty node's descendants are always dirty (as they
+        can only be recalculated after it), so marking stops at dirty nodes.
+        """
+        if self.dirty:
+            return
+
+        self.dirty = True
+        if self.on_dirty is not None:
+            self.on_dirty()
+        for child in self.children:
+            child.mark_dirty()
+
+
+    def set_local(self, local: glm.mat4) -> None:
+        """Replaces the node's matrix, relative to its parent."""
+        self.local = glm.mat4(local)
+        self.mark_dirty()
+
+
+    def apply(self, M: glm.mat4) -> None:
+        """Multiplies the node's local matrix by M (on the right)."""
+        self.set_local(self.local * M)
+
+
+    def set_world(self, world: glm.mat4) -> None:
+        """Sets the local matrix which gives the node this world matrix."""
+        if self.parent is None:
+            self.set_local(world)
+        else:
+            self.set_local(glm.inverse(self.parent.world) * world)
+
+
+    @property
+    def world(self) -> glm.mat4:
+        """The node's world matrix, recalculated if it is dirty."""
+        if self.dirty:
+            if self.parent is None:
+                self._world = glm.mat4(self.local)
+            else:
+                self._world = self.parent.world * self.local
+            self.dirty = False
+            self.version = next(_versions)
+        return self._world
+
+
+    @property
+    def normal_matrix(self) -> glm.mat4:
+        """The inverse transpose of the world matrix, for transforming normals."""
+        world = self.world
+        if self.normal_version != self.version:
+            self._normal = glm.inverseTranspose(world)
+            self.normal_version = self.version
+        return self._normal
+
+
+    @property
+    def world_array(self) -> np.ndarray:
+        """The world matrix as a (4, 4) float64 array, in the mathematical layout."""
+        world = self.world
+        if self.array_version != self.version:
+            self._array = np.array(world, dtype=np.float64)
+            self.array_version = self.version
+        return self._array
+
+
+    @property
+    def world_version(self) -> int:
+        """The version of the (recalculated if dirty) world matrix."""
+        self.world
+        return self.version
@@ -0,0 +1,196 @@
+import ctypes
+
+from OpenGL.GL import *
+
+import glm
+import numpy as np
+
+'''
+Vertex buffer layouts, and the compact vertex formats used by MeshBuffers
+when a model opts in to them.
+
+Attribute     float format         compact format
+position      3 x float32 (12B)    4 x unorm16 (8B), relative to the mesh bounds
+normal        3 x float32 (12B)    snorm 10_10_10_2 (4B)
+tex_coord     2 x float32 (8B)     2 x float16 (4B)
+indices       uint32 (4B)          uint16 (2B) if every index fits
+
+Quantised positions are in [0, 1] on each axis of the mesh's bounding box, so
+shaders must transform them by the mesh's dequantisation matrix (the
+position_transform uniform) before using them. The 4th component of a
+position is padding, so each vertex stays 4-byte aligned.
+
+Whatever the formats, the attributes of a mesh are interleaved into a single
+vertex buffer by VertexLayout, at the fixed locations below (which the
+shaders' layout qualifiers use).
+'''
+
+# Shader location of each vertex attribute
+ATTRIBUTE_LOCATIONS = {
+    "position": 0,
+    "normal": 1,
+    "colour": 2,
+    "tex_coord": 3
+}
+
+# First shader location of each per-instance attribute (see instancing.py).
+# Each mat4 takes 4 consecutive locations, one per column.
+INSTANCE_LOCATIONS = {
+    "instance_M": 4,
+    "instance_M_it": 8,
+    "instance_tint": 12
+}
+
+
+class VertexAttribute:
+    """The format and data of one attribute in a VertexLayout."""
+    def __init__(self, name, data, type, normalized, size, offset):
+        self.name = name
+        self.location = ATTRIBUTE_LOCATIONS[name]
+        self.data = data
+        self.type = type
+        self.normalized = normalized
+
+        # Number of components, as given to glVertexAttribPointer
+        self.size = size
+
+        # Offset in bytes from the start of each vertex
+        self.offset = offset
+
+
+class VertexLayout:
+    """
+    Builds an interleaved vertex buffer: each vertex's attributes are stored
+    next to each other, so one buffer (and one upload) holds the whole mesh.
+    """
+    def __init__(self, vertex_count: int):
+        self.vertex_count = vertex_count
+        self.attributes: list[VertexAttribute] = []
+
+        # Size of each vertex in bytes
+        self.stride = 0
+
+
+    def add(self, name: str, data: np.ndarray, type=GL_FLOAT, normalized=False, size=None) -> None:
+        """
+        Adds an attribute to the layout, unless data is None.
+        :param data: A (vertex_count, n) array, already of the type given.
+        :param size: The number of components, if not the width of data.
+        """
+        if data is None:
+            return
+
+        data = np.ascontiguousarray(data).reshape(self.vertex_count, -1)
+        if size is None:
+            size = data.shape[1]
+
+        self.attributes.append(VertexAttribute(name, data, type, normalized, size, self.stride))
+
+        # Keep every attribute 4-byte aligned
+        self.stride += -(-data.shape[1] * data.itemsize // 4) * 4
+
+
+    def build(self) -> np.ndarray:
+        """Returns the interleaved vertex data, as a (vertex_count, stride) uint8 array."""
+        vertices = np.zeros((self.vertex_count, self.stride), dtype=np.uint8)
+        for attribute in self.attributes:
+            data = attribute.data.view(np.uint8).reshape(self.vertex_count, -1)
+            vertices[:, attribute.offset:attribute.offset + data.shape[1]] = data
+        return vertices
+
+
+class VertexFormat:
+    @staticmethod
+    def float_layout(mesh) -> VertexLayout:
+        """Returns the layout of a mesh with every attribute stored as floats."""
+        layout = VertexLayout(mesh.vertices.shape[0])
+        for name, data in (("position", mesh.vertices), ("normal", mesh.normals),
+                           ("colour", mesh.colors), ("tex_coord", mesh.textureCoords)):
+            if data is not None:
+                layout.add(name, np.asarray(data, dtype=np.float32))
+        return layout
+
+
+    @staticmethod
+    def compact_layout(mesh) -> tuple:
+        """
+        Returns the layout of a mesh in the compact formats, and the matrix
+        which dequantises its positions.
+        """
+        layout = VertexLayout(mesh.vertices.shape[0])
+
+        positions, dequantise = VertexFormat.quantise_positions(mesh.vertices)
+        layout.add("position", positions, type=GL_UNSIGNED_SHORT, normalized=True)
+
+        if mesh.normals is not None:
+            layout.add("normal", VertexFormat.pack_normals(mesh.normals),
+                       type=GL_INT_2_10_10_10_REV, normalized=True, size=4)
+
+        if mesh.colors is not None:
+            layout.add("colour", np.asarray(mesh.colors, dtype=np.float32))
+
+        if mesh.textureCoords is not None:
+            layout.add("tex_coord", VertexFormat.half_floats(mesh.textureCoords), type=GL_HALF_FLOAT)
+
+        return layout, dequantise
+
+
+    @staticmethod
+    def quantise_positions(positions: np.ndarray) -> tuple:
+        """
+        Quantises positions to unorm16 against their bounding box.
+        :return: the (n, 4) uint16 array, and the matrix which maps the
+        normalised values back to the original positions.
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        low = positions.min(axis=0)
+        size = positions.max(axis=0) - low
+        size[size == 0] = 1.0
+
+        quantised = np.zeros((positions.shape[0], 4), dtype=np.uint16)
+        quantised[:, :3] = np.rint((positions - low) / size * 65535)
+
+        dequantise = glm.translate(glm.vec3(*low)) * glm.scale(glm.vec3(*size))
+        return quantised, dequantise
+
+
+    @staticmethod
+    def pack_normals(normals: np.ndarray) -> np.ndarray:
+        """
+        Packs unit vectors into one uint32 each, with 10 bits per component
+        (GL_INT_2_10_10_10_REV, normalised).
+        """
+        components = np.rint(np.clip(normals, -1.0, 1.0) * 511).astype(np.int32) & 0x3FF
+        packed = components[:, 0] | (components[:, 1] << 10) | (components[:, 2] << 20)
+        return packed.astype(np.uint32).reshape(-1, 1)
+
+
+    @staticmethod
+    def half_floats(data: np.ndarray) -> np.ndarray:
+        """Converts an array to 16-bit floats (GL_HALF_FLOAT)."""
+        return np.ascontiguousarray(data, dtype=np.float16)
+
+
+    @staticmethod
+    def point_attributes(formats, stride: int) -> None:
+        """
+        Points the bound vao's attribute locations at the bound vertex buffer.
+        :param formats: The (location, size, type, normalized, offset) of each attribute.
+        """
+        for location, size, type, normalized, offset in formats:
+            glEnableVertexAttribArray(location)
+
+            # Every vertex shader instance gets one vertex of the buffer, so can be processed in parallel
+            glVertexAttribPointer(index=location, size=size, type=type, normalized=normalized,
+                stride=stride, pointer=ctypes.c_void_p(offset))
+
+
+    @staticmethod
+    def index_type(vertex_count: int, compact: bool) -> tuple:
+        """
+        Returns the numpy and OpenGL index types for a mesh: uint16 if
+        compact and every index fits, otherwise uint32.
+        """
+        if compact and vertex_count <= 65536:
+            return np.uint16, GL_UNSIGNED_SHORT
+        return np.uint32, GL_UNSIGNED_INT